@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Measures what the backplane adds to a message. Two Hotaru nodes run in this
+process, the room is created on node A, the owner connects to node A and a
+player to node B, so both directions cross the backplane once:
+
+    direct  both connect to node A, no backplane involved
+    local   node B reaches node A through a shared LocalBackplane
+    broker  through BrokerBackplane and the stand-in broker of hotaru/broker.py
+
+Messages are sent one at a time, each after the previous one arrived, and the
+p50/p99 latency is reported per direction.
+Run from the repository root: python benchmarks/backplane.py --messages 2000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru.backplane import BrokerBackplane, LocalBackplane
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_broker():
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "hotaru.broker", "--port", str(port)],
+                               cwd=ROOT, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the broker didn't start listening")
+
+
+def node(backplane):
+    app = Hotaru(do_inspect=False, do_metrics=False, backplane=backplane)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    return server, f"127.0.0.1:{sockets[0].getsockname()[1]}"
+
+
+def connect(base, query):
+    return tornado.websocket.websocket_connect(f"ws://{base}/ws/v0?{query}")
+
+
+# Sends a chat and waits for it on the other end, anything else that arrives is skipped
+async def one_way(sender, receiver, to, i):
+    started = time.perf_counter()
+    await sender.write_message("chat " + json.dumps({"to": to, "content": i}))
+    while True:
+        msg = json.loads(await receiver.read_message()).get("msg", {})
+        if msg.get("type") == "msg" and msg.get("am") == i:
+            return time.perf_counter() - started
+
+
+async def measure(mode, messages, broker_port=None):
+    if mode == "broker":
+        a, b = BrokerBackplane(port=broker_port), BrokerBackplane(port=broker_port)
+        await a.connect()
+        await b.connect()
+    else:
+        channels = {}
+        a, b = LocalBackplane(channels), LocalBackplane(channels)
+
+    server_a, base_a = node(a)
+    server_b, base_b = node(b)
+    if mode == "direct":
+        base_b = base_a
+
+    http = tornado.httpclient.AsyncHTTPClient()
+    room = json.loads((await http.fetch(f"http://{base_a}/hotaru/v0/createServer",
+                                        method="POST", body="")).body)
+
+    owner = await connect(base_a, f"code={room['c']}&su={room['su']}")
+    player = await connect(base_b, f"code={room['c']}&name=player")
+    # The owner hears about the player once it's in the room
+    while json.loads(await owner.read_message()).get("msg", {}).get("type") != "userappend":
+        pass
+
+    results = {}
+    for direction, sender, receiver, to in (("player to owner", player, owner, 1),
+                                            ("owner to player", owner, player, "player")):
+        samples = sorted([await one_way(sender, receiver, to, i) for i in range(messages)])
+        results[direction] = (samples[len(samples) // 2], samples[int(len(samples) * 0.99)])
+
+    owner.close()
+    player.close()
+    server_a.stop()
+    server_b.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000, help="messages per direction")
+    args = parser.parse_args()
+
+    broker, port = start_broker()
+    try:
+        print(f"{'mode':>8} {'direction':>16} {'p50':>10} {'p99':>10}")
+        for mode in ("direct", "local", "broker"):
+            results = asyncio.run(measure(mode, args.messages, port))
+            for direction, (p50, p99) in results.items():
+                print(f"{mode:>8} {direction:>16} {p50 * 1e6:>7.0f} us {p99 * 1e6:>7.0f} us")
+    finally:
+        broker.kill()
+        broker.wait()
+
+
+if __name__ == "__main__":
+    main()
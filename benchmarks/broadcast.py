@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measures the cost of one "to": 2 broadcast for different room sizes.
+Run from the repository root: python benchmarks/broadcast.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru import messages
+from hotaru.servers import Server
+from hotaru.players import Player, inbound_frame
+
+CONTENT = {
+    "question": "Which of these is not a fruit?",
+    "answers": ["Apple", "Tomato", "Carrot", "Banana"],
+    "time": 30
+}
+
+
+class NullClient:
+    """
+    Stands in for a WebSocket, it only remembers how much was written
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write_message(self, frame):
+        self.written += len(frame)
+
+    def write_inbound(self, q, message):
+        self.write_message(inbound_frame(q, message.encode()))
+
+
+def make_room(size):
+    server = Server("BNCH", -1)
+    server.client = NullClient()
+    for i in range(size):
+        server.add_user(Player(f"player{i}", NullClient()))
+    return server
+
+
+# What every broadcast used to cost: one full json.dumps per recipient
+def broadcast_per_recipient(server):
+    msg = messages.RawMessage(server, CONTENT)
+    for player in server.players.list():
+        player.client.write_message(json.dumps(
+            {
+                "type": "inbound",
+                "q": player.next,
+                "msg": msg.repr()
+            }
+        ))
+        player.next += 1
+
+
+def broadcast_encoded_once(server):
+    msg = messages.RawMessage(server, CONTENT)
+    server.sends_message(server.players, msg)
+
+
+def main():
+    print(f"{'players':>8} {'per recipient':>16} {'encoded once':>16} {'us/recipient':>14}")
+    for size in (1, 10, 100, 1000):
+        rounds = max(10, 20000 // size)
+
+        old = make_room(size)
+        t_old = timeit.timeit(lambda: broadcast_per_recipient(old), number=rounds) / rounds
+
+        new = make_room(size)
+        t_new = timeit.timeit(lambda: broadcast_encoded_once(new), number=rounds) / rounds
+
+        print(f"{size:>8} {t_old * 1e6:>13.1f} us {t_new * 1e6:>13.1f} us {t_new * 1e6 / size:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
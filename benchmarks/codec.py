@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Compares the JSON codecs of hotaru/codec.py on what Hotaru parses and writes for
+itself all the time, and measures how long a long repeat holds up the IOLoop, from
+the "repeat" command to the frame being written. It's compared with building every
+dict first and encoding the frame at once, or a chunk at a time, see sessions.py.
+Frames for clients are written by the json module with either codec.
+Run from the repository root: python benchmarks/codec.py --repeat 100000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru import Hotaru
+from hotaru import codec
+from hotaru import messages
+from hotaru.players import Player
+from hotaru.servers import Server
+from hotaru.sessions import Session
+
+FRAME = 'chat {"to": 2, "content": {"question": "Which of these is not a fruit?", ' \
+        '"answers": ["Apple", "Tomato", "Carrot", "Banana"], "time": 30}}'
+RECORD = ["chat", "ABCD", "player1", 2, {"question": "Which of these is not a fruit?",
+                                         "answers": ["Apple", "Tomato", "Carrot", "Banana"]}]
+BODY = {"type": "msg", "from": "player1",
+        "am": {"question": "Which of these is not a fruit?",
+               "answers": ["Apple", "Tomato", "Carrot", "Banana"], "time": 30}}
+
+
+def codecs():
+    found = [codec.JsonCodec()]
+    if codec.orjson:
+        found.append(codec.OrjsonCodec())
+    return found
+
+
+class NullClient:
+    def write_inbound(self, q, message):
+        pass
+
+
+class RecordingSession(Session):
+    """
+    A client of the room that keeps whatever is written to it.
+    """
+
+    connected = True
+
+    def __init__(self, application):
+        self.application = application
+        self.metrics = application.metrics
+        self.written = []
+
+    def write_message(self, message, binary=False):
+        self.written.append(message)
+
+    def close(self, code=None, reason=None):
+        pass
+
+
+# A player with a long log of broadcasts, messages from the owner and shadows
+def long_log(application, length):
+    server = Server("BNCH", -1)
+    server.client = NullClient()
+    session = RecordingSession(application)
+    player = Player("player", session)
+    server.register(player)
+    session.bind(server, player)
+
+    for i in range(length):
+        content = {"n": i, "pad": "x" * 64}
+        if i % 4 == 0:
+            player.sends_message(server, messages.RawMessage(player, content))
+        elif i % 4 == 1:
+            server.sends_message(player, messages.RawMessage(server, content))
+        else:
+            server.sends_message(server.players, messages.RawMessage(server, content))
+    return session
+
+
+# How long it took and the longest the IOLoop went without getting to run meanwhile
+async def stall(repeat):
+    gaps = []
+    done = asyncio.Event()
+
+    async def tick():
+        last = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await repeat()
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.01)
+    done.set()
+    await ticker
+    return elapsed, max(gaps)
+
+
+def repeats(session, chunk):
+    player = session.player
+
+    # Every dict built first, then encoded at once
+    async def at_once():
+        repeat = player.generate_repeat(0)
+        session.write_message(codec.dumps(
+            {"type": "repeated", "start": 0, "repeat": repeat, "next": player.next}, False))
+
+    # Every dict built first, then encoded a chunk at a time
+    async def dicts_chunked():
+        repeat = player.generate_repeat(0)
+        chunks = []
+        for i in range(0, len(repeat), chunk):
+            chunks.append(codec.dumps(repeat[i:i + chunk], False)[1:-1])
+            await asyncio.sleep(0)
+        session.write_message(session.protocol.repeated(0, len(repeat), chunks, player.next))
+
+    # What the "repeat" command does
+    async def run():
+        waiting = session.run("repeat", 0)
+        if waiting:
+            await waiting
+
+    return [("at once", at_once), ("dicts chunked", dicts_chunked), ("run(\"repeat\")", run)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=100000, help="messages in the long repeat")
+    parser.add_argument("--chunk", type=int, default=1000, help="messages encoded at a time")
+    args = parser.parse_args()
+
+    rounds = 100000
+    payload = FRAME.partition(" ")[2]
+    print(f"{'codec':>7} {'parse frame':>12} {'journal record':>15}")
+    for c in codecs():
+        t_parse = timeit.timeit(lambda: c.loads(payload), number=rounds) / rounds
+        t_record = timeit.timeit(lambda: c.compact(RECORD), number=rounds) / rounds
+        print(f"{c.name:>7} {t_parse * 1e6:>9.2f} us {t_record * 1e6:>12.2f} us")
+
+    t_body = timeit.timeit(lambda: codec.dumps(BODY), number=rounds) / rounds
+    print(f"\na message body for clients {t_body * 1e6:.2f} us")
+
+    application = Hotaru(do_inspect=False, do_metrics=False, repeat_chunk=args.chunk)
+    session = long_log(application, args.repeat)
+    print(f"\nrepeat of {args.repeat} messages, {args.chunk} at a time")
+    print(f"{'':>15} {'total':>10} {'longest stall':>14}")
+    frames = []
+    for name, repeat in repeats(session, args.chunk):
+        session.written.clear()
+        elapsed, longest = asyncio.run(stall(repeat))
+        frames.append(session.written[-1])
+        print(f"{name:>15} {elapsed * 1e3:>7.1f} ms {longest * 1e3:>11.1f} ms")
+
+    # They all have to write the same frame
+    assert len(set(frames)) == 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes to allocate a room code as a prefix fills up,
+and what a prefix with a single room costs in memory.
+Run from the repository root: python benchmarks/codes.py
+"""
+
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru.codes import CodeAllocator, SPACE
+
+
+# The old way: draw random codes until one isn't taken
+def probing_allocate(taken):
+    while True:
+        code = "".join(random.choices(string.ascii_uppercase, k=4))
+        if code not in taken:
+            taken.add(code)
+            return code
+
+
+def measure(allocate, release, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        code = allocate()
+        samples.append(time.perf_counter() - start)
+        release(code)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def main():
+    rounds = 20000
+    print(f"{'occupancy':>10} {'probing p50':>12} {'p99':>10} {'allocator p50':>14} {'p99':>10}")
+
+    for occupancy in (0.1, 0.9, 0.999):
+        filled = int(SPACE * occupancy)
+
+        allocator = CodeAllocator()
+        taken = {allocator.allocate() for _ in range(filled)}
+
+        old = measure(lambda: probing_allocate(taken), taken.remove, rounds)
+        new = measure(allocator.allocate, allocator.release, rounds)
+
+        print(f"{occupancy:>10.1%} {old[0] * 1e6:>9.2f} us {old[1] * 1e6:>7.2f} us "
+              f"{new[0] * 1e6:>11.2f} us {new[1] * 1e6:>7.2f} us")
+
+    prefixes = 1000
+    tracemalloc.start()
+    allocators = [CodeAllocator() for _ in range(prefixes)]
+    for allocator in allocators:
+        allocator.allocate()
+    print(f"memory per prefix: {tracemalloc.get_traced_memory()[0] / prefixes:.0f} bytes")
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
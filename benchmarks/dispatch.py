@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Measures how many frames per second a single connection can push through
+HotaruWebsocket.on_message, without any network in the way.
+Run from the repository root: python benchmarks/dispatch.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+import tornado.httputil
+
+from hotaru import Hotaru
+from hotaru.hotaru import HotaruWebsocket
+
+
+class NullConnection:
+    """
+    Just enough of an HTTP connection for a handler to be constructed
+    """
+
+    def set_close_callback(self, callback):
+        pass
+
+
+def connect(app, query):
+    request = tornado.httputil.HTTPServerRequest(
+        method="GET", uri="/ws/v0?" + query, connection=NullConnection())
+    handler = HotaruWebsocket(app, request)
+    handler.path_args = ["v0"]
+    handler.open("v0")
+    return handler
+
+
+# How every frame used to find its server and player from the query string
+def xtract_args(handler):
+    code = handler.get_argument("code")
+    server = handler.application.pool.get_server_safe(code)
+
+    player_name = handler.get_argument("name", None)
+    player = None
+    if server and player_name:
+        player = server.get_player_safe(player_name)
+
+    su = handler.get_argument("su", None)
+    if su and not player_name:
+        player = server
+
+    return (server, player_name, player, su)
+
+
+# What every frame used to cost before the command was even looked at
+def legacy_preamble(handler, message):
+    xtract_args(handler)
+    message_command = message.split(" ")[0]
+    actual_message = json.loads(" ".join(message.split(" ")[1:]))
+    return message_command, actual_message
+
+
+def bound_preamble(handler, message):
+    message_command, _, payload = message.partition(" ")
+    actual_message = json.loads(payload)
+    return message_command, actual_message
+
+
+def main():
+    app = Hotaru(do_inspect=False)
+    server = app.pool.create_server(-1)
+    connect(app, f"code={server.code}&su={server.su}")
+    player = connect(app, f"code={server.code}&name=player")
+
+    frame = 'chat {"to": 1, "content": {"answer": 3, "time": 12.5}}'
+    rounds = 100000
+
+    for name, preamble in (("legacy preamble", legacy_preamble), ("bound preamble", bound_preamble)):
+        t = timeit.timeit(lambda: preamble(player, frame), number=rounds)
+        print(f"{name:>16}: {rounds / t:>10.0f} frames/s")
+
+    t = timeit.timeit(lambda: player.on_message(frame), number=rounds)
+    print(f"{'on_message':>16}: {rounds / t:>10.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main()
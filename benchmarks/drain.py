@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Measures how long a graceful shutdown takes with many connections open, see
+hotaru/drain.py. --rooms rooms get --players players each, all of them
+connected, plus --silent clients that never answer the close handshake and
+have to be dropped at the deadline.
+Connections take two file descriptors each here, raise ulimit -n accordingly.
+Run from the repository root: python benchmarks/drain.py --rooms 1000 --players 9
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.websocket
+
+from hotaru import Hotaru
+
+HANDSHAKE = ("GET /ws/v0?code={code}&name={name} HTTP/1.1\r\nHost: {base}\r\n"
+             "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+             "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+
+
+# Connects, then reads until it's closed, like any client would
+async def player(base, code, name, closed):
+    connection = await tornado.websocket.websocket_connect(f"ws://{base}/ws/v0?code={code}&name={name}")
+
+    async def read():
+        while await connection.read_message() is not None:
+            pass
+        closed.append(connection.close_code)
+
+    return asyncio.ensure_future(read())
+
+
+# Goes through the WebSocket handshake and then never reads again
+async def silent(base, code, name):
+    host, port = base.split(":")
+    reader, writer = await asyncio.open_connection(host, int(port))
+    writer.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    writer.write(HANDSHAKE.format(code=code, name=name, base=base).encode())
+    await reader.readuntil(b"\r\n\r\n")
+    return writer
+
+
+async def measure(args):
+    app = Hotaru(do_inspect=False, do_metrics=False, compress=False)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1", backlog=4096)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    base = f"127.0.0.1:{sockets[0].getsockname()[1]}"
+    http = tornado.httpclient.AsyncHTTPClient()
+
+    closed = []
+    readers = []
+    writers = []
+    for r in range(args.rooms):
+        room = json.loads((await http.fetch(f"http://{base}/hotaru/v0/createServer",
+                                            method="POST", body="")).body)
+        for i in range(args.players):
+            readers.append(await player(base, room["c"], f"player{i}", closed))
+        if r < args.silent:
+            writers.append(await silent(base, room["c"], "silent"))
+    await asyncio.sleep(0.5)
+
+    connections = len(app.sockets)
+    started = time.perf_counter()
+    await app.shutdown(args.timeout)
+    took = time.perf_counter() - started
+
+    await asyncio.gather(*readers, return_exceptions=True)
+    for writer in writers:
+        writer.close()
+    server.stop()
+
+    print(f"{'connections':>12} {'silent':>7} {'deadline':>9} {'took':>9} {'closed':>7} {'dropped':>8}")
+    print(f"{connections:>12} {len(writers):>7} {args.timeout:>7.1f} s {took:>7.2f} s "
+          f"{closed.count(4020):>7} {app.drain.leftover:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rooms", type=int, default=1000, help="rooms to open")
+    parser.add_argument("--players", type=int, default=9, help="players connected to each room")
+    parser.add_argument("--silent", type=int, default=10, help="clients that never answer")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds the shutdown may take")
+    args = parser.parse_args()
+    asyncio.run(measure(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Measures the cost of the owner messaging a team of players, one chat per
+member versus one chat to the team's group, see servers.Group.
+Run from the repository root: python benchmarks/groups.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru.servers import Server
+from hotaru.players import Player, inbound_frame
+
+CONTENT = {
+    "hint": "The answer starts with a T",
+    "role": "spymaster",
+    "time": 30
+}
+
+
+class NullClient:
+    """
+    Stands in for a WebSocket, it only remembers how much was written
+    """
+
+    def __init__(self):
+        self.written = 0
+
+    def write_inbound(self, q, message):
+        self.written += len(inbound_frame(q, message.encode()))
+
+
+def make_room(team):
+    server = Server("BNCH", -1)
+    server.client = NullClient()
+    for i in range(team * 2):
+        server.register(Player(f"player{i}", NullClient()))
+    names = [f"player{i}" for i in range(team)]
+    server.set_group("team", names)
+    return server, names
+
+
+def per_member(server, names):
+    for name in names:
+        server.chat(server, name, CONTENT)
+
+
+def to_group(server, names):
+    server.chat(server, "team", CONTENT)
+
+
+def main():
+    print(f"{'team':>6} {'per member':>14} {'group':>14} {'owner log':>10}")
+    for team in (2, 8, 32, 256):
+        rounds = max(10, 20000 // team)
+
+        old, names = make_room(team)
+        registered = len(old.messages)
+        t_old = timeit.timeit(lambda: per_member(old, names), number=rounds) / rounds
+
+        new, names = make_room(team)
+        t_new = timeit.timeit(lambda: to_group(new, names), number=rounds) / rounds
+
+        print(f"{team:>6} {t_old * 1e6:>11.1f} us {t_new * 1e6:>11.1f} us "
+              f"{(len(old.messages) - registered) // rounds:>4} -> {(len(new.messages) - registered) // rounds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measures what a late joiner costs in a room that has been running for a while.
+The owner broadcasts the current state of --keys things over and over, --messages
+times in total, and the players acknowledge every --ack-every messages. Then one
+more player registers and repeats everything, once with plain broadcasts and once
+with keyed ones, see messages.KeyedMessage.
+Run from the repository root: python benchmarks/latejoin.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru.players import Player
+from hotaru.servers import Server
+
+ACK_MARGIN = 32
+
+
+class NullClient:
+    def write_inbound(self, q, message):
+        pass
+
+
+def fill(args, keyed):
+    server = Server("BNCH", -1)
+    server.client = NullClient()
+    players = []
+    for i in range(args.players):
+        player = Player(f"player{i}", NullClient())
+        server.register(player)
+        players.append(player)
+
+    for i in range(args.messages):
+        key = f"key{i % args.keys}"
+        content = {key: i, "pad": "x" * args.size}
+        server.chat(server, 2, content, key if keyed else None)
+
+        # The owner acknowledges too, but not always at the same time as everyone else
+        if args.ack_every and i % args.ack_every == 0:
+            for p in players:
+                server.acknowledge(p, p.next, ACK_MARGIN)
+        if args.ack_every and i % (args.ack_every * 10) == 0:
+            server.acknowledge(server, server.next, ACK_MARGIN)
+    return server
+
+
+def late_join(server):
+    player = Player("late", NullClient())
+    started = time.perf_counter()
+    server.register(player)
+    repeat = player.generate_repeat(0)
+    elapsed = time.perf_counter() - started
+    return elapsed, len(repeat), len(json.dumps(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--keys", type=int, default=20, help="distinct pieces of state")
+    parser.add_argument("--players", type=int, default=8, help="players per room")
+    parser.add_argument("--size", type=int, default=64, help="padding bytes per message")
+    parser.add_argument("--ack-every", type=int, default=1000, help="0 never acknowledges")
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'join':>10} {'messages':>9} {'bytes':>10} {'owner repeat':>13} {'kept':>10}")
+    for keyed in (False, True):
+        server = fill(args, keyed)
+        elapsed, count, size = late_join(server)
+        owner = len(server.generate_repeat(server.floor))
+        stats = server.log_stats()
+        print(f"{'keyed' if keyed else 'plain':>6} {elapsed * 1e3:>7.2f} ms {count:>9} {size:>10} "
+              f"{owner:>13} {stats['bytes']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Load test over real WebSockets. Starts Hotaru in this process on localhost,
+creates rooms through /hotaru/v0/createServer and has owners and players
+send to each other with one of these patterns:
+
+    direct     every player sends chats to the owner
+    broadcast  every player sends chats to everyone ("to": 2)
+    chats      every player sends "chats" bursts to the owner
+    repeat     the owner broadcasts, then players keep reconnecting and asking for a repeat
+
+Reports messages per second, p50/p99 delivery latency and the server's RSS.
+With --workers, server.py runs as that many worker processes, see hotaru/workers.py,
+and --procs client processes share the load so the clients don't become the bottleneck.
+Run from the repository root: python benchmarks/load.py --pattern broadcast --output run.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.websocket
+
+from hotaru import Hotaru
+
+PATTERNS = ("direct", "broadcast", "chats", "repeat")
+
+
+class Client:
+    """
+    One simulated owner or player. Every chat carries the time it was sent,
+    the reader works out the delivery latency from it
+    """
+
+    def __init__(self, run, url, name=None):
+        self.run = run
+        self.url = url
+        self.name = name
+        self.su = None
+        self.next = 0
+        self.connection = None
+        self.reader = None
+        # Resolved by the reader when a "repeated" frame arrives
+        self.repeated = None
+
+    async def connect(self, query):
+        self.connection = await tornado.websocket.websocket_connect(self.url + query)
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def close(self):
+        self.connection.close()
+        await self.reader
+
+    async def read(self):
+        while True:
+            frame = await self.connection.read_message()
+            if frame is None:
+                return
+
+            received = time.perf_counter()
+            frame = json.loads(frame)
+            if frame["type"] == "repeated":
+                self.repeated.set_result(frame)
+                continue
+            if frame["type"] != "inbound":
+                continue
+
+            self.next = frame["q"] + 1
+            msg = frame["msg"]
+            if msg["type"] == "su":
+                self.su = msg["su"]
+            elif msg["type"] == "msg" and isinstance(msg["am"], dict):
+                self.run.delivered(received - msg["am"]["t"])
+
+    def chat(self, to, burst=1):
+        payload = {"t": time.perf_counter(), "pad": self.run.padding}
+        if burst == 1:
+            return self.connection.write_message("chat " + json.dumps({"to": to, "content": payload}))
+        return self.connection.write_message("chats " + json.dumps([{"to": to, "content": payload}] * burst))
+
+    async def repeat(self, q):
+        self.repeated = asyncio.get_running_loop().create_future()
+        await self.connection.write_message(f"repeat {q}")
+        return await self.repeated
+
+
+class Run:
+    """
+    Counts deliveries until everything that was sent has arrived
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.padding = "x" * args.size
+        self.latencies = []
+        self.expected = 0
+        self.done = asyncio.Event()
+        # Messages that came back in repeats, for the repeat pattern
+        self.repeated = 0
+
+    def delivered(self, latency):
+        self.latencies.append(latency)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def create_room(http, base):
+    response = await http.fetch(f"http://{base}/hotaru/v0/createServer", method="POST", body="")
+    return json.loads(response.body)
+
+
+async def setup(args, base):
+    http = tornado.httpclient.AsyncHTTPClient()
+    run = Run(args)
+    rooms = []
+    for _ in range(args.rooms):
+        room = await create_room(http, base)
+        url = f"ws://{base}/ws/v0?code={room['c']}"
+
+        owner = Client(run, url)
+        await owner.connect(f"&su={room['su']}")
+        players = []
+        for i in range(args.players):
+            player = Client(run, url, f"player{i}")
+            await player.connect(f"&name={player.name}")
+            players.append(player)
+        rooms.append((owner, players))
+
+    # Wait for everyone's su before anything is sent
+    while not all(p.su for owner, players in rooms for p in players):
+        await asyncio.sleep(0.01)
+    return run, rooms
+
+
+# Without a rate, everyone sends as fast as the connection takes it and the
+# latency mostly shows how long messages queue up. With one, it shows delivery under that load
+async def send_all(clients, messages, send, rate=0):
+    async def sender(client):
+        started = time.perf_counter()
+        for i in range(messages):
+            if rate:
+                await asyncio.sleep(max(started + i / rate - time.perf_counter(), 0))
+            await send(client)
+    await asyncio.gather(*(sender(c) for c in clients))
+
+
+async def drive(args, run, rooms):
+    players = [p for owner, ps in rooms for p in ps]
+    owners = [owner for owner, ps in rooms]
+
+    if args.pattern == "direct":
+        run.expected = len(players) * args.messages
+        await send_all(players, args.messages, lambda c: c.chat(1), args.rate)
+
+    elif args.pattern == "broadcast":
+        # Everyone in the room gets it, the sender and the owner included
+        run.expected = len(players) * args.messages * (args.players + 1)
+        await send_all(players, args.messages, lambda c: c.chat(2), args.rate)
+
+    elif args.pattern == "chats":
+        run.expected = len(players) * args.messages * args.burst
+        await send_all(players, args.messages, lambda c: c.chat(1, args.burst), args.rate)
+
+    elif args.pattern == "repeat":
+        # Fill the logs first, then every player drops its connection, comes back
+        # and asks for everything again, over and over
+        run.expected = len(owners) * args.messages * (args.players + 1)
+        await send_all(owners, args.messages, lambda c: c.chat(2), args.rate)
+        await asyncio.wait_for(run.done.wait(), args.timeout)
+
+        run.latencies = []
+
+        async def storm(player):
+            for _ in range(args.reconnects):
+                await player.close()
+                await player.connect(f"&name={player.name}&su={player.su}")
+                started = time.perf_counter()
+                frame = await player.repeat(0)
+                run.latencies.append(time.perf_counter() - started)
+                run.repeated += len(frame["repeat"])
+
+        await asyncio.gather(*(storm(p) for p in players))
+        return run.repeated
+
+    try:
+        await asyncio.wait_for(run.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    return len(run.latencies)
+
+
+# Drives this process's share of the rooms, the barrier lines up several client processes
+async def drive_clients(args, base, barrier=None):
+    run, rooms = await setup(args, base)
+    if barrier:
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    started = time.perf_counter()
+    delivered = await drive(args, run, rooms)
+    elapsed = time.perf_counter() - started
+
+    for owner, players in rooms:
+        for client in [owner] + players:
+            client.connection.close()
+
+    return {
+        "delivered": delivered,
+        "expected": run.expected if args.pattern != "repeat" else None,
+        "elapsed": elapsed,
+        "latencies": run.latencies
+    }
+
+
+def client_process(args, base, barrier, queue):
+    queue.put(asyncio.run(drive_clients(args, base, barrier)))
+
+
+async def in_process(args):
+    app = Hotaru(do_inspect=False, do_metrics=False)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+
+    result = await drive_clients(args, f"127.0.0.1:{sockets[0].getsockname()[1]}")
+    server.stop()
+    return result
+
+
+# Runs server.py with WORKERS worker processes in a session of their own
+def start_workers(workers):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    env = dict(os.environ, WORKERS=str(workers), PORT=str(port), LOG_LEVEL="WARNING")
+    process = subprocess.Popen([sys.executable, "server.py"], cwd=ROOT, env=env,
+                               start_new_session=True)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process, f"127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server.py didn't start listening")
+
+
+# Resident memory of every process in a session, in kilobytes
+def session_rss(session):
+    total = 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            if os.getsid(int(pid)) != session:
+                continue
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+def main(args):
+    if args.workers:
+        process, base = start_workers(args.workers)
+        try:
+            share = argparse.Namespace(**vars(args))
+            share.rooms = max(args.rooms // args.procs, 1)
+
+            barrier = multiprocessing.Barrier(args.procs)
+            queue = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=client_process, args=(share, base, barrier, queue))
+                       for _ in range(args.procs)]
+            for client in clients:
+                client.start()
+            # A client process that crashed would leave us waiting forever otherwise
+            parts = [queue.get(timeout=args.timeout * 3) for _ in clients]
+            for client in clients:
+                client.join()
+            rss = session_rss(process.pid)
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+    else:
+        parts = [asyncio.run(in_process(args))]
+        # Linux reports this in kilobytes, clients included
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    delivered = sum(p["delivered"] for p in parts)
+    elapsed = max(p["elapsed"] for p in parts)
+    latencies = sorted(l for p in parts for l in p["latencies"])
+    return {
+        "pattern": args.pattern,
+        "config": vars(args),
+        "python": platform.python_version(),
+        "delivered": delivered,
+        "expected": None if args.pattern == "repeat" else sum(p["expected"] for p in parts),
+        "elapsed": elapsed,
+        "messages_per_second": delivered / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "server_rss_kb": rss
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pattern", choices=PATTERNS, default="direct")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--players", type=int, default=8, help="players per room")
+    parser.add_argument("--messages", type=int, default=200, help="messages per sender")
+    parser.add_argument("--burst", type=int, default=10, help="messages per chats frame")
+    parser.add_argument("--reconnects", type=int, default=5, help="repeats per player")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages per second per sender, 0 sends as fast as possible")
+    parser.add_argument("--size", type=int, default=32, help="padding bytes per message")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run server.py with this many worker processes instead of in this process")
+    parser.add_argument("--procs", type=int, default=1,
+                        help="client processes sharing the rooms, only with --workers")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = main(args)
+
+    print(f"{results['pattern']}: {results['delivered']} messages in {results['elapsed']:.2f} s, "
+          f"{results['messages_per_second']:.0f}/s")
+    if results["latency_p50"] is not None:
+        print(f"latency p50 {results['latency_p50'] * 1000:.2f} ms, "
+              f"p99 {results['latency_p99'] * 1000:.2f} ms")
+    print(f"server RSS {results['server_rss_kb'] / 1024:.1f} MiB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
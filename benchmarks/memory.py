@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Measures how many bytes a room keeps per stored message and per player.
+Run from the repository root: python benchmarks/memory.py
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru import messages
+from hotaru.servers import Server
+from hotaru.players import Player
+
+
+# Serializes like a connected client would, so the cached bodies are counted too
+class NullClient:
+    def write_inbound(self, q, message):
+        message.encode()
+
+
+def join(server, name):
+    player = Player(name, NullClient())
+    server.add_user(player)
+    player.subscribe(server.messages_public, messages.Su(player.su))
+    return player
+
+
+# Bytes allocated by fill(), divided by count
+def bytes_per(count, setup, fill):
+    state = setup()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = fill(state)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+
+def room(players):
+    server = Server("BNCH", -1)
+    return server, [join(server, f"player{i}") for i in range(players)]
+
+
+def broadcasts(state, count=50000):
+    server, players = state
+    for i in range(count):
+        players[i % len(players)].sends_message(server.players, messages.RawMessage(players[0], i))
+    return state
+
+
+def direct(state, count=50000):
+    server, players = state
+    for i in range(count):
+        players[0].sends_message(players[1], messages.RawMessage(players[0], i))
+    return state
+
+
+def registrations(state, count=10000):
+    server, players = state
+    return [join(server, f"new{i}") for i in range(count)]
+
+
+def main():
+    print(f"per broadcast (10 players):  {bytes_per(50000, lambda: room(10), broadcasts):>8.1f} bytes")
+    print(f"per direct message:          {bytes_per(50000, lambda: room(2), direct):>8.1f} bytes")
+    print(f"per player:                  {bytes_per(10000, lambda: room(0), registrations):>8.1f} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Measures what a client that asks for repeats in a loop does to everyone else.
+One room has a long log and a player that keeps sending "repeat 0" without
+waiting for the answers, another room measures the round trip of its chats.
+This runs once without rate limits and once with them, see hotaru/ratelimit.py.
+Run from the repository root: python benchmarks/noisy.py --log 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.netutil
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru.ratelimit import RateLimits
+
+
+async def room(base, http):
+    return json.loads((await http.fetch(f"http://{base}/hotaru/v0/createServer",
+                                        method="POST", body="")).body)
+
+
+def connect(base, query):
+    return tornado.websocket.websocket_connect(f"ws://{base}/ws/v0?{query}")
+
+
+async def spam(connection, stop):
+    while not stop.is_set():
+        await connection.write_message("repeat 0")
+        await asyncio.sleep(0)
+
+
+# The answers only have to be read so that they don't pile up
+async def discard(connection, stop):
+    while not stop.is_set() and await connection.read_message() is not None:
+        pass
+
+
+async def measure(rate_limits, args):
+    app = Hotaru(do_inspect=False, do_metrics=False, compress=False, rate_limits=rate_limits)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    base = f"127.0.0.1:{sockets[0].getsockname()[1]}"
+    http = tornado.httpclient.AsyncHTTPClient()
+
+    noisy = await room(base, http)
+    owner = await connect(base, f"code={noisy['c']}&su={noisy['su']}")
+    for i in range(args.log):
+        await owner.write_message("chat " + json.dumps({"to": 2, "content": {"n": i, "pad": "x" * 64}}))
+    spammer = await connect(base, f"code={noisy['c']}&name=spammer")
+
+    quiet = await room(base, http)
+    sender = await connect(base, f"code={quiet['c']}&su={quiet['su']}")
+    receiver = await connect(base, f"code={quiet['c']}&name=player")
+    await receiver.read_message()
+
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(spam(spammer, stop)), asyncio.ensure_future(discard(spammer, stop)),
+             asyncio.ensure_future(discard(owner, stop))]
+    await asyncio.sleep(0.5)
+
+    samples = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        await sender.write_message("chat " + json.dumps({"to": "player", "content": i}))
+        while json.loads(await receiver.read_message())["msg"].get("am") != i:
+            pass
+        samples.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+
+    stop.set()
+    for connection in (owner, spammer, sender, receiver):
+        connection.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    server.stop()
+
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--log", type=int, default=5000, help="broadcasts in the noisy room")
+    parser.add_argument("--messages", type=int, default=200, help="chats measured in the quiet room")
+    args = parser.parse_args()
+
+    print(f"{'limits':>8} {'p50':>10} {'p99':>10}")
+    for name, rate_limits in (("none", None), ("default", RateLimits(50, 256 * 1024, 2))):
+        p50, p99 = asyncio.run(measure(rate_limits, args))
+        print(f"{name:>8} {p50 * 1e3:>7.2f} ms {p99 * 1e3:>7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
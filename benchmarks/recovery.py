@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Measures how long Hotaru takes to get its rooms back after a restart.
+Fills a journal with --messages chat messages spread over --rooms rooms, then
+recovers from it twice: once replaying the journal, which also takes a snapshot,
+and once more from that snapshot.
+Players acknowledge every --ack-every messages, like real clients do, so the
+rooms don't keep everything. With --ack-every 0 nothing is ever freed.
+Run from the repository root: python benchmarks/recovery.py --messages 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru.journal import Journal
+from hotaru.players import Player
+from hotaru.servers import ServerPool
+
+ACK_MARGIN = 32
+
+
+def fill(directory, args):
+    journal = Journal(directory)
+    os.makedirs(directory)
+    journal.file = open(journal.journal_path(0), "a")
+    pool = ServerPool(journal=journal)
+
+    rooms = []
+    for _ in range(args.rooms):
+        server = pool.create_server(-1)
+        players = []
+        for i in range(args.players):
+            player = Player(f"player{i}", None)
+            server.register(player)
+            journal.registered(server, player)
+            players.append(player)
+        rooms.append((server, players))
+
+    for i in range(args.messages):
+        # The rooms take turns, n is how many messages this room has had so far
+        server, players = rooms[i % len(rooms)]
+        n = i // len(rooms)
+        player = players[n % len(players)]
+        # Mostly to the owner, every tenth one to everyone
+        to = 2 if n % 10 == 0 else 1
+        content = {"n": i, "pad": "x" * args.size}
+        server.chat(player, to, content)
+        journal.chatted(server, player, to, content)
+
+        if args.ack_every and n % args.ack_every == 0:
+            for p in [server] + players:
+                server.acknowledge(p, p.next, ACK_MARGIN)
+                journal.acked(server, p, p.next)
+
+        if len(journal.buffer) >= 10000:
+            journal.write()
+
+    journal.close()
+    return journal
+
+
+def size_of(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+async def recover(directory):
+    journal = Journal(directory)
+    pool = ServerPool()
+    started = time.perf_counter()
+    journal.open(pool, ACK_MARGIN)
+    total = time.perf_counter() - started
+    journal.close()
+    return journal, total, pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=8, help="players per room")
+    parser.add_argument("--size", type=int, default=32, help="padding bytes per message")
+    parser.add_argument("--ack-every", type=int, default=100)
+    args = parser.parse_args()
+
+    directory = os.path.join(tempfile.mkdtemp(), "journal")
+    try:
+        started = time.perf_counter()
+        journal = fill(directory, args)
+        print(f"journal: {journal.records} records, {size_of(directory) / 2 ** 20:.1f} MiB, "
+              f"written in {time.perf_counter() - started:.1f} s")
+
+        journal, total, pool = asyncio.run(recover(directory))
+        print(f"replay: {journal.recovered} rooms in {journal.recovery_time:.2f} s "
+              f"({args.messages / journal.recovery_time:.0f} messages/s), "
+              f"{total:.2f} s with the snapshot")
+        print(f"snapshot: {size_of(directory) / 2 ** 20:.1f} MiB")
+        del pool
+
+        journal, total, pool = asyncio.run(recover(directory))
+        print(f"from the snapshot: {journal.recovered} rooms in {journal.recovery_time:.2f} s")
+        # Linux reports this in kilobytes
+        print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    finally:
+        shutil.rmtree(os.path.dirname(directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes to generate a short "repeat" at the end of a long log.
+Run from the repository root: python benchmarks/repeat.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hotaru import messages
+from hotaru.servers import Server
+from hotaru.players import Player
+
+
+class NullClient:
+    def write_inbound(self, q, message):
+        pass
+
+
+def join(server, name):
+    player = Player(name, NullClient())
+    server.add_user(player)
+    player.subscribe(server.messages_public, messages.Su(player.su))
+    return player
+
+
+# Half of the log is broadcast before the player joins, the rest is a mix
+# of broadcasts, direct messages and shadows of what the player sent
+def make_player(entries):
+    server = Server("BNCH", -1)
+    join(server, "other")
+
+    for i in range(entries // 2):
+        server.sends_message(server.players, messages.RawMessage(server, i))
+
+    player = join(server, "player")
+    for i in range(entries // 2):
+        if i % 4 == 0:
+            player.sends_message(server, messages.RawMessage(player, i))
+        elif i % 4 == 1:
+            server.sends_message(player, messages.RawMessage(server, i))
+        else:
+            server.sends_message(server.players, messages.RawMessage(server, i))
+    return player
+
+
+# The old way of generating a repeat: walk the whole log from the very beginning
+def linear_repeat(log, expected_next):
+    looped_real_messages = 0
+    caret = 0
+    for ms in log:
+        if looped_real_messages == expected_next:
+            break
+        if not ms["type"] == "shadow":
+            looped_real_messages += 1
+        caret += 1
+    return log[caret:]
+
+
+def main():
+    print(f"{'entries':>8} {'resume from':>12} {'linear':>12} {'indexed':>12}")
+    for entries in (1000, 100000, 1000000):
+        player = make_player(entries)
+        log = player.generate_repeat(0)
+
+        for expected_next in (1, player.next // 3, player.next // 2 + 1, player.next - 10):
+            assert linear_repeat(log, expected_next) == player.generate_repeat(expected_next)
+
+        expected_next = player.next - 10
+        rounds = 5
+        t_linear = timeit.timeit(
+            lambda: linear_repeat(log, expected_next), number=rounds) / rounds
+        rounds = 10000
+        t_indexed = timeit.timeit(
+            lambda: player.generate_repeat(expected_next), number=rounds) / rounds
+
+        print(f"{entries:>8} {expected_next:>12} {t_linear * 1e6:>9.1f} us {t_indexed * 1e6:>9.1f} us")
+
+
+if __name__ == "__main__":
+    main()
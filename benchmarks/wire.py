@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compares the v0 (text and JSON) and v1 (MessagePack) wire protocols:
+bytes on the wire and time spent encoding and decoding typical frames.
+Run from the repository root: python benchmarks/wire.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import msgpack
+
+from hotaru import messages
+from hotaru.players import Player
+from hotaru.protocols import PROTOCOLS
+
+CONTENT = {
+    "question": "Which of these is not a fruit?",
+    "answers": ["Apple", "Tomato", "Carrot", "Banana"],
+    "scores": {"alice": 1200, "bob": 950, "carol": 1010},
+    "time": 30
+}
+
+# The same commands, as a client would send them
+COMMANDS = {
+    "v0": {
+        "chat": 'chat {"to": 2, "content": {"answer": 3, "time": 12.5}}',
+        "repeat": "repeat 1500"
+    },
+    "v1": {
+        "chat": msgpack.packb([1, {"to": 2, "content": {"answer": 3, "time": 12.5}}]),
+        "repeat": msgpack.packb([3, 1500])
+    }
+}
+
+
+def fresh_message():
+    return messages.RawMessage(Player("alice", None), CONTENT)
+
+
+def main():
+    rounds = 100000
+    print(f"{'':>8} {'frame':>10} {'bytes':>7} {'encode':>10} {'decode':>10}")
+
+    for version in ("v0", "v1"):
+        protocol = PROTOCOLS[version]
+        decode = msgpack.unpackb if protocol.binary else json.loads
+
+        # First delivery of a message, its body still has to be serialized
+        frame = protocol.inbound(1500, fresh_message())
+        t_encode = timeit.timeit(
+            lambda: protocol.inbound(1500, fresh_message()), number=rounds) / rounds
+        t_decode = timeit.timeit(lambda: decode(frame), number=rounds) / rounds
+        print(f"{version:>8} {'inbound':>10} {len(frame):>7} {t_encode * 1e6:>7.2f} us {t_decode * 1e6:>7.2f} us")
+
+        # Every other recipient of the same message only gets a new q spliced in
+        message = fresh_message()
+        protocol.inbound(0, message)
+        t_encode = timeit.timeit(
+            lambda: protocol.inbound(1500, message), number=rounds) / rounds
+        print(f"{version:>8} {'fan-out':>10} {len(frame):>7} {t_encode * 1e6:>7.2f} us")
+
+        for command, frame in COMMANDS[version].items():
+            t_decode = timeit.timeit(lambda: protocol.parse(frame), number=rounds) / rounds
+            print(f"{version:>8} {command:>10} {len(frame):>7} {'':>10} {t_decode * 1e6:>7.2f} us")
+
+
+if __name__ == "__main__":
+    main()
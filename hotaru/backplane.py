@@ -0,0 +1,422 @@
+import abc
+import collections
+import datetime
+import functools
+import logging
+import uuid
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.util
+import tornado.websocket
+
+from hotaru import codec
+from hotaru.sessions import Session
+
+"""
+Delivery between Hotaru nodes. A room lives on a single node, but its players
+may connect to any of them: a node that doesn't have the room links the socket
+to whichever node does, and frames go back and forth over the backplane.
+Every node listens on "hotaru:room:<code>" for the rooms it hosts, and every
+linked socket on "hotaru:link:<id>" for what its room sends back.
+"""
+
+ROOM = "hotaru:room:"
+LINK = "hotaru:link:"
+
+# Longest a socket waits for its room to be found on another node, see Backplane.link
+LINK_TIMEOUT = datetime.timedelta(seconds=5)
+# Seconds between attempts to reach the broker again, doubling up to the last one
+RECONNECT_DELAY = 0.1
+RECONNECT_DELAY_MAX = 5
+
+
+# Envelopes are a line of JSON and the frame exactly as it came, so frames are
+# never parsed or re-encoded on the way
+def pack(header: dict, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return codec.compact(header).encode() + b"\n" + payload
+
+
+def unpack(data: bytes):
+    header, _, payload = data.partition(b"\n")
+    return codec.loads(header), payload
+
+
+class Backplane(abc.ABC):
+    """
+    Moves envelopes between nodes. Subclasses only provide the transport:
+    subscribe(), unsubscribe() and publish(), everything else is the same.
+    """
+
+    def __init__(self):
+        self.app = None
+        # Sockets of other nodes in the rooms hosted here, by room code and link id
+        self.sessions = {}
+
+    # The Hotaru application that hosts rooms on this node
+    def attach(self, app):
+        self.app = app
+
+    # Returns an awaitable that resolves once the subscription is in place
+    @abc.abstractmethod
+    def subscribe(self, channel: str, callback):
+        pass
+
+    @abc.abstractmethod
+    def unsubscribe(self, channel: str):
+        pass
+
+    # Returns an awaitable of how many subscribers got it, nobody waits for it
+    # but opening a link
+    @abc.abstractmethod
+    def publish(self, channel: str, data: bytes):
+        pass
+
+    # Resolves once other nodes can reach a room hosted here, see host()
+    def hosted(self, code: str):
+        return resolved(None)
+
+    # A room was created here, or closed
+    def host(self, server):
+        self.sessions[server.code] = {}
+        self.subscribe(ROOM + server.code,
+                       functools.partial(self.room_received, self.sessions[server.code]))
+
+    # Whatever the other nodes still had connected was closed along with the room
+    def unhost(self, code: str):
+        self.unsubscribe(ROOM + code)
+        self.sessions.pop(code, None)
+
+    # What a socket on another node does in a room hosted here
+    def room_received(self, sessions: dict, data: bytes):
+        header, payload = unpack(data)
+        link = header["link"]
+
+        if header["op"] == "open":
+            session = RemoteSession(self, link)
+            sessions[link] = session
+            session.join(**header["args"])
+
+        elif header["op"] == "frame":
+            session = sessions.get(link)
+            if session:
+                session.receive(payload if header["binary"] else payload.decode())
+
+        elif header["op"] == "close":
+            session = sessions.pop(link, None)
+            if session:
+                session.connected = False
+                session.left(header["code"])
+
+    # Links a socket connected here to its room on another node.
+    # Returns None if no node hosts the room, and raises tornado.util.TimeoutError
+    # if the other nodes can't be reached in time, like while the broker is down
+    async def link(self, handler, args: dict):
+        link = Link(self, handler, args["code"])
+        try:
+            await tornado.gen.with_timeout(LINK_TIMEOUT, self.subscribe(link.channel, link.received))
+            receivers = await tornado.gen.with_timeout(LINK_TIMEOUT, self.publish(
+                link.room, pack({"op": "open", "link": link.id, "args": args})))
+        except tornado.util.TimeoutError:
+            logging.error(f"Backplane couldn't reach room {args['code']} in time")
+            self.unsubscribe(link.channel)
+            raise
+
+        if not receivers:
+            self.unsubscribe(link.channel)
+            return None
+        return link
+
+
+class Link:
+    """
+    The node's end of a socket whose room is somewhere else.
+    """
+
+    def __init__(self, backplane: Backplane, handler, code: str):
+        self.backplane = backplane
+        self.handler = handler
+        self.id = uuid.uuid4().hex
+        self.room = ROOM + code
+        self.channel = LINK + self.id
+
+    # A frame from the client
+    def forward(self, frame):
+        self.backplane.publish(self.room, pack(
+            {"op": "frame", "link": self.id, "binary": not isinstance(frame, str)}, frame))
+
+    # The client went away
+    def closed(self, close_code):
+        self.backplane.publish(self.room, pack(
+            {"op": "close", "link": self.id, "code": close_code}))
+        self.backplane.unsubscribe(self.channel)
+
+    # Something from the room
+    def received(self, data: bytes):
+        header, payload = unpack(data)
+        if header["op"] == "frame":
+            binary = header["binary"]
+            try:
+                self.handler.write_message(payload if binary else payload.decode(), binary)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+        elif header["op"] == "close":
+            self.handler.close(code=header["code"])
+
+
+class RemoteSession(Session):
+    """
+    A socket on another node, as the room on this node sees it.
+    Frames are written to its link instead of a connection.
+    """
+
+    def __init__(self, backplane: Backplane, link: str):
+        self.backplane = backplane
+        self.application = backplane.app
+        self.metrics = backplane.app.metrics
+        self.channel = LINK + link
+        # Until we or the other node close it
+        self.connected = True
+        # Frames that came in while an earlier one was still being handled, like one
+        # delayed by the rate limits. A local socket isn't read from in the meantime,
+        # these wait here instead so they're still handled in order
+        self.queued = None
+
+    def receive(self, frame):
+        if self.queued is not None:
+            self.queued.append(frame)
+            return
+        waiting = self.handle(frame)
+        if waiting:
+            self.queued = collections.deque()
+            tornado.ioloop.IOLoop.current().spawn_callback(self.catch_up, waiting)
+
+    async def catch_up(self, waiting):
+        try:
+            await waiting
+            while self.queued and self.connected:
+                waiting = self.handle(self.queued.popleft())
+                if waiting:
+                    await waiting
+        finally:
+            self.queued = None
+
+    def write_message(self, message, binary=False):
+        if self.batch is not None and self.batched:
+            self.flush_batch()
+        binary = binary or self.protocol.binary
+        self.backplane.publish(self.channel, pack({"op": "frame", "binary": binary}, message))
+
+    # The other node closes the socket and sends back a "close" with the code,
+    # which is when the room hears about it, same as with a local socket
+    def close(self, code=None, reason=None):
+        if not self.connected:
+            return
+        self.connected = False
+        self.metrics.closed(code)
+        self.backplane.publish(self.channel, pack({"op": "close", "code": code}))
+
+
+class LocalBackplane(Backplane):
+    """
+    Every node in this process, which is all of them unless there's a broker.
+    Envelopes are handed to the subscriber right away. Nodes that should see
+    each other share their channels.
+    """
+
+    def __init__(self, channels=None):
+        super().__init__()
+        self.channels = {} if channels is None else channels
+
+    def subscribe(self, channel: str, callback):
+        self.channels[channel] = callback
+        return resolved(None)
+
+    def unsubscribe(self, channel: str):
+        self.channels.pop(channel, None)
+
+    def publish(self, channel: str, data: bytes):
+        callback = self.channels.get(channel)
+        if callback:
+            callback(data)
+        return resolved(1 if callback else 0)
+
+
+def resolved(value):
+    future = tornado.concurrent.Future()
+    future.set_result(value)
+    return future
+
+
+# Commands as the broker expects them, an array of bulk strings
+def command(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(stream: tornado.iostream.IOStream):
+    line = await stream.read_until(b"\r\n")
+    kind, value = line[:1], line[1:-2]
+
+    if kind == b"*":
+        return [await read_reply(stream) for _ in range(int(value))]
+    if kind == b"$":
+        if int(value) < 0:
+            return None
+        return (await stream.read_bytes(int(value) + 2))[:-2]
+    if kind == b":":
+        return int(value)
+    if kind == b"-":
+        raise BrokerError(value.decode())
+    return value
+
+
+class BrokerError(Exception):
+    """
+    The broker answered a command with an error
+    """
+
+
+class BrokerBackplane(Backplane):
+    """
+    Nodes in any number of processes and machines, connected through a broker
+    that speaks the Redis protocol. Only PUBLISH, SUBSCRIBE and UNSUBSCRIBE are
+    used, broker.py is a stand-in for testing and benchmarks.
+    A subscribed connection can't publish, so there are two of them.
+    If either one is lost, both are opened again and every channel is subscribed
+    again. What was published in the meantime is lost.
+    """
+
+    def __init__(self, address="127.0.0.1", port=6379):
+        super().__init__()
+        self.address = address
+        self.port = port
+        self.publisher = None
+        self.subscriber = None
+        self.channels = {}
+
+        # Futures of the commands sent on each connection, replies come back in order
+        self.published = collections.deque()
+        self.subscribed = {}
+
+        # Whether both connections are up, see lost()
+        self.connected = False
+
+    async def connect(self):
+        client = tornado.tcpclient.TCPClient()
+        publisher = await client.connect(self.address, self.port)
+        try:
+            subscriber = await client.connect(self.address, self.port)
+        except Exception:
+            publisher.close()
+            raise
+        publisher.set_nodelay(True)
+        subscriber.set_nodelay(True)
+        self.publisher, self.subscriber = publisher, subscriber
+        self.connected = True
+
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read_published, publisher)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read_subscribed, subscriber)
+        logging.info(f"Backplane connected to the broker at {self.address}:{self.port}")
+
+    # Either connection was closed. Whatever waits for a PUBLISH gets 0 receivers,
+    # and both connections are opened again
+    def lost(self, stream=None):
+        if not self.connected or stream not in (None, self.publisher, self.subscriber):
+            return
+        logging.error("Backplane lost its connection to the broker")
+        self.connected = False
+        self.publisher.close()
+        self.subscriber.close()
+
+        published, self.published = self.published, collections.deque()
+        for future in published:
+            if not future.done():
+                future.set_result(0)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.reconnect)
+
+    async def reconnect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            await tornado.gen.sleep(delay)
+            try:
+                await self.connect()
+                break
+            except OSError as e:
+                logging.warning(f"Backplane couldn't reach the broker at {self.address}:{self.port}: {e}")
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+        # Subscriptions made in the meantime are only sent now, hosted() waits for them
+        for channel in self.channels:
+            self.subscribed.setdefault(channel, tornado.concurrent.Future())
+            self.send(self.subscriber, command("SUBSCRIBE", channel))
+
+    # Commands written while the broker is out of reach are dropped,
+    # SUBSCRIBE is sent again once it's back, see reconnect()
+    def send(self, stream, data: bytes):
+        if not self.connected:
+            return
+        try:
+            stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            self.lost()
+
+    def subscribe(self, channel: str, callback):
+        self.channels[channel] = callback
+        future = self.subscribed[channel] = tornado.concurrent.Future()
+        self.send(self.subscriber, command("SUBSCRIBE", channel))
+        return future
+
+    # Until the broker confirms the subscription, other nodes' "open" envelopes go nowhere
+    def hosted(self, code: str):
+        return self.subscribed.get(ROOM + code) or resolved(None)
+
+    def unsubscribe(self, channel: str):
+        if self.channels.pop(channel, None):
+            self.send(self.subscriber, command("UNSUBSCRIBE", channel))
+
+    def publish(self, channel: str, data: bytes):
+        if not self.connected:
+            return resolved(0)
+        future = tornado.concurrent.Future()
+        self.published.append(future)
+        self.send(self.publisher, command("PUBLISH", channel, data))
+        return future
+
+    async def read_published(self, stream: tornado.iostream.IOStream):
+        try:
+            while True:
+                receivers = await read_reply(stream)
+                self.published.popleft().set_result(receivers)
+        except tornado.iostream.StreamClosedError:
+            self.lost(stream)
+
+    async def read_subscribed(self, stream: tornado.iostream.IOStream):
+        try:
+            while True:
+                kind, channel, data = await read_reply(stream)
+                channel = channel.decode()
+
+                if kind == b"message":
+                    callback = self.channels.get(channel)
+                    if callback:
+                        try:
+                            callback(data)
+                        except Exception as e:
+                            logging.error(f"Backplane failed to handle a message on {channel}: {e}")
+
+                elif kind == b"subscribe":
+                    future = self.subscribed.pop(channel, None)
+                    if future and not future.done():
+                        future.set_result(None)
+        except tornado.iostream.StreamClosedError:
+            self.lost(stream)
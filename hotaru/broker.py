@@ -0,0 +1,97 @@
+import argparse
+import logging
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+from hotaru.backplane import command, read_reply
+
+"""
+A stand-in for the broker of backplane.BrokerBackplane, for tests and benchmarks.
+It only knows the part of the Redis protocol that Hotaru uses: PUBLISH,
+SUBSCRIBE, UNSUBSCRIBE and PING. Nothing is stored or sent anywhere else,
+so a real broker is the way to go in production.
+Run from the repository root: python -m hotaru.broker --port 6379
+"""
+
+
+class Broker(tornado.tcpserver.TCPServer):
+    """
+    Channels and the connections subscribed to them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.channels = {}
+
+    async def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        subscribed = set()
+        try:
+            while True:
+                args = await read_reply(stream)
+                name = args[0].upper()
+
+                if name == b"PUBLISH":
+                    channel, data = args[1].decode(), args[2]
+                    receivers = self.channels.get(channel, ())
+                    message = command("message", channel, data)
+                    for receiver in receivers:
+                        receiver.write(message)
+                    stream.write(b":%d\r\n" % len(receivers))
+
+                elif name == b"SUBSCRIBE":
+                    for channel in args[1:]:
+                        channel = channel.decode()
+                        self.channels.setdefault(channel, set()).add(stream)
+                        subscribed.add(channel)
+                        stream.write(reply("subscribe", channel, len(subscribed)))
+
+                elif name == b"UNSUBSCRIBE":
+                    for channel in args[1:] or list(subscribed):
+                        channel = channel if isinstance(channel, str) else channel.decode()
+                        self.leave(channel, stream)
+                        subscribed.discard(channel)
+                        stream.write(reply("unsubscribe", channel, len(subscribed)))
+
+                elif name == b"PING":
+                    stream.write(b"+PONG\r\n")
+
+                else:
+                    stream.write(b"-ERR unknown command\r\n")
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            for channel in subscribed:
+                self.leave(channel, stream)
+
+    def leave(self, channel: str, stream):
+        receivers = self.channels.get(channel)
+        if receivers:
+            receivers.discard(stream)
+            if not receivers:
+                self.channels.pop(channel)
+
+
+# Confirmations of (un)subscribing end with the number of channels left
+def reply(kind: str, channel: str, count: int):
+    kind, channel = kind.encode(), channel.encode()
+    return b"*3\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n:%d\r\n" % (
+        len(kind), kind, len(channel), channel, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in broker for the Hotaru backplane")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--address", default="127.0.0.1")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(name)s/%(levelname)s: %(message)s', level="INFO")
+    Broker().listen(args.port, args.address)
+    logging.info(f"Broker listening on {args.address}:{args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
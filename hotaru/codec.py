@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+Everything Hotaru turns into JSON or reads from it goes through here.
+orjson is used when it's installed, the json module otherwise.
+HOTARU_CODEC=json in the environment sticks to the json module either way.
+
+Frames sent to clients are always written by the json module, so v0 stays byte
+for byte what it always was: orjson leaves out the spaces after commas and colons,
+and it can't escape what isn't ASCII. orjson writes what only Hotaru reads back,
+like the journal and backplane headers, and parses everything.
+"""
+
+# orjson reads integers past 64 bits as floats, so JSON with a run of this many
+# digits is left to the json module. The runs are found with a translation table
+# that turns digits into "0" and everything else into a space, a regex is slower
+LONG_NUMBER = b"0" * 19
+DIGITS = bytes(48 if 48 <= i <= 57 else 32 for i in range(256))
+
+
+class JsonCodec:
+    """
+    The json module from the standard library.
+    """
+
+    name = "json"
+
+    # Frames for clients, see above
+    def dumps(self, obj, ensure_ascii=True):
+        return json.dumps(obj, ensure_ascii=ensure_ascii)
+
+    # Without any spaces, for what's only read back by Hotaru itself
+    def compact(self, obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson, several times faster than the json module. What it can't handle,
+    like integers over 64 bits, is left to the json module.
+    """
+
+    name = "orjson"
+
+    def compact(self, obj):
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            return super().compact(obj)
+
+    def loads(self, data):
+        digits = (data.encode() if isinstance(data, str) else data).translate(DIGITS)
+        if LONG_NUMBER in digits:
+            return json.loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            if not json_only(e):
+                raise
+            return json.loads(data)
+
+
+# Whether the json module reads what orjson just turned down: NaN and Infinity,
+# numbers too large for a double and strings with unpaired surrogates.
+# Anything else isn't JSON for either of them, and isn't parsed again
+def json_only(error):
+    if "surrogate" in error.msg or "infinity" in error.msg:
+        return True
+    rest = error.doc[error.pos:error.pos + 8]
+    if isinstance(rest, bytes):
+        rest = rest.decode("latin-1")
+    return rest.startswith(("NaN", "Infinity"))
+
+
+def pick(name=None):
+    if name == "json" or orjson is None:
+        if name == "orjson":
+            logging.warning("HOTARU_CODEC asks for orjson, but it isn't installed")
+        return JsonCodec()
+    return OrjsonCodec()
+
+
+CODEC = pick(os.environ.get("HOTARU_CODEC"))
+
+dumps = CODEC.dumps
+compact = CODEC.compact
+loads = CODEC.loads
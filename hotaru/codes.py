@@ -0,0 +1,130 @@
+import random
+import string
+
+"""
+Allocation of the four-letter room codes.
+"""
+
+CODE_LENGTH = 4
+SPACE = len(string.ascii_uppercase) ** CODE_LENGTH
+
+# Prefixes are chosen by clients, they're kept short and URL-safe
+PREFIX_LIMIT = 16
+PREFIX_CHARACTERS = set(string.ascii_letters + string.digits + "-_")
+# Rounds of the permutation in CodeAllocator, 4 are enough to look random
+FEISTEL_ROUNDS = 4
+
+
+# Which of `shards` worker processes owns a room, see workers.py.
+# None if the code can't be a room code at all
+def shard_of(code: str, shards: int):
+    letters = code[-CODE_LENGTH:]
+    if len(letters) != CODE_LENGTH or not all(l in string.ascii_uppercase for l in letters):
+        return None
+    return code_to_index(letters) % shards
+
+
+def valid_prefix(prefix: str):
+    return len(prefix) <= PREFIX_LIMIT and all(c in PREFIX_CHARACTERS for c in prefix)
+
+
+def code_to_index(code: str):
+    index = 0
+    for letter in code:
+        index = index * 26 + string.ascii_uppercase.index(letter)
+    return index
+
+
+def index_to_code(index: int):
+    letters = []
+    for _ in range(CODE_LENGTH):
+        index, letter = divmod(index, 26)
+        letters.append(string.ascii_uppercase[letter])
+    return "".join(reversed(letters))
+
+
+class CodeAllocator:
+    """
+    Hands out the codes of a single prefix in random order, without ever building
+    the list of all of them: prefixes come from clients, so there can be many.
+    A cursor walks through a permutation of the prefix's codes, keyed at random,
+    see permute(). Released codes the cursor already went past are kept in a list
+    and handed out again first. Only the codes in use and the released ones take
+    up memory, allocating and releasing are O(1) no matter how full the prefix is.
+    With several worker processes, each one only hands out the codes of its own shard.
+    """
+
+    def __init__(self, shard=0, shards=1):
+        self.shard = shard
+        self.shards = shards
+        # Codes of this shard are shard, shard + shards, shard + 2 * shards...
+        self.size = len(range(shard, SPACE, shards))
+
+        # The permutation works on numbers of 2 * half bits, codes past the end
+        # are walked over, see permute()
+        self.half = 1
+        while 1 << (2 * self.half) < self.size:
+            self.half += 1
+        self.mask = (1 << self.half) - 1
+        self.keys = [random.getrandbits(32) for _ in range(FEISTEL_ROUNDS)]
+
+        self.cursor = 0
+        self.freed = []
+        self.taken = set()
+
+    def __len__(self):
+        return len(self.taken)
+
+    # A Feistel network is a permutation of 2 * half bit numbers whatever the round function is,
+    # applying it again to what falls outside the shard (cycle walking) makes it one of the shard
+    def permute(self, position: int):
+        while True:
+            left, right = position >> self.half, position & self.mask
+            for key in self.keys:
+                left, right = right, left ^ (hash((key, right)) & self.mask)
+            position = (left << self.half) | right
+            if position < self.size:
+                return position
+
+    def unpermute(self, index: int):
+        while True:
+            left, right = index >> self.half, index & self.mask
+            for key in reversed(self.keys):
+                left, right = right ^ (hash((key, left)) & self.mask), left
+            index = (left << self.half) | right
+            if index < self.size:
+                return index
+
+    # Returns None when every code of this prefix is taken
+    def allocate(self):
+        if self.freed:
+            i = random.randrange(len(self.freed))
+            index = self.freed[i]
+            self.freed[i] = self.freed[-1]
+            self.freed.pop()
+        else:
+            # Codes restored by reserve() are skipped when the cursor gets to them
+            while True:
+                if self.cursor == self.size:
+                    return None
+                index = self.permute(self.cursor)
+                self.cursor += 1
+                if index not in self.taken:
+                    break
+
+        self.taken.add(index)
+        return index_to_code(self.shard + index * self.shards)
+
+    # Takes specific codes out of the free ones, for rooms that come back after a restart
+    def reserve(self, codes):
+        for code in codes:
+            self.taken.add((code_to_index(code) - self.shard) // self.shards)
+        if self.freed:
+            self.freed = [index for index in self.freed if index not in self.taken]
+
+    def release(self, code: str):
+        index = (code_to_index(code) - self.shard) // self.shards
+        self.taken.discard(index)
+        # Codes the cursor hasn't got to yet are handed out when it does
+        if self.unpermute(index) < self.cursor:
+            self.freed.append(index)
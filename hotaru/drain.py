@@ -0,0 +1,101 @@
+import logging
+import time
+
+import tornado.gen
+
+from hotaru import exceptions
+
+"""
+Shutting down without cutting games off in the middle, for instance on a deploy.
+"""
+
+# Connections closed before the IOLoop gets a turn again
+CLOSE_CHUNK = 500
+# Longest the rooms get to hear about the connections dropped at the deadline,
+# once those are closed
+LEFT_TIMEOUT = 1.0
+
+
+class Drain:
+    """
+    Stops new rooms from being created, lets what was already sent go out,
+    then closes every connection at once with exceptions.ServerClosing().
+    All of it has to fit within `timeout` seconds, connections that haven't
+    finished their close handshake by then are dropped.
+    Rooms themselves aren't closed, with a journal they're back after the restart.
+    """
+
+    def __init__(self, app, timeout: float):
+        self.app = app
+        self.timeout = timeout
+
+        self.started = time.monotonic()
+        # None until it's done
+        self.duration = None
+        # Open connections when it started
+        self.connections = 0
+        # Bytes that still hadn't been flushed when the connections were closed
+        self.unflushed = 0
+        # Connections that were still open at the deadline
+        self.leftover = 0
+
+    async def run(self):
+        app = self.app
+        deadline = self.started + self.timeout
+        logging.info(f"Draining, {len(app.sockets)} connections have {self.timeout} s to go")
+
+        # Nothing is closed by anyone else from now on
+        if app.reaper:
+            app.reaper.stop()
+        if app.keepalive:
+            app.keepalive.stop()
+
+        sockets = list(app.sockets)
+        self.connections = len(sockets)
+
+        # What was already sent goes out first, for up to half of the time
+        flushing = self.started + self.timeout / 2
+        while time.monotonic() < flushing and any(
+                s.outbound.pending or (s.batch is not None and s.batched) for s in sockets):
+            await tornado.gen.sleep(0.01)
+        self.unflushed = sum(s.outbound.pending for s in sockets)
+
+        # Tornado lets go of the stream of a connection once it's closed,
+        # those that don't finish their close handshake are dropped through these
+        streams = {s: s.ws_connection.stream for s in sockets if s.ws_connection}
+
+        # Every connection at once, the close handshakes run alongside each other.
+        # Players of our rooms connected to other nodes hear about it through the backplane
+        local = set(sockets)
+        remote = [p.client for server in list(app.pool.pool.values())
+                  for p in [server] + server.players.list()
+                  if p.online and p.client not in local]
+        for i, session in enumerate(sockets + remote):
+            if i and i % CLOSE_CHUNK == 0:
+                await tornado.gen.sleep(0)
+            if session.connected:
+                session.close(exceptions.ServerClosing())
+
+        while app.sockets and time.monotonic() < deadline:
+            await tornado.gen.sleep(0.05)
+
+        # Whoever didn't answer in time is dropped, like in keepalive.py
+        self.leftover = len(app.sockets)
+        for handler in list(app.sockets):
+            stream = streams.get(handler)
+            if stream:
+                handler.timed_out = True
+                stream.close()
+
+        # Tornado runs their on_connection_close on a later turn of the IOLoop,
+        # the journal is only closed once their rooms wrote down that they left
+        left = time.monotonic() + LEFT_TIMEOUT
+        while app.sockets and time.monotonic() < left:
+            await tornado.gen.sleep(0.01)
+
+        if app.journal:
+            app.journal.close()
+
+        self.duration = time.monotonic() - self.started
+        logging.info(f"Drained {self.connections} connections in {self.duration:.2f} s, "
+                     f"{self.unflushed} bytes unflushed, {self.leftover} dropped at the deadline")
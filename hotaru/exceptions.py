@@ -46,11 +46,28 @@ def RoomLimitReached():
     return 4000 + 7
 
 
+def SlowConsumer():  # The client doesn't read what it's sent fast enough
+    logging.debug(f"exception: SlowConsumer")
+    return 4000 + 8
+
+
+def RateLimited():  # The client sends more than the rate limits allow, see ratelimit.py
+    logging.debug(f"exception: RateLimited")
+    return 4000 + 9
+
+
 def Overridden():
     logging.debug(f"exception: Overridden")
     return 4000 + 10
 
 
+# Never sent, the other end is gone already. It's what the connections dropped by
+# keepalive.py leave with, clients that close without a code leave with None
+def StoppedAnswering():
+    logging.debug(f"exception: StoppedAnswering")
+    return 1006
+
+
 def BreakingApiChange():
     logging.debug(f"exception: BreakingApiChange")
     return 4000 + 19
@@ -59,3 +76,17 @@ def BreakingApiChange():
 def ServerClosing():
     logging.debug(f"exception: ServerClosing")
     return 4000 + 20
+
+
+class InvalidPayload(Exception):
+    """
+    Raised when a v1 frame carries something JSON can't hold, like binary data.
+    Everything a room keeps has to be sendable to v0 clients too
+    """
+
+
+class LogTrimmed(Exception):
+    """
+    Raised when a repeat asks for messages that were already acknowledged and freed.
+    The argument is the first q that can still be repeated
+    """
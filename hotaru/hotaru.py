@@ -1,28 +1,110 @@
-import tornado.escape
+import tornado.gen
 import tornado.template
+import tornado.util
 import tornado.web
 import tornado.websocket
 
-from hotaru import messages
+from hotaru import codec
+from hotaru import codes
 from hotaru import exceptions
+from hotaru import outbound
+from hotaru.backplane import LocalBackplane
+from hotaru.drain import Drain
+from hotaru.keepalive import Keepalive
+from hotaru.metrics import Metrics
+from hotaru.reaper import Reaper
 from hotaru.servers import ServerPool
-from hotaru.players import Player
+from hotaru.sessions import Session
 
+import datetime
 import logging
-import json
+import time
 
 HT_VERSION = "v0"
 
+# Rooms per inspector page by default and at most, and how many rooms a single
+# request may look at while filtering, see ServerPool.page
+INSPECT_PAGE_SIZE = 50
+INSPECT_PAGE_LIMIT = 500
+INSPECT_SCAN_BUDGET = 5000
+
+# Most rooms createServers and closeServers take in a single request, and how many
+# of them are handled before live traffic gets its turn on the IOLoop again
+BULK_LIMIT = 1000
+BULK_CHUNK = 50
+
+# How long createServer waits for the backplane to reach a new room, see HotaruCommands.hosted
+HOST_TIMEOUT = 5
+
 
 class Hotaru(tornado.web.Application):
     """
     Main object for the Tornado server.
     """
 
-    def __init__(self, do_inspect):
-        self.pool = ServerPool()
+    def __init__(self, do_inspect, do_metrics=True, ack_margin=32, high_water=1 << 20,
+                 slow_consumer_policy=outbound.DROP, block_timeout=5,
+                 compress=True, compression_level=6, compression_mem_level=8,
+                 compression_min_size=0, room_ttl=None, shard=0, shards=1,
+                 backplane=None, journal=None, ping_interval=None, ping_timeout=None,
+                 rate_limits=None, repeat_chunk=1000):
+        # Sockets connected to this node can join rooms hosted by another one through
+        # the backplane, see backplane.py. Without a broker, nodes only see themselves
+        self.backplane = backplane or LocalBackplane()
+        self.backplane.attach(self)
+
+        # With several worker processes, this one only creates rooms of its own shard
+        self.pool = ServerPool(shard, shards, self.backplane, journal)
+        self.ack_margin = ack_margin
+        self.backpressure = outbound.Backpressure(
+            high_water, slow_consumer_policy, block_timeout)
+        # What clients may send per connection and per room, None for no limits, see ratelimit.py
+        self.rate_limits = rate_limits
+        # Repeats of more messages than this are encoded this many at a time,
+        # with the IOLoop getting to everything else in between, see sessions.py
+        self.repeat_chunk = repeat_chunk
+        # Always counted, do_metrics only decides whether /metrics is served
+        self.metrics = Metrics()
+
+        # permessage-deflate settings, None turns compression off everywhere.
+        # Frames shorter than compression_min_size are never compressed. It's 0 by default,
+        # skipping small frames costs most of what deflate saves, see benchmarks/compression.py
+        self.compression = None
+        if compress:
+            self.compression = {
+                "compression_level": compression_level,
+                "mem_level": compression_mem_level
+            }
+        self.compression_min_size = compression_min_size
+
+        # Rooms without any connections or traffic for room_ttl seconds get closed
+        self.reaper = None
+        if room_ttl:
+            self.reaper = Reaper(self.pool, room_ttl)
+            self.reaper.start()
+
+        # Every WebSocket gets pinged every ping_interval seconds, which also keeps proxies
+        # like Heroku's from dropping idle connections. Those that don't answer within
+        # ping_timeout are dropped, and the owner hears about it, see keepalive.py
+        self.keepalive = None
+        if ping_interval:
+            self.keepalive = Keepalive(ping_interval, ping_timeout or ping_interval)
+            self.keepalive.start()
+
+        # Rooms from before a restart come back from the journal, see journal.py
+        self.journal = journal
+        if journal:
+            for server in journal.open(self.pool, ack_margin):
+                if self.reaper:
+                    self.reaper.watch(server)
         self.html = tornado.template.Loader("./html")
 
+        # Every WebSocket of this process, and the drain once shutdown() was called
+        self.sockets = set()
+        self.drain = None
+        # With several worker processes, the workers.Router that hands connections around
+        self.router = None
+
         handlers = [
             ("/ws/(.*)", HotaruWebsocket),
             ("/hotaru/(.*)",   HotaruCommands)
@@ -33,11 +115,24 @@ class Hotaru(tornado.web.Application):
                 ("/inspect(.*)", HotaruInspector)
             )
 
+        if do_metrics:
+            handlers.append(
+                ("/metrics", HotaruMetrics)
+            )
+
         handlers.append(
             ("/(.*)", HotaruLanding)
         )
         super().__init__(handlers)
 
+    # Shuts down gracefully within timeout seconds, see drain.py.
+    # New rooms and connections are turned away from the moment it's called
+    async def shutdown(self, timeout: float):
+        if self.drain:
+            return
+        self.drain = Drain(self, timeout)
+        await self.drain.run()
+
 ###          ###
 ### HANDLERS ###
 ###          ###
@@ -68,18 +163,108 @@ class HotaruInspector(tornado.web.RequestHandler):
         cmd = cmd.split("/")[1:]
 
         if cmd[0] == "":
-            s = list(self.application.pool.pool.values())
+            servers, cursor = self.application.pool.page(
+                self.get_argument("cursor", ""), limit=INSPECT_PAGE_SIZE)
             self.write(self.application.html.load(
-                "home.html").generate(a="x", servers=s))
+                "home.html").generate(a="x", servers=servers, cursor=cursor,
+                                      backpressure=self.application.backpressure,
+                                      reaper=self.application.reaper,
+                                      journal=self.application.journal,
+                                      keepalive=self.application.keepalive,
+                                      rate_limits=self.application.rate_limits,
+                                      drain=self.application.drain))
+
+        # JSON list of rooms, a page at a time. Follow "cursor" until it's null
+        elif cmd[0] == "rooms":
+            self.list_rooms()
 
         else:
             serv = self.application.pool.get_server_safe(cmd[0])
             if serv:
-                pass  # TODO
+                self.write(self.describe_room(serv))
             else:
                 self.set_status(404)
                 self.write("Not found")
 
+    def list_rooms(self):
+        try:
+            limit = min(max(int(self.get_argument("limit", INSPECT_PAGE_SIZE)), 1),
+                        INSPECT_PAGE_LIMIT)
+            min_players = int(self.get_argument("min_players", 0))
+        except ValueError:
+            self.set_status(400)
+            self.write({
+                "error": "limit and min_players have to be numbers"
+            })
+            return
+
+        locked = self.get_argument("locked", None)
+        if locked is not None:
+            locked = locked not in ("0", "false")
+
+        def match(server):
+            if server.players.count() < min_players:
+                return False
+            return locked is None or server.lock == locked
+
+        servers, cursor = self.application.pool.page(
+            self.get_argument("cursor", ""), self.get_argument("prefix", ""),
+            limit, INSPECT_SCAN_BUDGET, match)
+
+        # Only what's cheap to read, the log sizes are in the per-room view
+        self.write({
+            "rooms": [{
+                "code": server.code,
+                "players": server.players.count(),
+                "limit": server.limit,
+                "locked": server.lock,
+                "connections": server.connections,
+                "idle": round(time.monotonic() - server.last_active, 1)
+            } for server in servers],
+            "cursor": cursor
+        })
+
+    def describe_room(self, server):
+        return {
+            "code": server.code,
+            "players": server.players.count(),
+            "limit": server.limit,
+            "locked": server.lock,
+            "compress": server.compress,
+            "connections": server.connections,
+            "idle": round(time.monotonic() - server.last_active, 1),
+            "owner": self.describe_player(server),
+            "player_list": [self.describe_player(p) for p in server.players.list()],
+            "groups": {name: list(group.players) for name, group in server.groups.items()},
+            "log": server.log_stats()
+        }
+
+    def describe_player(self, player):
+        client = player.client
+        # Sockets on other nodes are flow controlled over there
+        local = player.online and client.outbound
+        return {
+            "name": player.name,
+            "connected": player.online,
+            "since": round(time.monotonic() - player.since, 1),
+            "next": player.next,
+            "floor": player.floor,
+            "entries": len(player.messages),
+            "pending": client.outbound.pending if local else 0,
+            "throttled": client.outbound.throttled if local else False
+        }
+
+
+class HotaruMetrics(tornado.web.RequestHandler):
+    """
+    Object for the /metrics endpoint, scraped by Prometheus.
+    Like the inspector, it lacks authentication.
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.application.metrics.render(self.application.pool, self.application.drain))
+
 
 class HotaruCommands(tornado.web.RequestHandler):
     """
@@ -89,6 +274,8 @@ class HotaruCommands(tornado.web.RequestHandler):
 
     def prepare(self):
         logging.debug("Handling request HotaruCommands/" + self.path_args[0])
+        # Rooms created by this request, see hosted()
+        self.created = []
         if not self.path_args[0].startswith(HT_VERSION + "/"):
             self.set_status(400)
             self.write({
@@ -100,216 +287,340 @@ class HotaruCommands(tornado.web.RequestHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'POST, DELETE')
 
-    def post(self, cmd):
+    async def post(self, cmd):
         if self._status_code == 400:
             return
-        if cmd.endswith("createServer"):
-            limit = int(self.get_argument("limit", -1))
-            if limit < 0:
-                limit = -1
-
-            prefix = self.get_argument("prefix", "")
+        # Rooms made now would be closed again right away
+        if self.application.drain and (cmd.endswith("createServer") or cmd.endswith("createServers")):
+            self.set_status(503)
+            self.write({"error": "draining"})
+        elif cmd.endswith("createServer"):
+            room = self.create_room(self.get_argument("limit", -1),
+                                    self.get_argument("prefix", ""),
+                                    self.get_argument("compress", "1") != "0")
+            if "error" in room:
+                self.set_status(400 if room["error"] == "invalid prefix" else 503)
+            else:
+                self.set_status(201)
+            await self.hosted()
+            self.write(room)
+
+        # Many rooms at once: {"rooms": [{"limit": 8, "prefix": "", "compress": true}, ...]}
+        # Every room gets either "c" and "su", or an "error"
+        elif cmd.endswith("createServers"):
+            rooms = self.bulk_body()
+            if rooms is None:
+                return
+
+            created = []
+            for i, room in enumerate(rooms):
+                if i and i % BULK_CHUNK == 0:
+                    await tornado.gen.sleep(0)
+                try:
+                    created.append(self.create_room(room.get("limit", -1), room.get("prefix", ""),
+                                                    room.get("compress", True)))
+                except (AttributeError, ValueError, TypeError):
+                    created.append({"error": "invalid room"})
 
-            server = self.application.pool.create_server(limit, prefix)
-            game_code = server.code
-            su = server.su
-            logging.info(f"Created new Server: {game_code}")
             self.set_status(201)
-            self.write({
-                "c": game_code[-4:],
-                "su": su
-            })
+            await self.hosted()
+            self.write({"rooms": created})
         else:
             self.set_status(404)
 
-    def delete(self, cmd):
+    async def delete(self, cmd):
         if self._status_code == 400:
             return
         if cmd.endswith("closeServer"):
-            server = self.application.pool.get_server_safe(
-                self.get_argument("code"))
-            if server:
-                if server.su == self.get_argument("su"):
-                    server.close_server()
-                    logging.info(f"Closed server: {server.code}")
-                    self.application.pool.free(server.code)
-                    self.set_status(200)
-                else:
-                    self.set_status(401)
+            code, su = self.get_argument("code"), self.get_argument("su")
+            shard = self.elsewhere(code)
+            if shard is None:
+                self.set_status(self.close_room(code, su))
             else:
-                self.set_status(404)
+                # The code was in the body, the request line didn't say where the room is
+                response = await self.application.router.forward(
+                    shard, self.request.path, "DELETE", code=code, su=su)
+                self.set_status(response.code if response.code < 599 else 503)
+
+        # Many rooms at once: {"rooms": [{"code": "ABCD", "su": "..."}, ...]}
+        # Every room gets the status closeServer would have answered with
+        elif cmd.endswith("closeServers"):
+            rooms = self.bulk_body()
+            if rooms is None:
+                return
+
+            closed = [None] * len(rooms)
+            # Positions of the rooms of other workers, by worker
+            elsewhere = {}
+            for i, room in enumerate(rooms):
+                if i and i % BULK_CHUNK == 0:
+                    await tornado.gen.sleep(0)
+                try:
+                    shard = self.elsewhere(room["code"])
+                    if shard is None:
+                        closed[i] = {"code": room["code"],
+                                     "status": self.close_room(room["code"], room["su"])}
+                    else:
+                        elsewhere.setdefault(shard, []).append(i)
+                except (KeyError, TypeError):
+                    closed[i] = {"status": 400}
+
+            await tornado.gen.multi([self.close_elsewhere(shard, [rooms[i] for i in positions], positions, closed)
+                                     for shard, positions in elsewhere.items()])
+
+            self.set_status(200)
+            self.write({"rooms": closed})
+
+    # The list of rooms of a bulk request, None if it was turned away
+    def bulk_body(self):
+        try:
+            rooms = codec.loads(self.request.body)["rooms"]
+        except (ValueError, KeyError, TypeError):
+            rooms = None
+
+        if not isinstance(rooms, list):
+            self.set_status(400)
+            self.write({
+                "error": "expected {\"rooms\": [...]}"
+            })
+            return None
+
+        if len(rooms) > BULK_LIMIT:
+            self.set_status(413)
+            self.write({
+                "error": f"at most {BULK_LIMIT} rooms per request"
+            })
+            return None
+        return rooms
+
+    def create_room(self, limit, prefix: str, compress: bool):
+        limit = int(limit)
+        if limit < 0:
+            limit = -1
+
+        prefix = str(prefix)
+        if not codes.valid_prefix(prefix):
+            return {
+                "error": "invalid prefix"
+            }
+
+        server = self.application.pool.create_server(
+            limit, prefix, bool(compress))
+        if not server:
+            return {
+                "error": "capacity exhausted"
+            }
+
+        if self.application.reaper:
+            self.application.reaper.watch(server)
+        self.created.append(server.code)
+        game_code = server.code
+        su = server.su
+        logging.info(f"Created new Server: {game_code}")
+        return {
+            "c": game_code[-4:],
+            "su": su
+        }
+
+    # Clients of other nodes only find a new room once the backplane subscribed to it,
+    # so its code isn't handed out before. A broker that doesn't answer doesn't hold
+    # up createServer forever, the room then only works on this node for now
+    async def hosted(self):
+        backplane = self.application.backplane
+        try:
+            await tornado.gen.with_timeout(datetime.timedelta(seconds=HOST_TIMEOUT),
+                                           tornado.gen.multi([backplane.hosted(code) for code in self.created]))
+        except tornado.util.TimeoutError:
+            logging.error(f"Backplane didn't confirm {len(self.created)} new rooms in time")
+
+    # Worker that owns a room, None if it's this one or there's only one
+    def elsewhere(self, code):
+        if self.application.router is None:
+            return None
+        return self.application.router.owner(str(code))
+
+    # Closes rooms of another worker, their statuses go where the rooms were in the request
+    async def close_elsewhere(self, shard: int, rooms: list, positions: list, closed: list):
+        response = await self.application.router.forward(
+            shard, self.request.path, "DELETE", codec.compact({"rooms": rooms}))
+        if response.code == 200:
+            statuses = codec.loads(response.body)["rooms"]
+        else:
+            statuses = [{"code": room["code"], "status": 503} for room in rooms]
+        for i, status in zip(positions, statuses):
+            closed[i] = status
+
+    # Returns the HTTP status of closing a single room
+    def close_room(self, code: str, su: str):
+        server = self.application.pool.get_server_safe(code)
+        if not server:
+            return 404
+        if server.su != su:
+            return 401
+
+        server.close_server()
+        logging.info(f"Closed server: {server.code}")
+        self.application.pool.free(server.code)
+        return 200
 
 
-class HotaruWebsocket(tornado.websocket.WebSocketHandler):
+class HotaruWebsocket(Session, tornado.websocket.WebSocketHandler):
     """
     Main object for the WebSocket endpoint itself.
-    This is where actual communication happens.
+    This is where actual communication happens, see sessions.py for what it does in a room.
     """
 
-    def check_origin(self, origin):
-        # VERY UNSAFE. This should get a tweak as soon as possible!!!
-        return True
+    # Set when the room is on another node, frames then go through the backplane
+    link = None
 
-    def get_compression_options(self):
-        # Non-None enables compression with default options
-        return {}
+    # Set when keepalive.py dropped this connection for not answering pings
+    timed_out = False
 
-    def xtract_args(self):
-        code = self.get_argument("code")
-        server = self.application.pool.get_server_safe(code)
+    def initialize(self):
+        self.metrics = self.application.metrics
+        self.outbound = outbound.Outbound(
+            self.application.backpressure, self.metrics)
 
-        player_name = self.get_argument("name", None)
-        player = None
-        if server and player_name:
-            player = server.get_player_safe(player_name)
+    @property
+    def connected(self):
+        return bool(self.ws_connection and not self.ws_connection.is_closing())
 
-        su = self.get_argument("su", None)
-        if su and not player_name:
-            player = server
+    def check_origin(self, origin):
+        # VERY UNSAFE. This should get a tweak as soon as possible!!!
+        return True
 
-        return (server, player_name, player, su)
+    def get_compression_options(self):
+        # Non-None enables compression, rooms can opt out when they're created
+        server = self.application.pool.get_server_safe(
+            self.get_argument("code", None))
+        if server and not server.compress:
+            return None
+        return self.application.compression
 
     def open(self, client):
         logging.debug("Handling request HotaruWebsocket/" +
                       self.path_args[0])
-        if not self.path_args[0] == HT_VERSION:
-            self.close(code=exceptions.BreakingApiChange())
-
-        server, player_name, player, su = self.xtract_args()
-
-        # Check for errors in the connection and kick the client if necessary
-
-        if not server:
-            self.close(code=exceptions.ServerCodeDoesntExist())
+        self.application.sockets.add(self)
+        if self.application.drain:
+            self.close(exceptions.ServerClosing())
+            return None
+        if self.application.keepalive:
+            self.application.keepalive.add(self)
+        args = {
+            "version": self.path_args[0],
+            "code": self.get_argument("code"),
+            "player_name": self.get_argument("name", None),
+            "su": self.get_argument("su", None),
+            "batch": self.get_argument("batch", None)
+        }
+
+        # The room might be hosted by another node
+        if not self.application.pool.get_server_safe(args["code"]):
+            return self.open_link(args)
+        self.join(**args)
+
+    async def open_link(self, args):
+        try:
+            self.link = await self.application.backplane.link(self, args)
+        except tornado.util.TimeoutError:
+            # The other nodes can't be reached right now, like during a drain the client comes back later
+            self.close(exceptions.ServerClosing())
             return
-
-        registering = player_name and not su
-        logging_in = player_name and su
-        owner_connecting = su and not player_name
-
-        if registering:
-            if server.lock:
-                self.close(code=exceptions.ServerIsLocked())
-
-            elif server.players.count() == server.limit:
-                self.close(code=exceptions.RoomLimitReached())
-
-            elif player:
-                self.close(code=exceptions.NameIsTaken())
-
-            elif player_name == "":
-                self.close(code=exceptions.NamePropertyIsEmpty())
-
-            else:
-                p = Player(player_name, self)
-                server.add_user(p)
-                su_message = messages.Su(p.su)
-                p.write_message(su_message)
-
-                for pb in server.messages_public:
-                    p.messages.append(pb)
-                    p.next += 1
-
-                append = messages.UserAppend(p)
-                server.write_message(append)
-
-        elif logging_in:
-            if not player:
-                self.close(code=exceptions.NameDoesntExist())
-
-            elif player.su != su:
-                self.close(code=exceptions.SuCodeMismatch())
-
-            # The player name exists and the code is correct
-            elif player.su == su:
-                try:
-                    player.client.close(code=exceptions.Overridden())
-                except:
-                    pass
-                player.client = self
-
-                join = messages.UserJoin(player)
-                server.write_message(join)
-
-        elif owner_connecting:
-            if server.su != su:
-                self.close(code=exceptions.SuAdminCodeMismatch())
-
-            # The code checks out
-            else:
-                try:
-                    server.client.close(code=exceptions.Overridden())
-                except:
-                    pass
-                server.client = self
-
-    # We notify the server owner about the disconnection
-    def on_connection_close(self):
-        if self.close_code:
-            if self.close_code != 1000 and self.close_code < 4000:
-                server, player_name, player, su = self.xtract_args()
-                if server and player:
-                    left = messages.UserLeft(player)
-                    server.write_message(left)
-
-    # Responsible for delivering messages
-    def _send_message(self, server, player, actual_message):
-        if actual_message["to"] == 1:
-            recipient = server
-        elif actual_message["to"] == 2:
-            recipient = server.players
+        if not self.link:
+            # Nobody has it, join() turns the client away like it always did
+            self.join(**args)
+        elif not self.ws_connection:
+            # The client left while we were looking for the room
+            self.link.closed(self.left_with())
+
+    # Everything written to this connection goes through here, see outbound.py
+    def write_message(self, message, binary=False):
+        # Whatever was batched so far has to go out first to keep the order
+        if self.batch is not None and self.batched:
+            self.flush_batch()
+
+        limits = self.outbound.limits
+        if self.outbound.throttled:
+            if limits.policy == outbound.DROP:
+                limits.dropped += 1
+                return None
+
+            if limits.policy == outbound.CLOSE:
+                limits.disconnected += 1
+                self.close(code=exceptions.SlowConsumer())
+                self.outbound.release()
+                return None
+
+            limits.blocked += 1
+            if limits.waiting is not None:
+                limits.waiting.append(self.outbound)
+
+        started = time.perf_counter()
+
+        # Everything in outbound.py, and compression_min_size, is counted in bytes.
+        # Tornado would encode text frames anyway, binary says which kind it is
+        if isinstance(message, str):
+            message = message.encode()
+
+        if len(message) < self.application.compression_min_size:
+            future = self.write_uncompressed(message, binary or self.protocol.binary)
         else:
-            recipient = server.get_player_safe(actual_message["to"])
+            future = super().write_message(message, binary or self.protocol.binary)
+
+        self.outbound.sent(len(message), future, started)
+        return future
+
+    # permessage-deflate allows uncompressed frames in between the compressed ones.
+    # Relies on Tornado 6's WebSocketProtocol13.write_message, which only compresses,
+    # and sets RSV1, while its private _compressor is set. Without that attribute the
+    # frame is simply written as Tornado would
+    def write_uncompressed(self, message, binary: bool):
+        connection = self.ws_connection
+        compressor = getattr(connection, "_compressor", None)
+        if compressor is None:
+            return super().write_message(message, binary)
+
+        connection._compressor = None
+        try:
+            return super().write_message(message, binary)
+        finally:
+            connection._compressor = compressor
+
+    # Every close code Hotaru sends is counted, see metrics.py
+    def close(self, code=None, reason=None):
+        if self.ws_connection:
+            self.metrics.closed(code)
+        super().close(code, reason)
+
+    def on_pong(self, data):
+        if self.application.keepalive:
+            self.application.keepalive.alive(self)
 
-        msg = messages.RawMessage(player, actual_message["content"])
-        player.sends_message(recipient, msg)
-
-        if actual_message["to"] == 2:
-            player.sends_message(server, msg, True)
-            server.messages_public.append(msg)
+    def on_connection_close(self):
+        self.application.sockets.discard(self)
+        if self.application.keepalive:
+            self.application.keepalive.remove(self)
+        self.outbound.release()
+        if self.link:
+            self.link.closed(self.left_with())
+        self.left(self.left_with())
+
+    # The close code the room hears about, see Session.left
+    def left_with(self):
+        if self.timed_out:
+            return exceptions.StoppedAnswering()
+        return self.close_code
 
     # Fires when a WS packet is received
     def on_message(self, message, *args):
-
-        # We discard any packet with a length less than or equal to 1.
-        # This is for Heroku, it likes to disconnect those that it deems inactive.
-        # I usually counter this by sending a whitespace every 5 seconds or so
+        # Whitespace keepalives of clients from before Hotaru pinged them itself,
+        # see ping_interval. Nothing else has to look at them
+        if self.application.keepalive:
+            self.application.keepalive.alive(self)
         if len(message) <= 1:
-            return
+            return None
 
-        server, player_name, player, su = self.xtract_args()
-
-        message_command = message.split(" ")[0]
-        actual_message = json.loads(" ".join(message.split(" ")[1:]))
-
-        # player.name is a 1 only if it's sent by the server owner,
-        # see servers.py. This is for legacy reasons and how Hotaru was implemented
-        # before the rewrite and open-sourcing.
-        if message_command == "lock" and player.name == 1:
-            server.lock = True
-
-        if message_command == "unlock" and player.name == 1:
-            server.lock = False
-
-        # Send a message.
-        if message_command == "chat":
-            self._send_message(server, player, actual_message)
-
-        # Identical behavior to sending multiple "chat" commands with different contents.
-        # Instead, the content is an array of what we would have sent individually
-        elif message_command == "chats":
-            for ms in actual_message:
-                self._send_message(server, player, ms)
-
-        # Have you lost a packet? Does your "q" number not match? Fear not, for we have a solution!
-        # Call 1-800-REPEAT to receive a copy of all messages that have been sent to you after a specified packet!
-        elif message_command == "repeat":
-            try:
-                player.client.write_message(json.dumps(
-                    {
-                        "type": "repeated",
-                        "start": actual_message,
-                        "repeat": player.generate_repeat(actual_message)
-                    }, ensure_ascii=False))
-            except:
-                pass
+        if self.link:
+            self.link.forward(message)
+            return None
+        return self.handle(message)
@@ -0,0 +1,468 @@
+import gc
+import logging
+import os
+import time
+
+import tornado.ioloop
+
+from hotaru import codec
+from hotaru import messages
+from hotaru.players import Player
+from hotaru.servers import Group, Server
+
+"""
+Keeping rooms across restarts. Everything that changes a room is appended to a
+journal, one JSON array per line, and written out in batches. Every so often the
+rooms are written down as a snapshot instead, which replaces all journals before it.
+On startup, the snapshot is loaded and the journals after it are replayed, so
+players reconnect with the su they had and repeat what they missed.
+
+The files are numbered by generation: snapshot.json says which generation it
+was taken at, and journal.<generation>.log files of that generation and later
+are what happened after it.
+"""
+
+SNAPSHOT = "snapshot.json"
+
+
+class Offline:
+    """
+    The client of everyone recovered from the journal, until they reconnect.
+    Whatever is sent to them in the meantime is only written down.
+    """
+
+    connected = False
+    outbound = None
+
+    def write_inbound(self, q: int, message):
+        pass
+
+    def close(self, code=None, reason=None):
+        pass
+
+
+OFFLINE = Offline()
+
+
+class Journal:
+    """
+    Append-only log of a ServerPool, and the snapshots that compact it.
+    Records are buffered and written every fsync_interval seconds, a crash
+    loses at most that much. After compact_after records, a snapshot is taken.
+    """
+
+    def __init__(self, directory: str, fsync_interval=1.0, compact_after=100000):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+
+        self.generation = 0
+        self.file = None
+        self.buffer = []
+        # Written since the last snapshot
+        self.records = 0
+        # An fsync is running on another thread
+        self.syncing = False
+        # A snapshot is being written by another process
+        self.compacting = False
+        self.timer = None
+        self.pool = None
+
+        # Since the start, for the inspector
+        self.recovered = 0
+        self.recovery_time = 0
+        self.snapshots = 0
+
+    def path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    def journal_path(self, generation: int):
+        return self.path(f"journal.{generation}.log")
+
+    def generations(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith("journal.") and name.endswith(".log"):
+                try:
+                    found.append(int(name[8:-4]))
+                except ValueError:
+                    pass
+        return sorted(found)
+
+    # Brings back the rooms that were open before, then starts writing down the new ones.
+    # Returns the recovered rooms
+    def open(self, pool, margin: int):
+        os.makedirs(self.directory, exist_ok=True)
+        self.pool = pool
+
+        started = time.perf_counter()
+        # Recovery makes millions of objects that all stay around, the cyclic
+        # garbage collector would keep looking through them for nothing
+        gc.disable()
+        try:
+            servers, records = self.load(margin)
+        finally:
+            gc.enable()
+        pool.restore(servers)
+        self.recovered = len(servers)
+        self.recovery_time = time.perf_counter() - started
+
+        if records:
+            # What was replayed doesn't have to be replayed next time
+            self.compact()
+        else:
+            self.file = open(self.journal_path(self.generation), "a")
+
+        logging.info(f"Journal recovered {len(servers)} rooms, replayed {records} records "
+                     f"in {self.recovery_time:.2f} s")
+
+        self.timer = tornado.ioloop.PeriodicCallback(self.flush, self.fsync_interval * 1000)
+        self.timer.start()
+        return list(servers.values())
+
+    # The snapshot, then every journal after it.
+    # Returns the rooms by code and how many journal records were replayed
+    def load(self, margin: int):
+        servers = {}
+        self.generation = 0
+
+        if os.path.exists(self.path(SNAPSHOT)):
+            with open(self.path(SNAPSHOT)) as f:
+                self.generation = codec.loads(f.readline())["generation"]
+                for line in f:
+                    server = load_room(codec.loads(line))
+                    servers[server.code] = server
+
+        records = 0
+        for generation in self.generations():
+            if generation < self.generation:
+                continue
+            self.generation = generation
+
+            # Read as a stream, journals can be a lot larger than memory would like
+            with open(self.journal_path(generation)) as f:
+                for line in f:
+                    try:
+                        entry = codec.loads(line)
+                    except ValueError:
+                        # The last line can be cut off by a crash, nothing comes after it
+                        logging.warning(f"Journal {generation} ends with an incomplete record")
+                        break
+                    replay(servers, entry, margin)
+                    records += 1
+
+        return servers, records
+
+    def record(self, *entry):
+        self.buffer.append(codec.compact(entry))
+
+    def created(self, server: Server):
+        self.record("create", server.code, server.su, server.limit, server.compress)
+
+    def closed(self, code: str):
+        self.record("close", code)
+
+    def registered(self, server: Server, player: Player):
+        self.record("register", server.code, player.name, player.su)
+
+    def joined(self, server: Server, player: Player):
+        self.record("join", server.code, player.name)
+
+    def left(self, server: Server, player: Player):
+        self.record("left", server.code, player.name)
+
+    def locked(self, server: Server):
+        self.record("lock", server.code, server.lock)
+
+    def grouped(self, server: Server, name: str, names: list):
+        self.record("group", server.code, name, names)
+
+    def chatted(self, server: Server, player: Player, to, content, key=None):
+        if key is None:
+            self.record("chat", server.code, player.name, to, content)
+        else:
+            self.record("chat", server.code, player.name, to, content, key)
+
+    def acked(self, server: Server, player: Player, q: int):
+        self.record("ack", server.code, player.name, q)
+
+    # Hands what was buffered to the OS, without waiting for the disk
+    def write(self):
+        if self.buffer:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            self.records += len(self.buffer)
+            self.buffer = []
+
+    # Writes out what was buffered, the fsync runs on another thread so the IOLoop doesn't wait for the disk
+    def flush(self):
+        if self.buffer:
+            self.write()
+            if not self.syncing:
+                self.syncing = True
+                synced = tornado.ioloop.IOLoop.current().run_in_executor(
+                    None, os.fsync, self.file.fileno())
+                synced.add_done_callback(self.synced)
+
+        # Not while an fsync still has the file
+        if self.records >= self.compact_after and not self.syncing:
+            self.compact(background=True)
+
+    def synced(self, future):
+        self.syncing = False
+        if future.exception():
+            logging.error(f"Journal couldn't be synced: {future.exception()}")
+
+    # Writes down every room as it is now and starts a new journal.
+    # The old journals are only deleted once the snapshot is safely in place.
+    # In the background, a forked copy of this process writes the snapshot,
+    # and the old journal is synced on another thread like in flush(),
+    # so the IOLoop doesn't stop for as long as that takes
+    def compact(self, background=False):
+        if self.compacting:
+            return
+        started = time.perf_counter()
+
+        if not background:
+            self.close_file()
+            self.next_generation()
+            self.write_snapshot(self.generation)
+            self.compacted(self.generation, started, 0)
+            return
+
+        self.write()
+        retired = self.file
+        self.next_generation()
+
+        # The child only gets the thread that forked it. Whatever lock another thread held
+        # at that moment, in logging or the executor, stays taken in the child forever.
+        # So it does nothing but write the snapshot and leave with os._exit: no logging,
+        # no IOLoop or executor, no atexit handlers, and no garbage collection that could
+        # run finalizers. flush() doesn't compact while its fsync runs, and the old
+        # journal only goes to the executor once the child is forked
+        pid = os.fork()
+        if pid == 0:
+            gc.disable()
+            try:
+                self.write_snapshot(self.generation)
+                os._exit(0)
+            except BaseException:
+                os._exit(1)
+
+        loop = tornado.ioloop.IOLoop.current()
+        self.syncing = True
+        synced = loop.run_in_executor(None, close_journal, retired)
+        synced.add_done_callback(self.synced)
+
+        self.compacting = True
+        generation = self.generation
+        waited = loop.run_in_executor(None, os.waitpid, pid, 0)
+        waited.add_done_callback(
+            lambda future: self.compacted(generation, started, future.result()[1]))
+
+    def next_generation(self):
+        self.generation += 1
+        self.file = open(self.journal_path(self.generation), "a")
+        self.records = 0
+
+    def write_snapshot(self, generation: int):
+        temporary = self.path(SNAPSHOT + ".tmp")
+        with open(temporary, "w") as f:
+            f.write(codec.compact({"generation": generation}) + "\n")
+            for server in self.pool.pool.values():
+                f.write(codec.compact(dump_room(server)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path(SNAPSHOT))
+        sync_directory(self.directory)
+
+    def compacted(self, generation: int, started: float, status: int):
+        self.compacting = False
+        if status:
+            # The journals are all still there, nothing is lost
+            logging.error(f"Journal couldn't take a snapshot, exit status {status}")
+            return
+
+        for older in self.generations():
+            if older < generation:
+                os.remove(self.journal_path(older))
+
+        self.snapshots += 1
+        logging.info(f"Journal took a snapshot of generation {generation} "
+                     f"in {time.perf_counter() - started:.2f} s")
+
+    def close_file(self):
+        if self.file:
+            self.write()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    # Everything buffered is written and synced, nothing is written afterwards
+    def close(self):
+        if self.timer:
+            self.timer.stop()
+        self.close_file()
+
+
+# A journal nothing is written to anymore, on another thread
+def close_journal(file):
+    try:
+        os.fsync(file.fileno())
+    finally:
+        file.close()
+
+
+# Renames are only durable once the directory itself is synced
+def sync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# The owner is 1 and everyone at once is 2, like in chat messages.
+# Shadows can be of messages to groups that have changed or are gone since
+def member(server: Server, name):
+    return server.recipient(name) or Group(name, {})
+
+
+# Does what a journal record says, the same way it happened the first time
+def replay(servers: dict, entry: list, margin: int):
+    op, code = entry[0], entry[1]
+
+    if op == "create":
+        server = Server(code, entry[3], entry[4])
+        server.su = entry[2]
+        server.client = OFFLINE
+        servers[code] = server
+        return
+    if op == "close":
+        servers.pop(code, None)
+        return
+
+    server = servers.get(code)
+    if not server:
+        return
+
+    if op == "register":
+        player = Player(entry[2], OFFLINE)
+        player.su = entry[3]
+        server.register(player)
+    elif op == "join":
+        server.write_message(messages.UserJoin(member(server, entry[2])))
+    elif op == "left":
+        server.write_message(messages.UserLeft(member(server, entry[2])))
+    elif op == "lock":
+        server.lock = entry[2]
+    elif op == "group":
+        server.set_group(entry[2], entry[3])
+    elif op == "chat":
+        server.chat(member(server, entry[2]), entry[3], entry[4],
+                    entry[5] if len(entry) > 5 else None)
+    elif op == "ack":
+        server.acknowledge(member(server, entry[2]), entry[3], margin)
+
+
+# A room as JSON. Messages are often in several logs at once, they're written
+# once and the logs refer to them by their position
+def dump_room(server: Server):
+    table = []
+    ids = {}
+
+    def ref(m):
+        key = id(m)
+        if key not in ids:
+            if isinstance(m, messages.ShadowOfMessage):
+                entry = ["h", m.to.name, ref(m.content)]
+            elif isinstance(m, messages.KeyedMessage):
+                entry = ["k", m.from_.name, m.message_content, m.key]
+            elif isinstance(m, messages.RawMessage):
+                entry = ["m", m.from_.name, m.message_content]
+            elif isinstance(m, messages.UserAppend):
+                entry = ["a", m.user.name]
+            elif isinstance(m, messages.UserJoin):
+                entry = ["j", m.user.name]
+            elif isinstance(m, messages.UserLeft):
+                entry = ["l", m.user.name]
+            elif isinstance(m, messages.State):
+                entry = ["t", m.state]
+            else:
+                entry = ["s", m.su]
+            ids[key] = len(table)
+            table.append(entry)
+        return ids[key]
+
+    def log(player):
+        return [[q, public, ref(m)] for q, public, m in player.messages]
+
+    public = server.messages_public
+    return {
+        "code": server.code,
+        "su": server.su,
+        "limit": server.limit,
+        "compress": server.compress,
+        "lock": server.lock,
+        "groups": {name: list(group.players) for name, group in server.groups.items()},
+        "owner": [server.next, server.floor, log(server)],
+        "players": [[p.name, p.su, p.next, p.floor, log(p)] for p in server.players.list()],
+        # Keyed broadcasts that were replaced are None in the shared log
+        "public": [public.start, [None if m is None else ref(m) for m in public.messages]],
+        "state": [[key, position, q, ref(m)] for key, (position, q, m) in server.state.items()],
+        "messages": table
+    }
+
+
+def load_room(data: dict):
+    server = Server(data["code"], data["limit"], data["compress"])
+    server.su = data["su"]
+    server.client = OFFLINE
+    server.lock = data["lock"]
+
+    for name, su, next, floor, log in data["players"]:
+        player = Player(name, OFFLINE)
+        player.su = su
+        player.next = next
+        player.floor = floor
+        player.public = server.messages_public
+        server.add_user(player)
+
+    for name, names in data.get("groups", {}).items():
+        server.set_group(name, names)
+
+    table = []
+    for entry in data["messages"]:
+        kind = entry[0]
+        if kind == "h":
+            m = messages.ShadowOfMessage(member(server, entry[1]), table[entry[2]])
+        elif kind == "m":
+            m = messages.RawMessage(member(server, entry[1]), entry[2])
+        elif kind == "k":
+            m = messages.KeyedMessage(member(server, entry[1]), entry[2], entry[3])
+        elif kind == "a":
+            m = messages.UserAppend(member(server, entry[1]))
+        elif kind == "j":
+            m = messages.UserJoin(member(server, entry[1]))
+        elif kind == "l":
+            m = messages.UserLeft(member(server, entry[1]))
+        elif kind == "t":
+            m = messages.State(entry[1])
+        else:
+            m = messages.Su(entry[1])
+        table.append(m)
+
+    def log(entries):
+        return [(q, public, table[i]) for q, public, i in entries]
+
+    server.next, server.floor, owner_log = data["owner"]
+    server.messages = log(owner_log)
+    for name, su, next, floor, entries in data["players"]:
+        server.players[name].messages = log(entries)
+
+    start, public = data["public"]
+    server.messages_public.start = start
+    server.messages_public.messages = [None if i is None else table[i] for i in public]
+    server.state = {key: (position, q, table[i]) for key, position, q, i in data.get("state", [])}
+    server.recount()
+    return server
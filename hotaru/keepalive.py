@@ -0,0 +1,68 @@
+import logging
+
+import tornado.ioloop
+import tornado.websocket
+
+"""
+Pinging every WebSocket, and dropping the ones that stopped answering.
+"""
+
+
+class Keepalive:
+    """
+    Pings all connections at once every `interval` seconds, from a single timer
+    instead of a task per connection. Whatever hasn't answered `timeout` seconds
+    later is dropped right away, without waiting for a close handshake the other
+    end will never do, so the room hears about it as an abnormal disconnection.
+    Any frame counts as an answer, not just pongs.
+    """
+
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.sockets = set()
+        # Pinged in the current round, and not heard from since
+        self.waiting = set()
+
+        # Connections dropped since the start
+        self.dropped = 0
+
+        self.timer = tornado.ioloop.PeriodicCallback(self.ping, interval * 1000)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def add(self, handler):
+        self.sockets.add(handler)
+
+    def remove(self, handler):
+        self.sockets.discard(handler)
+        self.waiting.discard(handler)
+
+    def alive(self, handler):
+        self.waiting.discard(handler)
+
+    def ping(self):
+        for handler in self.sockets:
+            try:
+                handler.ping()
+            except tornado.websocket.WebSocketClosedError:
+                pass
+        self.waiting = set(self.sockets)
+        tornado.ioloop.IOLoop.current().call_later(self.timeout, self.drop, self.waiting)
+
+    # Everything that didn't answer in time. Answers that come in after
+    # the next round started don't count for this one anymore
+    def drop(self, waiting: set):
+        for handler in list(waiting):
+            logging.debug("Dropping a connection that stopped answering pings")
+            self.remove(handler)
+            self.dropped += 1
+            if handler.ws_connection:
+                # Closing the stream makes Tornado call on_connection_close without a close code,
+                # same as a client that closed without one. The room tells them apart by this
+                handler.timed_out = True
+                handler.ws_connection.stream.close()
@@ -1,94 +1,223 @@
+from hotaru import codec
 from hotaru.players import Player
 
 """
 Holder classes for all message types we currently support.
 """
 
+# What comes before message_content in the JSON body of a RawMessage, and around
+# the content of a shadow, see ShadowOfMessage.encode
+MSG_FROM = '{"type": "msg", "from": '
+MSG_AM = ', "am": '
+SHADOW = '{"type": "shadow", "shadow": {"to": %s, "content": %s}}'
 
-class RawMessage:
+
+class Message:
+    """
+    Base class for every message type.
+    The body is serialized only once, no matter how many players receive it,
+    and repeats reuse it too. Rooms keep a lot of these around, so every message
+    type uses __slots__, and only the serialized body is kept, in the protocols
+    it was needed in
+    """
+
+    __slots__ = ("_encoded", "_packed", "_size")
+
+    def __init__(self):
+        self._encoded = None
+        self._packed = None
+        self._size = None
+
+    # The body as a dict, subclasses say what goes in it with build().
+    # It isn't kept, everything Hotaru sends uses the serialized body instead
+    def repr(self):
+        return self.build()
+
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = codec.dumps(self.repr())
+        return self._encoded
+
+    # Same as encode(), but for the binary protocol, see protocols.py
+    def pack(self, packb):
+        if self._packed is None:
+            self._packed = packb(self.repr())
+        return self._packed
+
+    # Length of the serialized body, worked out only once. Logs keep a running
+    # total of these, see Server.log_stats, so it mustn't change afterwards
+    def size(self):
+        if self._size is None:
+            self._size = len(self.encode())
+        return self._size
+
+
+class RawMessage(Message):
     """
     Class for user-sent messages, these are always
     from someone else, not Hotaru itself
     """
 
+    __slots__ = ("from_", "message_content")
+
     def __init__(self, from_: Player, message_content):
+        super().__init__()
         self.from_ = from_
         self.message_content = message_content
 
-    def repr(self):
+    def build(self):
         return {
             "type": "msg",
             "from": self.from_.name,
             "am": self.message_content
         }
 
+    # message_content as it is in the body, for shadows of this message. What comes
+    # before and after it is known, so it's cut out instead of serialized again
+    def encoded_content(self):
+        body = self.encode()
+        start = len(MSG_FROM) + len(codec.dumps(self.from_.name)) + len(MSG_AM)
+        return body[start:len(body) - len(self.encoded_tail())]
 
-class UserAppend:
+    # The same for the binary protocol: a map header, then the keys and values in order
+    def packed_content(self, packb):
+        body = self.pack(packb)
+        start = 1 + len(packb("type")) + len(packb("msg")) + len(packb("from")) + \
+            len(packb(self.from_.name)) + len(packb("am"))
+        return body[start:len(body) - len(self.packed_tail(packb))]
+
+    # What comes after message_content
+    def encoded_tail(self):
+        return "}"
+
+    def packed_tail(self, packb):
+        return b""
+
+
+class KeyedMessage(RawMessage):
+    """
+    A broadcast from the owner that replaces the previous one with the same key,
+    like the current state of a board. The room only keeps the latest per key
+    """
+
+    __slots__ = ("key",)
+
+    def __init__(self, from_: Player, message_content, key: str):
+        super().__init__(from_, message_content)
+        self.key = key
+
+    def build(self):
+        return {
+            "type": "msg",
+            "from": self.from_.name,
+            "am": self.message_content,
+            "key": self.key
+        }
+
+    def encoded_tail(self):
+        return ', "key": ' + codec.dumps(self.key) + "}"
+
+    def packed_tail(self, packb):
+        return packb("key") + packb(self.key)
+
+
+class UserAppend(Message):
     """
     Sent to the owner when a player enters the game for the first time,
     their name should be appended to some kind of dictionary
     on the server owner's end
     """
 
+    __slots__ = ("user",)
+
     def __init__(self, user: Player):
+        super().__init__()
         self.user = user
 
-    def repr(self):
+    def build(self):
         return {
             "type": "userappend",
             "user": self.user.name
         }
 
 
-class UserJoin:
+class UserJoin(Message):
     """
     Sent to the owner when an already registered player joins the game back,
     presumably after being disconnected or when switching devices
     """
 
+    __slots__ = ("user",)
+
     def __init__(self, user: Player):
+        super().__init__()
         self.user = user
 
-    def repr(self):
+    def build(self):
         return {
             "type": "userjoin",
             "user": self.user.name
         }
 
 
-class UserLeft:
+class UserLeft(Message):
     """
     Sent to the owner when an already registered player disconnects abnormally,
     presumably after network problems
     """
 
+    __slots__ = ("user",)
+
     def __init__(self, user: Player):
+        super().__init__()
         self.user = user
 
-    def repr(self):
+    def build(self):
         return {
             "type": "userleft",
             "user": self.user.name
         }
 
 
-class Su:
+class Su(Message):
     """
     Sent to every newly registered player, this code is used for
     authentication later on, for instance when reconnecting
     """
 
+    __slots__ = ("su",)
+
     def __init__(self, su: str):
+        super().__init__()
         self.su = su
 
-    def repr(self):
+    def build(self):
         return {
             "type": "su",
             "su": self.su
         }
 
 
-class ShadowOfMessage:
+class State(Message):
+    """
+    Sent to a newly registered player when the room has keyed broadcasts
+    that were already trimmed from its log, the latest content per key
+    """
+
+    __slots__ = ("state",)
+
+    def __init__(self, state: dict):
+        super().__init__()
+        self.state = state
+
+    def build(self):
+        return {
+            "type": "state",
+            "state": self.state
+        }
+
+
+class ShadowOfMessage(Message):
     """
     This type of message is never sent directly, rather, it's a part
     of a "repeat" packet. They are messages sent by a player to Hotaru.
@@ -98,15 +227,32 @@ class ShadowOfMessage:
     One could rebuild the chat log like this.
     """
 
+    __slots__ = ("to", "content")
+
     def __init__(self, to, content):
+        super().__init__()
         self.to = to
         self.content = content
 
-    def repr(self):
+    # A shadow is only ever encoded as part of a repeat, what it keeps around is the message
+    def size(self):
+        return self.content.size()
+
+    # Nothing is kept for shadows, their content is cut out of the message's own body
+    def encode(self):
+        return SHADOW % (codec.dumps(self.to.name), self.content.encoded_content())
+
+    # Same as packb() of build(), two maps of two
+    def pack(self, packb):
+        return b"".join([b"\x82", packb("type"), packb("shadow"), packb("shadow"),
+                         b"\x82", packb("to"), packb(self.to.name),
+                         packb("content"), self.content.packed_content(packb)])
+
+    def build(self):
         return {
             "type": "shadow",
             "shadow": {
                 "to": self.to.name,
-                "content": self.content
+                "content": self.content.message_content
             }
         }
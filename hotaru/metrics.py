@@ -0,0 +1,123 @@
+import bisect
+import inspect
+import time
+
+from hotaru import exceptions
+
+"""
+Counters for the /metrics endpoint, in the Prometheus text format.
+Everything here is a plain increment on the hot path, the expensive
+parts are only worked out when someone scrapes the endpoint.
+"""
+
+# Commands are counted by name, anything else a client sends ends up as "other"
+COMMANDS = ("chat", "chats", "repeat", "ack", "lock", "unlock", "presence", "group")
+
+# Names of the close codes in exceptions.py, {4000: "ServerCodeDoesntExist", ...}.
+# Worked out on the first scrape, the functions log, and logging at import time
+# would configure the root logger before server.py gets to
+CLOSE_REASONS = {}
+
+
+def close_reasons():
+    if not CLOSE_REASONS:
+        CLOSE_REASONS.update({f(): name for name, f in vars(exceptions).items()
+                              if inspect.isfunction(f)})
+    return CLOSE_REASONS
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, the upper bounds are inclusive
+    like Prometheus expects them to be.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        # One more for everything above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """
+    Everything Hotaru counts while it runs.
+    """
+
+    def __init__(self):
+        self.commands = dict.fromkeys(COMMANDS + ("other",), 0)
+        self.closes = {}
+
+        # How many players a single chat message was sent to
+        self.fanout = Histogram((1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+        # Building a frame for a connection, and until Tornado has flushed it
+        self.encode = Histogram((0.000001, 0.000005, 0.00001, 0.00005, 0.0001,
+                                 0.0005, 0.001, 0.005, 0.01))
+        self.send = Histogram((0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+                               0.1, 0.5, 1, 5))
+
+    def command(self, name):
+        if name not in self.commands:
+            name = "other"
+        self.commands[name] += 1
+
+    def closed(self, code):
+        self.closes[code] = self.closes.get(code, 0) + 1
+
+    # The whole page, rooms and their logs are looked at right now.
+    # The drain only shows up once the process is shutting down, see drain.py
+    def render(self, pool, drain=None):
+        servers = list(pool.pool.values())
+        out = []
+
+        def metric(name, kind, help, lines):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+
+        metric("hotaru_rooms", "gauge", "Rooms that are open.",
+               [f"hotaru_rooms {len(servers)}"])
+        metric("hotaru_sockets", "gauge", "WebSocket connections bound to a room.",
+               [f"hotaru_sockets {sum(s.connections for s in servers)}"])
+        metric("hotaru_commands_total", "counter", "Frames received, by command.",
+               [f'hotaru_commands_total{{command="{c}"}} {n}' for c, n in self.commands.items()])
+        metric("hotaru_fanout", "histogram", "Recipients of a single chat message.",
+               self.fanout.render("hotaru_fanout"))
+        metric("hotaru_encode_seconds", "histogram", "Time spent building an outgoing frame.",
+               self.encode.render("hotaru_encode_seconds"))
+        metric("hotaru_send_seconds", "histogram", "Time until an outgoing frame was flushed.",
+               self.send.render("hotaru_send_seconds"))
+        metric("hotaru_room_log_bytes", "gauge", "Serialized size of what a room keeps for repeats.",
+               [f'hotaru_room_log_bytes{{room="{s.code}"}} {s.log_stats()["bytes"]}' for s in servers])
+        reasons = close_reasons()
+        metric("hotaru_closes_total", "counter", "Connections closed by Hotaru, by close code.",
+               [f'hotaru_closes_total{{code="{code or ""}",reason="{reasons.get(code, "")}"}} {n}'
+                for code, n in sorted(self.closes.items(), key=lambda c: str(c[0]))])
+
+        if drain:
+            duration = drain.duration if drain.duration is not None else time.monotonic() - drain.started
+            metric("hotaru_drain_seconds", "gauge", "How long the shutdown has taken so far, or took.",
+                   [f"hotaru_drain_seconds {duration}"])
+            metric("hotaru_drain_connections", "gauge", "Connections open when the shutdown started.",
+                   [f"hotaru_drain_connections {drain.connections}"])
+            metric("hotaru_drain_leftover", "gauge", "Connections dropped at the shutdown deadline.",
+                   [f"hotaru_drain_leftover {drain.leftover}"])
+
+        return "\n".join(out) + "\n"
@@ -0,0 +1,104 @@
+import datetime
+import logging
+import time
+
+import tornado.locks
+import tornado.util
+
+"""
+Flow control for what Hotaru writes to its connections.
+Tornado buffers anything a client doesn't read fast enough, so a single stalled
+phone could make the server hold on to an unbounded amount of memory.
+"""
+
+# What happens to a connection that has more pending than the high-water mark
+DROP = "drop"    # Frames are skipped, the client notices the gap in "q" and asks for a repeat
+CLOSE = "close"  # The connection is closed with exceptions.SlowConsumer()
+BLOCK = "block"  # Whoever sends to the connection stops being read until it catches up
+
+
+class Backpressure:
+    """
+    Settings and counters shared by all connections.
+    """
+
+    def __init__(self, high_water: int, policy: str, block_timeout: float):
+        if policy not in (DROP, CLOSE, BLOCK):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+        self.high_water = high_water
+        self.low_water = high_water // 2
+        self.policy = policy
+        self.block_timeout = datetime.timedelta(seconds=block_timeout)
+
+        # Connections that are over the high-water mark right now
+        self.throttled = 0
+        # Totals since the start
+        self.dropped = 0
+        self.disconnected = 0
+        self.blocked = 0
+
+        # Connections the frame currently being handled has to wait for, see BLOCK.
+        # None while no frame is handled, writes made then don't hold up anyone
+        self.waiting = None
+
+    # Before a frame is handled, take_waiting() once it's done
+    def collect(self):
+        self.waiting = []
+
+    def take_waiting(self):
+        waiting = self.waiting or []
+        self.waiting = None
+        return waiting
+
+
+class Outbound:
+    """
+    Bytes handed to a single connection that haven't been flushed to the network yet.
+    """
+
+    def __init__(self, limits: Backpressure, metrics=None):
+        self.limits = limits
+        # Flush times end up in metrics.send, see metrics.py
+        self.metrics = metrics
+        self.pending = 0
+        self.throttled = False
+        self.drained = tornado.locks.Event()
+        self.drained.set()
+
+    # Called for every frame written, size is in bytes, and future is what Tornado returned for it
+    # and started is when the frame was handed over, from time.perf_counter()
+    def sent(self, size: int, future, started: float):
+        self.pending += size
+        if not self.throttled and self.pending > self.limits.high_water:
+            logging.debug(f"Connection has {self.pending} bytes pending, throttling")
+            self.throttled = True
+            self.limits.throttled += 1
+            self.drained.clear()
+
+        future.add_done_callback(lambda f: self.flushed(size, f, started))
+
+    def flushed(self, size: int, future, started: float):
+        if self.metrics:
+            self.metrics.send.observe(time.perf_counter() - started)
+
+        # A closed connection fails its pending writes, there's nobody to tell about it
+        if not future.cancelled():
+            future.exception()
+
+        self.pending -= size
+        if self.throttled and self.pending <= self.limits.low_water:
+            self.release()
+
+    # Stop counting this connection as throttled and let blocked senders through
+    def release(self):
+        if self.throttled:
+            self.throttled = False
+            self.limits.throttled -= 1
+        self.drained.set()
+
+    async def wait_drained(self):
+        try:
+            await self.drained.wait(timeout=self.limits.block_timeout)
+        except tornado.util.TimeoutError:
+            logging.debug("Gave up waiting for a slow connection to drain")
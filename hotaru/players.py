@@ -1,6 +1,8 @@
 from hotaru import messages
+from hotaru import exceptions
+import bisect
+import time
 import uuid
-import json
 
 import logging
 
@@ -9,71 +11,157 @@ Class for handling connected players.
 """
 
 
+# Builds the "inbound" envelope around an already serialized message body.
+# This is byte for byte what codec.dumps would produce for the whole envelope,
+# but the body only has to be encoded once per message instead of once per recipient
+def inbound_frame(q: int, body: str):
+    return '{"type": "inbound", "q": %d, "msg": %s}' % (q, body)
+
+
+# Our own log entries with the broadcasts from the shared log in between,
+# "first" is the position of the first broadcast in the list
+def merge(own: list, broadcasts: list, first: int):
+    caret = first
+    for q, public, m in own:
+        if caret < public:
+            yield from (b for b in broadcasts[caret - first:public - first] if b is not None)
+            caret = public
+        yield m
+
+    yield from (b for b in broadcasts[caret - first:] if b is not None)
+
+
 class Player:
+    # A room can have a lot of players, this keeps each of them small
+    __slots__ = ("name", "su", "client", "next", "messages", "public", "floor",
+                 "online", "since", "bytes")
+
     def __init__(self, name: str, client):
         self.name = str(name)
         self.su = str(uuid.uuid4())
         self.client = client
-        self.messages = []
         self.next = 0
 
+        # Everything sent from and to this player that isn't a broadcast.
+        # Entries are (q, public, message) tuples, where q is the number of the next
+        # inbound message and public is how far the room's shared log went at the time.
+        # Broadcasts are only stored once, in the shared log, which is merged back in on repeat
+        self.messages = []
+        self.public = None
+        # Serialized size of what's in our own log, see Server.log_stats
+        self.bytes = 0
+
+        # Anything before this q has been acknowledged and freed
+        self.floor = 0
+
+        # Whether a connection is bound to this player, and since when.
+        # Kept up to date when connections come and go, so reading it costs nothing
+        self.online = False
+        self.since = time.monotonic()
+
+    def set_online(self, online: bool):
+        self.online = online
+        self.since = time.monotonic()
+
+    # Start receiving broadcasts from a room's shared log. The greeting comes first,
+    # then everything that is still in the shared log counts as already sent,
+    # without copying any of it
+    def subscribe(self, public, greeting):
+        size = greeting.size()
+        self.public = public
+        self.messages.append((self.next, public.start, greeting))
+        self.bytes += size
+        self.deliver(greeting)
+        self.next += len(public)
+
     # This is used when something sends a message TO this player
     def write_message(self, message):
+        self.log(message)
+        self.deliver(message)
+
+    # Write down a message in this player's own log
+    def log(self, message):
+        size = message.size()
+        public = self.public.end() if self.public is not None else 0
+        self.messages.append((self.next, public, message))
+        self.bytes += size
+
+    # Send a message without writing it down, this is what the "q" number counts
+    def deliver(self, message):
         try:
-            self.client.write_message(json.dumps(
-                {
-                    "type": "inbound",
-                    "q": self.next,
-                    "msg": message.repr()
-                }
-            ))
+            self.client.write_inbound(self.next, message)
         except:
             pass
 
         self.next += 1
-        self.messages.append(message)
 
     # This is used when THIS PLAYER sends something to someone else
     def sends_message(self, to, content, shadowless=False):
-        # This is how we identify that we're dealing with a PlayerPool object
-        if to.name == 2:
-            for recipient in to.list():
-                # Run this function again, but one message by one.
-                # Pass True so that we don't get millions of undesired shadows,
-                # but instead get one that was sent to "2"
-                self.sends_message(recipient, content, True)
-
-        # When we're dealing with anyone but a PlayerPool
-        if to.name != 2:
-            to.write_message(content)
+        # A PlayerPool takes care of broadcasts itself, see servers.py
+        to.write_message(content)
 
         # Write down a shadow so that we include a copy of this sent message
         # when the player asks for a log
         if not shadowless:
             sh = messages.ShadowOfMessage(to, content)
-            self.messages.append(sh)
+            self.log(sh)
+
+    # Position in the shared log of the broadcast that got number q, or of the one
+    # that comes after it. "start" is the first entry of our own log at or after q.
+    # Every q number between the two was taken up by a broadcast
+    def public_position(self, q, start=None):
+        if start is None:
+            start = bisect.bisect_left(self.messages, (q,))
+
+        if start < len(self.messages):
+            own_q, public, m = self.messages[start]
+            return public - (own_q - q)
+        return self.public.end() - (self.next - q)
+
+    # The client has received everything before q, anything older than
+    # the safety margin doesn't have to be kept for a repeat anymore
+    def trim(self, q, margin=0):
+        floor = min(q - margin, self.next)
+        if floor <= self.floor:
+            return
+
+        self.floor = floor
+        end = bisect.bisect_left(self.messages, (floor,))
+        self.bytes -= sum(m.size() for q, public, m in self.messages[:end])
+        del self.messages[:end]
 
     # This is what generates a repeat, or in other words, a log of everything sent
-    # from and to this player. It's used for packet losses, reconnecting, and so on
-    def generate_repeat(self, expected_next):
+    # from and to this player. It's used for packet losses, reconnecting, and so on.
+    # Returns how many messages there are and an iterator over them, nothing is built yet.
+    # What it goes through is copied first, so the logs can change while a long repeat
+    # is encoded a chunk at a time, see Session.encode_later
+    def repeat_messages(self, expected_next):
         logging.debug(
             f"Generating repeat packet for {self.name}; Next expected packet is {expected_next}")
-        looped_real_messages = 0
-        caret = 0
 
         # Clients should only keep the number of messages they have received.
-        # We loop through all messages that this object holds, and count those
-        # that have been sent from someone else to this user.
+        # Shadows that were written after the last received message are repeated too.
+        # Anything past what we've sent so far yields an empty repeat.
+        if expected_next < 0:
+            return 0, iter(())
 
-        # This might get changed, because it could cause shadow message duplication in some cases
+        if expected_next < self.floor:
+            raise exceptions.LogTrimmed(self.floor)
 
-        for ms in self.messages:
-            if looped_real_messages == expected_next:
-                break
-            if not ms.get("type", "") == "shadow":
-                looped_real_messages += 1
-            caret += 1
+        # First entry of our own log that has to be repeated
+        start = bisect.bisect_left(self.messages, (expected_next,))
+        own = self.messages[start:]
 
-        n = self.messages[caret:]
+        if self.public is None:
+            return len(own), (m for q, public, m in own)
 
-        return [i.repr() for i in n]
+        # The broadcasts are merged back in between our own entries.
+        # Keyed broadcasts that were replaced since are skipped, see Server.supersede
+        caret = self.public_position(expected_next, start)
+        broadcasts = self.public.between(caret, self.public.end())
+        return len(own) + len(broadcasts) - broadcasts.count(None), merge(own, broadcasts, caret)
+
+    # The same as a list of dicts
+    def generate_repeat(self, expected_next):
+        length, repeat = self.repeat_messages(expected_next)
+        return [m.repr() for m in repeat]
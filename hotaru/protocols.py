@@ -0,0 +1,142 @@
+from hotaru import codec
+from hotaru import exceptions
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from hotaru.players import inbound_frame
+
+BATCH = '{"type": "inbound", "batch": [%s]}'
+BATCH_ENTRY = '{"q": %d, "msg": %s}'
+BATCH_COMMA = ", "
+REPEATED = '{"type": "repeated", "start": %s, "repeat": [%s], "next": %d}'
+
+"""
+Wire formats of the WebSocket endpoint, picked by the version in its URL.
+Both carry the same commands and the same message types, see messages.py
+"""
+
+
+class TextProtocol:
+    """
+    v0: a command word, a space and JSON from the client, JSON frames back
+    """
+
+    binary = False
+
+    def parse(self, frame):
+        # Everything before the first space is the command, the rest is JSON.
+        # Commands like "lock" or "presence" don't need anything after them
+        command, _, payload = frame.partition(" ")
+        return command, codec.loads(payload) if payload else None
+
+    def inbound(self, q: int, message):
+        return inbound_frame(q, message.encode())
+
+    def batch(self, batched):
+        return BATCH % BATCH_COMMA.join(BATCH_ENTRY % (q, m.encode()) for q, m in batched)
+
+    def dumps(self, frame: dict):
+        return codec.dumps(frame, ensure_ascii=False)
+
+    # Long repeats are encoded a chunk of messages at a time, then put together.
+    # This is byte for byte what dumps() would make of the whole "repeated" frame
+    def encode_items(self, items: list):
+        return BATCH_COMMA.join(repeated_body(m) for m in items)
+
+    def repeated(self, start, length: int, chunks: list, next: int):
+        return REPEATED % (codec.dumps(start), BATCH_COMMA.join(c for c in chunks if c), next)
+
+
+# v1 commands, sent by the client as [opcode, payload]
+COMMANDS = {
+    1: "chat",
+    2: "chats",
+    3: "repeat",
+    4: "ack",
+    5: "lock",
+    6: "unlock",
+    7: "presence",
+    8: "group"
+}
+
+# v1 frames sent by Hotaru. Inbound messages are [OP_INBOUND, q, msg],
+# batches are [OP_BATCH, [[q, msg], ...]]. Everything else is the same map as in v0
+OP_INBOUND = 0
+OP_BATCH = 1
+
+
+class MsgpackProtocol:
+    """
+    v1: MessagePack both ways, with numeric opcodes instead of command words
+    """
+
+    binary = True
+
+    def __init__(self):
+        self.packer = msgpack.Packer()
+
+    # Frames that aren't [opcode, payload], or that JSON couldn't hold, are turned down
+    def parse(self, frame):
+        try:
+            opcode, payload = msgpack.unpackb(frame)
+        except (ValueError, TypeError):
+            raise exceptions.InvalidPayload()
+        if not jsonable(payload):
+            raise exceptions.InvalidPayload()
+        return COMMANDS.get(opcode, ""), payload
+
+    # Like in v0, the message body is packed once and the rest is spliced around it
+    def inbound(self, q: int, message):
+        return b"\x93" + self.packer.pack(OP_INBOUND) + self.packer.pack(q) + message.pack(msgpack.packb)
+
+    def batch(self, batched):
+        frame = [b"\x92", self.packer.pack(OP_BATCH),
+                 self.packer.pack_array_header(len(batched))]
+        for q, m in batched:
+            frame += [b"\x92", self.packer.pack(q), m.pack(msgpack.packb)]
+        return b"".join(frame)
+
+    def dumps(self, frame: dict):
+        return msgpack.packb(frame)
+
+    def encode_items(self, items: list):
+        return b"".join(m.pack(msgpack.packb) for m in items)
+
+    # A map of four, same as packb() of the "repeated" frame
+    def repeated(self, start, length: int, chunks: list, next: int):
+        return b"".join([b"\x84", self.packer.pack("type"), self.packer.pack("repeated"),
+                         self.packer.pack("start"), self.packer.pack(start),
+                         self.packer.pack("repeat"), self.packer.pack_array_header(length)]
+                        + chunks + [self.packer.pack("next"), self.packer.pack(next)])
+
+
+# A message in a v0 "repeated" frame. Unlike inbound frames, those don't escape what
+# isn't ASCII, so the body sent in inbound frames is only the same when nothing in it
+# was escaped. Characters like "\n" are written the same way by both
+def repeated_body(message):
+    body = message.encode()
+    if "\\u" in body:
+        return codec.dumps(message.repr(), ensure_ascii=False)
+    return body
+
+
+# Whether JSON can hold it. MessagePack also has binary data and extension types,
+# and maps with keys that aren't strings, which it turns down itself.
+# Serializing it is the quickest way to find out, with orjson at least
+def jsonable(payload):
+    try:
+        codec.compact(payload)
+    except (TypeError, ValueError, RecursionError):
+        return False
+    return True
+
+
+PROTOCOLS = {
+    "v0": TextProtocol()
+}
+
+if msgpack is not None:
+    PROTOCOLS["v1"] = MsgpackProtocol()
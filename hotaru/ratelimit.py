@@ -0,0 +1,123 @@
+import logging
+import time
+
+"""
+Limits on what a client may send, so that a single one sending in a loop
+can't take the IOLoop away from every other room.
+Connections and rooms each have token buckets for messages, bytes and repeats.
+"""
+
+# What happens to a frame that goes over a limit
+DROP = "drop"    # It's ignored, as if it was never sent
+DELAY = "delay"  # It's handled once the limits allow it, the connection isn't read from until then
+CLOSE = "close"  # The connection is closed with exceptions.RateLimited()
+
+
+class TokenBucket:
+    """
+    Refills at `rate` tokens per second, up to `burst` tokens.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # Seconds until there are n tokens, 0 if they're already there
+    def wait(self, n: int, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+
+    # Can go below zero for a delayed frame, later frames then wait for it too
+    def take(self, n: int):
+        self.tokens -= n
+
+
+class Buckets:
+    """
+    The token buckets of a single connection or room, None where there's no limit.
+    """
+
+    __slots__ = ("messages", "bytes", "repeats")
+
+    def __init__(self, messages, bytes, repeats):
+        self.messages = messages
+        self.bytes = bytes
+        self.repeats = repeats
+
+
+class RateLimits:
+    """
+    Settings and counters shared by all connections.
+    Rates are per second, None means no limit. Buckets hold `burst` seconds worth
+    of tokens, so short bursts of a normal client don't count against it.
+    """
+
+    def __init__(self, messages=None, bytes=None, repeats=None,
+                 room_messages=None, room_bytes=None, room_repeats=None,
+                 max_frame=None, max_chats=None, policy=DROP, burst=2.0):
+        if policy not in (DROP, DELAY, CLOSE):
+            raise ValueError(f"Unknown rate limit policy: {policy}")
+
+        self.messages = messages
+        self.bytes = bytes
+        self.repeats = repeats
+        self.room_messages = room_messages
+        self.room_bytes = room_bytes
+        self.room_repeats = room_repeats
+        # Longest frame in bytes, and most messages in a single "chats"
+        self.max_frame = max_frame
+        self.max_chats = max_chats
+        self.policy = policy
+        self.burst = burst
+
+        # Totals since the start
+        self.dropped = 0
+        self.delayed = 0
+        self.disconnected = 0
+
+    def bucket(self, rate, least=0):
+        if not rate:
+            return None
+        return TokenBucket(rate, max(rate * self.burst, least))
+
+    # Frames up to max_frame always fit into an empty byte bucket
+    def connection(self):
+        return Buckets(self.bucket(self.messages), self.bucket(self.bytes, self.max_frame or 0),
+                       self.bucket(self.repeats))
+
+    def room(self):
+        return Buckets(self.bucket(self.room_messages), self.bucket(self.room_bytes, self.max_frame or 0),
+                       self.bucket(self.room_repeats))
+
+    # Whether a frame is over the limits no matter how long it waits
+    def too_large(self, size: int):
+        return self.max_frame is not None and size > self.max_frame
+
+    def too_many(self, chats: list):
+        return self.max_chats is not None and len(chats) > self.max_chats
+
+    # Seconds a frame has to wait for, 0 if it can be handled right away.
+    # Frames only use up tokens if they're handled, now or later under DELAY
+    def admit(self, connection: Buckets, room: Buckets, size: int, repeat: bool):
+        now = time.monotonic()
+        needed = []
+        for buckets in (connection, room):
+            needed += [(buckets.messages, 1), (buckets.bytes, size)]
+            if repeat:
+                needed.append((buckets.repeats, 1))
+        needed = [(bucket, n) for bucket, n in needed if bucket]
+
+        wait = max((bucket.wait(n, now) for bucket, n in needed), default=0)
+        if not wait or self.policy == DELAY:
+            for bucket, n in needed:
+                bucket.take(n)
+        if wait:
+            logging.debug(f"Frame of {size} bytes is over the rate limits for {wait:.2f} s")
+        return wait
@@ -0,0 +1,81 @@
+import logging
+import math
+import time
+
+import tornado.ioloop
+
+"""
+Closing rooms that were abandoned, for instance when the owner closed the tab.
+"""
+
+
+class Reaper:
+    """
+    A timer wheel of rooms. Every room sits in the slot of the tick it could
+    expire at, so a tick only has to look at the rooms that are due.
+    Traffic just updates Server.last_active, rooms that turn out to be
+    still in use get pushed back when their slot comes up.
+    """
+
+    def __init__(self, pool, ttl: float, resolution=1.0):
+        self.pool = pool
+        self.ttl = ttl
+        self.resolution = resolution
+
+        # Deadlines are never more than ttl away, so a single turn of the wheel covers them
+        self.slots = [[] for _ in range(math.ceil(ttl / resolution) + 1)]
+        self.tick = self._tick_of(time.monotonic())
+
+        # Rooms closed since the start
+        self.reaped = 0
+
+        self.timer = tornado.ioloop.PeriodicCallback(
+            self.turn, resolution * 1000)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def _tick_of(self, moment: float):
+        return int(moment / self.resolution)
+
+    def _schedule(self, server, deadline: float):
+        # Never schedule into a slot the wheel has already passed
+        tick = max(self._tick_of(deadline), self.tick + 1)
+        self.slots[tick % len(self.slots)].append(server)
+
+    # Start keeping an eye on a freshly created room
+    def watch(self, server):
+        self._schedule(server, server.last_active + self.ttl)
+
+    # Called every resolution seconds, goes through all slots that are due
+    def turn(self):
+        now = time.monotonic()
+        while self.tick < self._tick_of(now):
+            self.tick += 1
+            slot = self.tick % len(self.slots)
+            due = self.slots[slot]
+            self.slots[slot] = []
+
+            for server in due:
+                self._check(server, now)
+
+    def _check(self, server, now: float):
+        # The room was closed in the meantime, and the code might belong to another one by now
+        if self.pool.get_server_safe(server.code) is not server:
+            return
+
+        if server.connections:
+            self._schedule(server, now + self.ttl)
+            return
+
+        if server.last_active + self.ttl > now:
+            self._schedule(server, server.last_active + self.ttl)
+            return
+
+        logging.info(f"Closing idle server: {server.code}")
+        server.close_server()
+        self.pool.free(server.code)
+        self.reaped += 1
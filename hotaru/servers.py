@@ -1,24 +1,74 @@
 import logging
 from hotaru import exceptions
+from hotaru import messages
 from hotaru.players import Player
+from hotaru.codes import CodeAllocator
+import bisect
 import uuid
-import random
-import string
+import time
 
 """
 Classes for the servers.
 """
 
 
+class BroadcastLog:
+    """
+    The room's shared log of broadcasts.
+    Positions count from the creation of the room, so trimming doesn't shift them.
+    Keyed broadcasts that were replaced leave a None behind, for the same reason.
+    """
+
+    def __init__(self):
+        self.start = 0
+        self.messages = []
+        # Serialized size of what's in here, see Server.log_stats
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    # Sized first, a message that can't be serialized never makes it in
+    def append(self, message):
+        size = message.size()
+        self.messages.append(message)
+        self.bytes += size
+
+    # Position right after the newest broadcast
+    def end(self):
+        return self.start + len(self.messages)
+
+    def between(self, first, last):
+        return self.messages[first - self.start:last - self.start]
+
+    # A broadcast that isn't worth repeating anymore, if it's still here
+    def drop(self, position):
+        if position >= self.start:
+            message = self.messages[position - self.start]
+            if message is not None:
+                self.bytes -= message.size()
+            self.messages[position - self.start] = None
+
+    # Free everything before a position
+    def trim(self, position):
+        if position > self.start:
+            self.bytes -= sum(m.size() for m in self.messages[:position - self.start] if m is not None)
+            del self.messages[:position - self.start]
+            self.start = position
+
+
 class PlayerPool:
     """
     Holder class for a list of players connected to a server.
     """
 
-    def __init__(self):
+    def __init__(self, messages: BroadcastLog):
         self.name = 2
         self.players = {}
 
+        # The room's shared log of broadcasts, see Player.subscribe
+        self.messages = messages
+
     # For subscript access
     def __setitem__(self, player_name, player):
         self.players[player_name] = player
@@ -36,9 +86,38 @@ class PlayerPool:
     def count(self):
         return len(self.players)
 
+    # A broadcast is written down once and delivered to everyone
+    def write_message(self, message):
+        self.messages.append(message)
+        for player in self.players.values():
+            player.deliver(message)
+
+
+class Group:
+    """
+    Some of the players of a room, set up by the owner so that a message
+    to all of them is sent, written down and encoded only once.
+    A list of names in "to" is a group too, just for that one message.
+    """
+
+    def __init__(self, name, players: dict):
+        self.name = name
+        self.players = players
+
+    def count(self):
+        return len(self.players)
+
+    # Every member gets it like a direct message, they all share the same message
+    def write_message(self, message):
+        for player in self.players.values():
+            player.write_message(message)
+
 
 class Server(Player):
-    def __init__(self, code: str, limit: int):
+    __slots__ = ("code", "messages_public", "players", "lock", "limit", "compress",
+                 "connections", "last_active", "state", "groups", "buckets")
+
+    def __init__(self, code: str, limit: int, compress=True):
         self.name = 1
 
         self.code = code
@@ -46,12 +125,34 @@ class Server(Player):
 
         self.client = None
 
-        self.players = PlayerPool()
+        self.messages_public = BroadcastLog()
+        self.players = PlayerPool(self.messages_public)
         self.messages = []
-        self.messages_public = []
+        self.public = None
+        self.bytes = 0
         self.next = 0
+        self.floor = 0
+        self.online = False
+        self.since = time.monotonic()
         self.lock = False
         self.limit = limit
+        # Whether connections to this room may use permessage-deflate
+        self.compress = compress
+
+        # Open connections of the owner and players, and when anyone last did anything.
+        # Rooms that have neither for long enough get closed, see reaper.py
+        self.connections = 0
+        self.last_active = time.monotonic()
+
+        # The latest keyed broadcast of every key, as (position in the shared log,
+        # q it got in our own log, message). Kept even after the log is trimmed
+        self.state = {}
+
+        # Groups of players by their name, see Group
+        self.groups = {}
+
+        # Rate limits of the whole room, set up by the first connection, see ratelimit.py
+        self.buckets = None
 
         logging.debug(f"Initialized new Server instance: {self.code}")
 
@@ -64,6 +165,86 @@ class Server(Player):
             logging.error(
                 f"Server {self.code} tried to add player {player} but the name is taken. Did an earlier check fail?")
 
+    # A new player: it gets its su code and the owner hears about it.
+    # Keyed state that was trimmed from the shared log comes right after the su code,
+    # the rest of it is still in the log and gets repeated from there
+    def register(self, player: Player):
+        self.add_user(player)
+        player.subscribe(self.messages_public, messages.Su(player.su))
+
+        trimmed = {key: m.message_content for key, (position, q, m) in self.state.items()
+                   if position < self.messages_public.start}
+        if trimmed:
+            player.write_message(messages.State(trimmed))
+
+        self.write_message(messages.UserAppend(player))
+
+    # Who a chat message is for: 1 is the owner, 2 is everyone in the room, then
+    # a player's name or a group's name, players first. A list of player names
+    # makes a group on the spot. Returns None when there's no one by that name
+    def recipient(self, to):
+        if to == 1:
+            return self
+        if to == 2:
+            return self.players
+        if isinstance(to, list):
+            return Group(to, {name: self.players[name] for name in to if name in self.players})
+
+        player = self.get_player_safe(to)
+        if player:
+            return player
+        return self.groups.get(to)
+
+    # The owner sets who is in a group, no one at all removes it.
+    # Names of players that aren't in the room are left out
+    def set_group(self, name: str, names: list):
+        members = {n: self.players[n] for n in names if n in self.players}
+        if members:
+            self.groups[name] = Group(name, members)
+        else:
+            self.groups.pop(name, None)
+
+    # The owner or a player sends a chat message to someone, see recipient().
+    # Broadcasts of the owner can have a key, see messages.KeyedMessage.
+    # Returns how many received it
+    def chat(self, player: Player, to, content, key=None):
+        recipient = self.recipient(to)
+
+        replaced = None
+        if key is not None and to == 2 and player is self:
+            msg = messages.KeyedMessage(player, content, key)
+            replaced = self.state.get(key)
+            self.state[key] = (self.messages_public.end(), self.next, msg)
+        else:
+            msg = messages.RawMessage(player, content)
+        player.sends_message(recipient, msg)
+
+        if to == 2:
+            player.sends_message(self, msg, True)
+
+        if replaced:
+            self.supersede(*replaced)
+
+        if to == 2:
+            return self.players.count() + 1
+        if isinstance(recipient, Group):
+            return recipient.count()
+        return 1
+
+    # Forgets a keyed broadcast that was replaced, so repeats only have the latest.
+    # In our own log, it was written down as a shadow and as itself, both with the same q
+    def supersede(self, position: int, q: int, message):
+        self.messages_public.drop(position)
+
+        i = bisect.bisect_left(self.messages, (q,))
+        while i < len(self.messages) and self.messages[i][0] == q:
+            m = self.messages[i][2]
+            if m is message or (isinstance(m, messages.ShadowOfMessage) and m.content is message):
+                self.bytes -= m.size()
+                del self.messages[i]
+            else:
+                i += 1
+
     # Check for a Player in PlayerPool, return None if not found
     def get_player_safe(self, player_name):
         if not player_name in self.players:
@@ -71,6 +252,41 @@ class Server(Player):
         else:
             return self.players[player_name]
 
+    # The owner or a player has received everything before q.
+    # The shared log can only let go of what every player has acknowledged
+    def acknowledge(self, player: Player, q: int, margin: int):
+        player.trim(q, margin)
+
+        if player is not self and self.players.count():
+            self.messages_public.trim(min(
+                p.public_position(p.floor) for p in self.players.list()))
+
+        logging.debug(
+            f"Server {self.code} trimmed logs after {player.name} acknowledged {q}")
+
+    # How much this room keeps around for repeats. Every log keeps a running total of
+    # its bytes, so this doesn't look at the messages themselves and /metrics can ask
+    # for it all the time. A message counts once for every log it's in, a shadow counts
+    # as the message it's a shadow of. Keyed state only adds what was trimmed from the log
+    def log_stats(self):
+        logs = [self] + self.players.list()
+        public = self.messages_public
+
+        return {
+            "broadcasts": len(self.messages_public),
+            "broadcasts_trimmed": self.messages_public.start,
+            "entries": sum(len(log.messages) for log in logs),
+            "keys": len(self.state),
+            "bytes": sum(log.bytes for log in logs) + public.bytes +
+                     sum(m.size() for position, q, m in self.state.values() if position < public.start)
+        }
+
+    # The running totals of log_stats() worked out from scratch, for rooms loaded from the journal
+    def recount(self):
+        for log in [self] + self.players.list():
+            log.bytes = sum(m.size() for q, public, m in log.messages)
+        self.messages_public.bytes = sum(m.size() for m in self.messages_public.messages if m is not None)
+
     # Disconnect everyone and send a specific close code
     def close_server(self):
         logging.debug(f"Server {self.code} closes all connections")
@@ -93,27 +309,56 @@ class ServerPool:
     Holder for Server classes.
     """
 
-    def __init__(self):
+    def __init__(self, shard=0, shards=1, backplane=None, journal=None):
         self.pool = {}
+        # One CodeAllocator for every prefix that has rooms
+        self.codes = {}
+        # Which worker process this is, and how many there are, see workers.py
+        self.shard = shard
+        self.shards = shards
+        # Every code in the pool, kept sorted so the inspector can page through them
+        self.sorted = []
+        # Lets sockets connected to other nodes into the rooms here, see backplane.py
+        self.backplane = backplane
+        # Writes down rooms coming and going, so they survive a restart, see journal.py
+        self.journal = journal
 
     def __contains__(self, what):
         return what in self.pool
 
-    def _gen_code(self, prefix: str):
-        x = "".join(random.choices(string.ascii_uppercase, k=4))
-        if not prefix+x in self:
-            return x
-        else:
-            return None
+    # Returns None when all codes of the prefix are taken
+    def create_server(self, limit: int, prefix="", compress=True):
+        if not prefix in self.codes:
+            self.codes[prefix] = CodeAllocator(self.shard, self.shards)
 
-    def create_server(self, limit: int, prefix=""):
-        code = None
-        while not code:
-            code = self._gen_code(prefix)
+        code = self.codes[prefix].allocate()
+        if not code:
+            logging.error(f"ServerPool ran out of codes for prefix '{prefix}'")
+            return None
 
-        self.pool[prefix+code] = Server(prefix+code, limit)
+        self.pool[prefix+code] = Server(prefix+code, limit, compress)
+        bisect.insort(self.sorted, prefix+code)
+        if self.backplane:
+            self.backplane.host(self.pool[prefix+code])
+        if self.journal:
+            self.journal.created(self.pool[prefix+code])
         return self.pool[prefix+code]
 
+    # Puts back rooms that were recovered from the journal, their codes stay theirs
+    def restore(self, servers):
+        by_prefix = {}
+        for code, server in servers.items():
+            self.pool[code] = server
+            by_prefix.setdefault(code[:-4], []).append(code[-4:])
+            if self.backplane:
+                self.backplane.host(server)
+        self.sorted = sorted(self.pool)
+
+        for prefix, codes in by_prefix.items():
+            if not prefix in self.codes:
+                self.codes[prefix] = CodeAllocator(self.shard, self.shards)
+            self.codes[prefix].reserve(codes)
+
     def get_server_safe(self, server):
         if not server in self.pool:
             return None
@@ -126,3 +371,38 @@ class ServerPool:
                 f"ServerPool tried to free {server}, but this server is not present. Did an earlier check fail?")
         else:
             self.pool.pop(server)
+            del self.sorted[bisect.bisect_left(self.sorted, server)]
+            if self.backplane:
+                self.backplane.unhost(server)
+            if self.journal:
+                self.journal.closed(server)
+
+            prefix = server[:-4]
+            self.codes[prefix].release(server[-4:])
+            if not len(self.codes[prefix]):
+                self.codes.pop(prefix)
+
+    # Rooms whose code comes after the cursor, in order of their codes.
+    # At most `budget` rooms are looked at, no matter how few of them pass
+    # the filter, so a single request never holds up the IOLoop for long.
+    # Returns the rooms and the cursor to continue from, None when there are no more
+    def page(self, cursor="", prefix="", limit=50, budget=1000, match=None):
+        i = max(bisect.bisect_right(self.sorted, cursor),
+                bisect.bisect_left(self.sorted, prefix))
+
+        found = []
+        scanned = 0
+        while i < len(self.sorted) and len(found) < limit and scanned < budget:
+            code = self.sorted[i]
+            if not code.startswith(prefix):
+                return found, None
+
+            server = self.pool[code]
+            if match is None or match(server):
+                found.append(server)
+            i += 1
+            scanned += 1
+
+        if i >= len(self.sorted) or not self.sorted[i].startswith(prefix):
+            return found, None
+        return found, self.sorted[i - 1]
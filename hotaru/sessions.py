@@ -0,0 +1,422 @@
+import itertools
+
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+
+from hotaru import messages
+from hotaru import exceptions
+from hotaru import ratelimit
+from hotaru.players import Player
+from hotaru.protocols import PROTOCOLS
+
+import time
+
+"""
+What a connection does inside a room, no matter where its socket is.
+"""
+
+# Longest a client may ask us to hold its messages back for, in milliseconds
+BATCH_WINDOW_LIMIT = 50
+
+
+class Session:
+    """
+    Joining a room, the commands sent to it and the messages received from it.
+    HotaruWebsocket is a Session for a socket connected to this process,
+    backplane.RemoteSession is one for a socket connected to another node.
+    Subclasses provide application, metrics, connected, write_message() and close().
+    """
+
+    # Resolved once in join(), these stay None if the client was turned away
+    server = None
+    player = None
+    is_owner = False
+
+    # Clients that connect with ?batch=<ms> get their inbound messages coalesced,
+    # see write_inbound. None means every message goes out on its own
+    batch = None
+
+    # Wire format, picked in join() by the version in the URL, see protocols.py
+    protocol = PROTOCOLS["v0"]
+
+    # Flow control of the socket, if this process has one, see outbound.py
+    outbound = None
+
+    # Rate limits of this connection, if the application has any, see ratelimit.py
+    buckets = None
+
+    # While a long repeat is being encoded, everything else for this client
+    # waits here, as (q, message) or (None, frame), see encode_later
+    held = None
+
+    # Everything a client sends in its URL when it connects
+    def join(self, version: str, code: str, player_name=None, su=None, batch=None):
+        if not version in PROTOCOLS:
+            self.close(code=exceptions.BreakingApiChange())
+            return
+        self.protocol = PROTOCOLS[version]
+
+        server = self.application.pool.get_server_safe(code)
+        player = None
+        if server and player_name:
+            player = server.get_player_safe(player_name)
+        if su and not player_name:
+            player = server
+
+        if batch is not None:
+            try:
+                self.batch = min(max(int(batch), 0), BATCH_WINDOW_LIMIT)
+            except ValueError:
+                self.batch = 0
+            self.batched = []
+
+        # Check for errors in the connection and kick the client if necessary
+
+        if not server:
+            self.close(code=exceptions.ServerCodeDoesntExist())
+            return
+
+        registering = player_name and not su
+        logging_in = player_name and su
+        owner_connecting = su and not player_name
+
+        if registering:
+            if server.lock:
+                self.close(code=exceptions.ServerIsLocked())
+
+            elif server.players.count() == server.limit:
+                self.close(code=exceptions.RoomLimitReached())
+
+            elif player:
+                self.close(code=exceptions.NameIsTaken())
+
+            elif player_name == "":
+                self.close(code=exceptions.NamePropertyIsEmpty())
+
+            else:
+                p = Player(player_name, self)
+                server.register(p)
+                self.bind(server, p)
+                if self.application.journal:
+                    self.application.journal.registered(server, p)
+
+        elif logging_in:
+            if not player:
+                self.close(code=exceptions.NameDoesntExist())
+
+            elif player.su != su:
+                self.close(code=exceptions.SuCodeMismatch())
+
+            # The player name exists and the code is correct
+            elif player.su == su:
+                try:
+                    player.client.close(code=exceptions.Overridden())
+                except:
+                    pass
+                player.client = self
+                self.bind(server, player)
+
+                join = messages.UserJoin(player)
+                server.write_message(join)
+                if self.application.journal:
+                    self.application.journal.joined(server, player)
+
+        elif owner_connecting:
+            if server.su != su:
+                self.close(code=exceptions.SuAdminCodeMismatch())
+
+            # The code checks out
+            else:
+                try:
+                    server.client.close(code=exceptions.Overridden())
+                except:
+                    pass
+                server.client = self
+                self.bind(server, server)
+
+    # Players deliver their messages through here
+    def write_inbound(self, q: int, message):
+        if self.held is not None:
+            self.held.append((q, message))
+            return
+
+        if self.batch is None:
+            started = time.perf_counter()
+            frame = self.protocol.inbound(q, message)
+            self.metrics.encode.observe(time.perf_counter() - started)
+            return self.write_message(frame)
+
+        # Everything sent during this IOLoop tick, or during the window the client
+        # asked for, goes out together in a single frame
+        if not self.batched:
+            if self.batch:
+                tornado.ioloop.IOLoop.current().call_later(
+                    self.batch / 1000, self.flush_batch)
+            else:
+                tornado.ioloop.IOLoop.current().add_callback(self.flush_batch)
+        self.batched.append((q, message))
+
+    def flush_batch(self):
+        batched = self.batched
+        if not batched:
+            return
+        self.batched = []
+
+        started = time.perf_counter()
+        if len(batched) == 1:
+            frame = self.protocol.inbound(*batched[0])
+        else:
+            frame = self.protocol.batch(batched)
+        self.metrics.encode.observe(time.perf_counter() - started)
+
+        try:
+            self.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    # Replies to the client's commands, after the repeat that is being encoded if there is one
+    def write_reply(self, frame):
+        if self.held is not None:
+            self.held.append((None, frame))
+        else:
+            self.write_message(frame)
+
+    # Goes through a long repeat and encodes it a chunk at a time, the IOLoop handles
+    # everything else in between. Then it's written, and whatever was held back in the
+    # meantime after it
+    def encode_later(self, start, length: int, repeat, next: int):
+        self.held = []
+        chunk = self.application.repeat_chunk
+
+        async def encode():
+            try:
+                chunks = []
+                while True:
+                    items = list(itertools.islice(repeat, chunk))
+                    if not items:
+                        break
+                    chunks.append(self.protocol.encode_items(items))
+                    await tornado.gen.sleep(0)
+                if self.connected:
+                    self.write_message(self.protocol.repeated(start, length, chunks, next))
+            finally:
+                held, self.held = self.held, None
+                for q, message in held:
+                    if not self.connected:
+                        break
+                    if q is None:
+                        self.write_message(message)
+                    else:
+                        self.write_inbound(q, message)
+
+        return tornado.gen.convert_yielded(encode())
+
+    # Remember who is on the other end of this connection for all of the frames to come
+    def bind(self, server, player):
+        self.server = server
+        self.player = player
+        server.connections += 1
+        server.last_active = time.monotonic()
+        player.set_online(True)
+
+        limits = self.application.rate_limits
+        if limits:
+            self.buckets = limits.connection()
+            if server.buckets is None:
+                server.buckets = limits.room()
+        # player.name is a 1 only if it's the server owner, see servers.py.
+        # This is for legacy reasons and how Hotaru was implemented
+        # before the rewrite and open-sourcing.
+        self.is_owner = player.name == 1
+
+    # We notify the server owner about the disconnection
+    def left(self, close_code):
+        if self.server:
+            self.server.connections -= 1
+            self.server.last_active = time.monotonic()
+
+        # Someone else logged in as this player in the meantime, they're still here
+        if not self.player or self.player.client is not self:
+            return
+        self.player.set_online(False)
+
+        # Clients that close without a code left on purpose, like those that close with 1000.
+        # Connections that stopped answering pings leave with 1006, see keepalive.py.
+        # The room may also be gone already
+        if close_code and close_code != 1000 and close_code < 4000:
+            if self.server.code in self.application.pool:
+                left = messages.UserLeft(self.player)
+                self.server.write_message(left)
+                if self.application.journal:
+                    self.application.journal.left(self.server, self.player)
+
+    # Responsible for delivering messages. "to" can also be a group or a list of
+    # names, and the owner's broadcasts may have a "key", only the latest of every key is repeated
+    def _send_message(self, server, player, actual_message):
+        key = actual_message.get("key")
+        received = server.chat(player, actual_message["to"], actual_message["content"], key)
+        if self.application.journal:
+            self.application.journal.chatted(
+                server, player, actual_message["to"], actual_message["content"], key)
+
+        self.metrics.fanout.observe(received)
+
+    # Handles a frame the client sent
+    def handle(self, message):
+
+        # We discard any packet with a length less than or equal to 1.
+        # This is for Heroku, it likes to disconnect those that it deems inactive.
+        # Clients used to send a whitespace every 5 seconds or so, nowadays Hotaru
+        # can ping them instead, see ping_interval in hotaru.py
+        if len(message) <= 1:
+            return
+
+        server = self.server
+        player = self.player
+        if not player:
+            return
+        server.last_active = time.monotonic()
+
+        # Too large to even be parsed
+        limits = self.application.rate_limits
+        if limits and limits.too_large(len(message)):
+            return self.over_limit(limits, "frame too large")
+
+        try:
+            message_command, actual_message = self.protocol.parse(message)
+        except exceptions.InvalidPayload:
+            self.write_reply(self.protocol.dumps({
+                "type": "error",
+                "error": "invalid payload"
+            }))
+            return None
+        self.metrics.command(message_command)
+
+        if limits:
+            if message_command == "chats" and isinstance(actual_message, list) \
+                    and limits.too_many(actual_message):
+                return self.over_limit(limits, "too many chats")
+
+            wait = limits.admit(self.buckets, server.buckets, len(message),
+                                message_command == "repeat")
+            if wait:
+                if limits.policy != ratelimit.DELAY:
+                    return self.over_limit(limits)
+                limits.delayed += 1
+                return tornado.gen.convert_yielded(
+                    self.run_later(wait, message_command, actual_message))
+
+        return self.run(message_command, actual_message)
+
+    # A frame that is over the rate limits. Frames that waiting doesn't help with
+    # come with an error, the client is told about those instead of the frame
+    # going missing, even under DELAY
+    def over_limit(self, limits, error=None):
+        if limits.policy == ratelimit.CLOSE:
+            # Frames that were already on their way when it was closed
+            if self.connected:
+                limits.disconnected += 1
+                self.close(code=exceptions.RateLimited())
+        else:
+            limits.dropped += 1
+            if error:
+                self.write_reply(self.protocol.dumps({
+                    "type": "error",
+                    "error": error
+                }))
+
+    # Under DELAY, the frame is handled once the limits allow it.
+    # Local sockets aren't read from in the meantime
+    async def run_later(self, wait: float, message_command, actual_message):
+        await tornado.gen.sleep(wait)
+        if self.connected:
+            waiting = self.run(message_command, actual_message)
+            if waiting:
+                await waiting
+
+    # Does what a frame says
+    def run(self, message_command, actual_message):
+        server = self.server
+        player = self.player
+        # Only what this frame sends can hold up this client, see the end
+        self.application.backpressure.collect()
+
+        if message_command == "lock" and self.is_owner:
+            server.lock = True
+            if self.application.journal:
+                self.application.journal.locked(server)
+
+        if message_command == "unlock" and self.is_owner:
+            server.lock = False
+            if self.application.journal:
+                self.application.journal.locked(server)
+
+        # Sets who is in a group of players, so that chat messages can be sent
+        # to all of them at once with the group's name in "to", see servers.Group
+        if message_command == "group" and self.is_owner:
+            if isinstance(actual_message, dict) and isinstance(actual_message.get("name"), str):
+                names = [n for n in actual_message.get("players") or [] if isinstance(n, str)]
+                server.set_group(actual_message["name"], names)
+                if self.application.journal:
+                    self.application.journal.grouped(server, actual_message["name"], names)
+
+        # Who is connected right now, and for how long they've been (dis)connected
+        if message_command == "presence" and self.is_owner:
+            now = time.monotonic()
+            self.write_message(self.protocol.dumps({
+                "type": "presence",
+                "players": {
+                    p.name: {"online": p.online, "since": round(now - p.since, 1)}
+                    for p in server.players.list()
+                }
+            }))
+
+        # Send a message.
+        if message_command == "chat":
+            self._send_message(server, player, actual_message)
+
+        # Identical behavior to sending multiple "chat" commands with different contents.
+        # Instead, the content is an array of what we would have sent individually
+        elif message_command == "chats":
+            for ms in actual_message:
+                self._send_message(server, player, ms)
+
+        # Have you lost a packet? Does your "q" number not match? Fear not, for we have a solution!
+        # Call 1-800-REPEAT to receive a copy of all messages that have been sent to you after a specified packet!
+        # Keyed broadcasts that were replaced aren't repeated, so there can be fewer messages
+        # than q numbers in between. "next" is the q of the next message the client gets
+        elif message_command == "repeat":
+            try:
+                length, repeat = player.repeat_messages(actual_message)
+                if self.held is None and length > self.application.repeat_chunk:
+                    # It's only written to this client, it can't have held up anyone else
+                    self.application.backpressure.take_waiting()
+                    return self.encode_later(actual_message, length, repeat, player.next)
+                self.write_reply(self.protocol.repeated(
+                    actual_message, length, [self.protocol.encode_items(repeat)], player.next))
+            except exceptions.LogTrimmed as e:
+                self.write_reply(self.protocol.dumps(
+                    {
+                        "type": "error",
+                        "error": "trimmed",
+                        "start": actual_message,
+                        "first": e.args[0]
+                    }))
+            except:
+                pass
+
+        # The client has safely received everything before this "q".
+        # Older messages get freed, so they can't be repeated afterwards
+        elif message_command == "ack":
+            if isinstance(actual_message, int):
+                server.acknowledge(player, actual_message,
+                                   self.application.ack_margin)
+                if self.application.journal:
+                    self.application.journal.acked(server, player, actual_message)
+
+        # Under the "block" policy, we stop reading from this client
+        # until everyone it just sent to has caught up, see outbound.py
+        waiting = self.application.backpressure.take_waiting()
+        if waiting:
+            return tornado.gen.multi([o.wait_drained() for o in set(waiting)])
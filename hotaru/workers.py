@@ -0,0 +1,270 @@
+import array
+import atexit
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import urllib.parse
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.process
+
+from hotaru import codec
+from hotaru.codes import shard_of
+
+"""
+Running Hotaru as several worker processes.
+Every worker owns the rooms whose code falls into its shard, see codes.shard_of.
+All workers accept connections on the same port (SO_REUSEPORT) and look at the
+request line. Connections for a room of another shard are handed over to its
+worker as a file descriptor, so nothing is proxied and the owner talks to the
+client directly.
+
+closeServer and closeServers are sent on to the workers of the rooms, see
+Router.forward. The inspector and /metrics only describe the worker that answers,
+/inspect?shard=N and /metrics?shard=N ask worker N, every worker has to be
+scraped on its own.
+"""
+
+# How much of a request we look at to route it, and for how long
+PEEK_LIMIT = 8192
+PEEK_TIMEOUT = 10
+
+# A busy worker's inbox can be full, hand-overs to it are tried again after
+# HAND_OVER_RETRY seconds, twice as long every time up to HAND_OVER_BACKOFF.
+# After HAND_OVER_TIMEOUT seconds, this worker answers the request itself
+HAND_OVER_RETRY = 0.001
+HAND_OVER_BACKOFF = 0.1
+HAND_OVER_TIMEOUT = 5
+
+
+# Worker that should handle a request, from its path and query. Without a room code,
+# "shard" in the query picks one. None means any worker can, for instance createServer,
+# which makes a room in the worker's own shard
+def route(target: str, shards: int):
+    path, _, query = target.partition("?")
+    arguments = urllib.parse.parse_qs(query)
+    code = None
+
+    if path.startswith("/ws/") or path.startswith("/hotaru/"):
+        code = arguments.get("code", [None])[0]
+    elif path.startswith("/inspect/"):
+        code = path.split("/")[2]
+
+    if code:
+        return shard_of(code, shards)
+    shard = arguments.get("shard", [""])[0]
+    if shard.isdigit() and int(shard) < shards:
+        return int(shard)
+    return None
+
+
+# The parent only waits for its workers. A SIGTERM it gets goes on to every one of them,
+# so each drains its own rooms, see drain.py. Workers that exit cleanly aren't started
+# again, and the parent exits after the last one
+def forward_sigterm(directory: str):
+    for name in os.listdir(directory):
+        if name.endswith(".pid"):
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    os.kill(int(f.read()), signal.SIGTERM)
+            except (OSError, ValueError):
+                pass
+
+
+# Forks into one process per shard and returns (shard, inbox, inboxes) in each of them.
+# The inboxes are where the workers receive connections from each other, they're
+# made before forking so none of them can be missing when the first hand-over comes.
+# Their directory goes away when the parent exits, after the last worker
+def fork(shards: int):
+    directory = tempfile.mkdtemp(prefix="hotaru-")
+    parent = os.getpid()
+    atexit.register(lambda: os.getpid() == parent and shutil.rmtree(directory, ignore_errors=True))
+    inboxes = [os.path.join(directory, f"worker{i}.sock") for i in range(shards)]
+
+    sockets = []
+    for path in inboxes:
+        inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        inbox.bind(path)
+        inbox.setblocking(False)
+        sockets.append(inbox)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: forward_sigterm(directory))
+    shard = tornado.process.fork_processes(shards)
+    # Workers drain on SIGTERM themselves, see server.py. The parent finds them by their pid files
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    with open(os.path.join(directory, f"worker{shard}.pid"), "w") as f:
+        f.write(str(os.getpid()))
+    for i, inbox in enumerate(sockets):
+        if i != shard:
+            inbox.close()
+    return shard, sockets[shard], inboxes
+
+
+class Router:
+    """
+    Accepts connections on the shared port and hands each one to the worker
+    that owns its room. Keep-alive is off for plain requests, so a connection
+    is always a single request, or a single WebSocket.
+    """
+
+    def __init__(self, app, shard: int, inbox: socket.socket, inboxes: list):
+        app.router = self
+        self.shard = shard
+        self.shards = len(inboxes)
+        self.inbox = inbox
+        self.inboxes = inboxes
+        # Never blocks, a full inbox of another worker mustn't stop this one, see hand_over
+        self.outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox.setblocking(False)
+
+        # Neither of these listens by itself, they only get the connections that belong here.
+        # Tornado can't upgrade to a WebSocket without keep-alive, hence the two of them
+        self.websockets = tornado.httpserver.HTTPServer(app)
+        self.requests = tornado.httpserver.HTTPServer(app, no_keep_alive=True)
+
+        # Connections handed over and received since the start, and hand-overs
+        # that had to wait for a full inbox
+        self.handed_over = 0
+        self.received = 0
+        self.retried = 0
+
+        # Where the workers accept connections, see forward
+        self.port = None
+        self.address = None
+
+    def listen(self, port: int, address=""):
+        self.port = port
+        self.address = address or "127.0.0.1"
+        io_loop = tornado.ioloop.IOLoop.current()
+        for sock in tornado.netutil.bind_sockets(port, address, reuse_port=True):
+            tornado.netutil.add_accept_handler(sock, self.accepted)
+        io_loop.add_handler(self.inbox.fileno(), self.receive, io_loop.READ)
+
+    def accepted(self, connection: socket.socket, address):
+        connection.setblocking(False)
+        deadline = tornado.ioloop.IOLoop.current().call_later(
+            PEEK_TIMEOUT, self.give_up, connection)
+        self.wait(connection, address, deadline)
+
+    def wait(self, connection: socket.socket, address, deadline):
+        # Given up on in the meantime
+        if connection.fileno() == -1:
+            return
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.add_handler(connection.fileno(),
+                            lambda fd, events: self.peek(connection, address, deadline),
+                            io_loop.READ)
+
+    # The client never sent a request line
+    def give_up(self, connection: socket.socket):
+        tornado.ioloop.IOLoop.current().remove_handler(connection.fileno())
+        connection.close()
+
+    # Reads the request line and headers without taking them off the socket,
+    # whoever handles the connection reads the request from the start
+    def peek(self, connection: socket.socket, address, deadline):
+        io_loop = tornado.ioloop.IOLoop.current()
+        try:
+            head = connection.recv(PEEK_LIMIT, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            head = b""
+
+        if head and b"\r\n\r\n" not in head and len(head) < PEEK_LIMIT:
+            # Only part of the headers are here, try again once more of them arrived
+            io_loop.remove_handler(connection.fileno())
+            io_loop.call_later(0.01, self.wait, connection, address, deadline)
+            return
+
+        io_loop.remove_handler(connection.fileno())
+        io_loop.remove_timeout(deadline)
+        if not head:
+            connection.close()
+            return
+
+        lines = head.split(b"\r\n\r\n", 1)[0].split(b"\r\n")
+        request = lines[0].split(b" ")
+        upgrade = any(line.lower().startswith(b"upgrade:") for line in lines[1:])
+
+        shard = None
+        if len(request) == 3:
+            shard = route(request[1].decode("latin-1"), self.shards)
+
+        if shard is None or shard == self.shard:
+            self.handle(connection, address, upgrade)
+        else:
+            self.hand_over(connection, address, upgrade, shard)
+
+    def hand_over(self, connection: socket.socket, address, upgrade: bool, shard: int,
+                  delay=HAND_OVER_RETRY, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + HAND_OVER_TIMEOUT
+        try:
+            # socket.send_fds would be the obvious choice, but it ignores the address
+            self.outbox.sendmsg([codec.compact([address, upgrade]).encode()],
+                               [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                 array.array("i", [connection.fileno()]))],
+                               0, self.inboxes[shard])
+        except BlockingIOError:
+            # Its inbox is full, the other worker is busy. Two workers handing over
+            # to each other would wait for one another forever if this blocked
+            if time.monotonic() < deadline:
+                self.retried += 1
+                tornado.ioloop.IOLoop.current().call_later(
+                    delay, self.hand_over, connection, address, upgrade, shard,
+                    min(delay * 2, HAND_OVER_BACKOFF), deadline)
+                return
+            logging.error(f"Worker {shard} didn't take a connection for {HAND_OVER_TIMEOUT} s")
+            self.handle(connection, address, upgrade)
+            return
+        except OSError as e:
+            # The other worker is gone, this one answers instead. The room won't be here
+            logging.error(f"Couldn't hand a connection over to worker {shard}: {e}")
+            self.handle(connection, address, upgrade)
+            return
+
+        connection.close()
+        self.handed_over += 1
+
+    def receive(self, fd, events):
+        while True:
+            try:
+                message, fds, flags, sender = socket.recv_fds(self.inbox, 1024, 1)
+            except BlockingIOError:
+                return
+
+            for received in fds:
+                connection = socket.socket(fileno=received)
+                connection.setblocking(False)
+                address, upgrade = codec.loads(message)
+                self.received += 1
+                self.handle(connection, tuple(address), upgrade)
+
+    # Worker of the room with this code, None if it's this one or the code isn't a room code
+    def owner(self, code: str):
+        shard = shard_of(code, self.shards)
+        if shard == self.shard:
+            return None
+        return shard
+
+    # Requests about rooms of another worker that can't be routed by their request line,
+    # like closeServers, are sent on to it over the shared port. "shard" in the query
+    # takes them there, see route()
+    async def forward(self, shard: int, path: str, method: str, body=None, **arguments):
+        arguments["shard"] = shard
+        url = f"http://{self.address}:{self.port}{path}?{urllib.parse.urlencode(arguments)}"
+        return await tornado.httpclient.AsyncHTTPClient().fetch(
+            url, method=method, body=body, raise_error=False, allow_nonstandard_methods=True)
+
+    def handle(self, connection: socket.socket, address, upgrade: bool):
+        server = self.websockets if upgrade else self.requests
+        server.handle_stream(tornado.iostream.IOStream(connection), address)
@@ -2,24 +2,138 @@
 import tornado.ioloop
 import os
 import logging
+import signal
 
 from hotaru import Hotaru
+from hotaru import workers
+from hotaru.backplane import BrokerBackplane
+from hotaru.journal import Journal
+from hotaru.ratelimit import RateLimits
 
 ENABLE_INSPECT = True
+# Prometheus metrics at /metrics
+ENABLE_METRICS = True
+# How many acknowledged messages are still kept around for repeats
+ACK_MARGIN = 32
+# How many bytes a connection may have waiting to be sent before it's throttled,
+# and what happens then: "drop", "close" or "block", see hotaru/outbound.py
+HIGH_WATER = 1 << 20
+SLOW_CONSUMER_POLICY = "drop"
+# permessage-deflate, frames shorter than COMPRESSION_MIN_SIZE are sent as they are.
+# Game traffic is mostly small frames sharing their keys, skipping the ones under 256 bytes
+# only saves 28% instead of 89%, see benchmarks/compression.py.
+# Rooms can still opt out with createServer?compress=0
+COMPRESS = True
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEM_LEVEL = 8
+COMPRESSION_MIN_SIZE = 0
+# Rooms nobody is connected to get closed after this many idle seconds, None keeps them forever
+ROOM_TTL = 30 * 60
+# Hotaru pings every connection this often and closes it if there's no answer within
+# PING_TIMEOUT seconds. Shorter than the 55 idle seconds after which Heroku drops connections
+PING_INTERVAL = 25
+PING_TIMEOUT = 10
+# Worker processes, each one owns the rooms of its own shard, see hotaru/workers.py.
+# The inspector and /metrics describe one worker each, /metrics?shard=N asks worker N
+WORKERS = int(os.environ.get("WORKERS", 1))
+# "host:port" of a broker speaking the Redis protocol, so players can join rooms
+# of other nodes, see hotaru/backplane.py. Without one, nodes only see their own rooms
+BROKER = os.environ.get("BROKER")
+# Directory where rooms are written down so they survive restarts, None keeps them in memory only.
+# Records are synced every JOURNAL_FSYNC_INTERVAL seconds, see hotaru/journal.py
+JOURNAL = os.environ.get("JOURNAL")
+JOURNAL_FSYNC_INTERVAL = 1.0
+JOURNAL_COMPACT_AFTER = 100000
+# What a single connection, and a whole room, may send per second. None means no limit,
+# which is the default. Something like 50 messages, 256 KiB and 2 repeats per connection,
+# and 1000 messages, 4 MiB and 50 repeats per room, leaves normal clients alone.
+# Frames over the limits are handled as RATE_LIMIT_POLICY says: "drop", "delay" or "close",
+# see hotaru/ratelimit.py. Longer frames, and "chats" with more messages, are never handled,
+# the client gets an error instead unless the policy is "close"
+RATE_LIMIT_MESSAGES = None
+RATE_LIMIT_BYTES = None
+RATE_LIMIT_REPEATS = None
+RATE_LIMIT_ROOM_MESSAGES = None
+RATE_LIMIT_ROOM_BYTES = None
+RATE_LIMIT_ROOM_REPEATS = None
+RATE_LIMIT_POLICY = "delay"
+MAX_FRAME = None
+MAX_CHATS = None
+# Repeats of more messages than this are encoded in chunks of that many, so other rooms
+# don't have to wait for them. Frames are parsed, and the journal and backplane written,
+# with orjson when it's installed. HOTARU_CODEC=json in the environment sticks to the
+# json module, see hotaru/codec.py
+REPEAT_CHUNK = 1000
+# On SIGTERM, what was already sent gets to go out and every connection is closed with 4020,
+# all within this many seconds. New rooms are turned away in the meantime, see hotaru/drain.py
+DRAIN_TIMEOUT = 10
 
 logging.basicConfig(
     format='%(name)s/%(levelname)s: %(message)s',
-    level=logging.DEBUG
+    level=os.environ.get("LOG_LEVEL", "DEBUG")
 )
 
 
+def make_app(shard=0, shards=1):
+    backplane = None
+    if BROKER:
+        address, port = BROKER.rsplit(":", 1)
+        backplane = BrokerBackplane(address, int(port))
+        tornado.ioloop.IOLoop.current().run_sync(backplane.connect)
+
+    journal = None
+    if JOURNAL:
+        # Every worker has its own rooms, and its own journal
+        journal = Journal(os.path.join(JOURNAL, f"shard{shard}"),
+                          JOURNAL_FSYNC_INTERVAL, JOURNAL_COMPACT_AFTER)
+
+    rate_limits = None
+    limits = (RATE_LIMIT_MESSAGES, RATE_LIMIT_BYTES, RATE_LIMIT_REPEATS,
+              RATE_LIMIT_ROOM_MESSAGES, RATE_LIMIT_ROOM_BYTES, RATE_LIMIT_ROOM_REPEATS,
+              MAX_FRAME, MAX_CHATS)
+    if any(limit is not None for limit in limits):
+        rate_limits = RateLimits(*limits, RATE_LIMIT_POLICY)
+
+    return Hotaru(do_inspect=ENABLE_INSPECT, do_metrics=ENABLE_METRICS,
+                  ack_margin=ACK_MARGIN, high_water=HIGH_WATER,
+                  slow_consumer_policy=SLOW_CONSUMER_POLICY,
+                  compress=COMPRESS, compression_level=COMPRESSION_LEVEL,
+                  compression_mem_level=COMPRESSION_MEM_LEVEL,
+                  compression_min_size=COMPRESSION_MIN_SIZE, room_ttl=ROOM_TTL,
+                  shard=shard, shards=shards, backplane=backplane,
+                  journal=journal, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT,
+                  rate_limits=rate_limits, repeat_chunk=REPEAT_CHUNK)
+
+
+# Deploys stop the process with SIGTERM, it drains first and exits afterwards
+def drain_on_sigterm(app):
+    loop = tornado.ioloop.IOLoop.current()
+
+    async def shutdown():
+        await app.shutdown(DRAIN_TIMEOUT)
+        loop.stop()
+
+    loop.asyncio_loop.add_signal_handler(signal.SIGTERM, lambda: loop.spawn_callback(shutdown))
+
+
 def main():
-    app = Hotaru(do_inspect=ENABLE_INSPECT)
     port = os.environ.get("PORT")
     if not port:
         port = 8000
-    logging.info("Starting Hotaru on port {0}".format(port))
-    app.listen(port)
+
+    if WORKERS > 1:
+        # Everything after this runs once in every worker
+        shard, inbox, inboxes = workers.fork(WORKERS)
+        logging.info("Starting Hotaru worker {0} on port {1}".format(shard, port))
+        app = make_app(shard, WORKERS)
+        router = workers.Router(app, shard, inbox, inboxes)
+        router.listen(int(port))
+    else:
+        logging.info("Starting Hotaru on port {0}".format(port))
+        app = make_app()
+        app.listen(port)
+
+    drain_on_sigterm(app)
     tornado.ioloop.IOLoop.current().start()
 
 
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru import backplane
+from hotaru.backplane import Backplane, BrokerBackplane
+from hotaru.broker import Broker
+
+"""
+Two nodes connected through the stand-in broker. A node that loses the broker
+connects to it again, and sockets aren't left waiting while it's gone.
+"""
+
+
+class RecordingBroker(Broker):
+    """
+    Keeps the connections, so the test can cut them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.streams = []
+
+    async def handle_stream(self, stream, address):
+        self.streams.append(stream)
+        await super().handle_stream(stream, address)
+
+    def cut(self):
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+
+
+def test_transports_have_to_provide_every_method():
+    with pytest.raises(TypeError):
+        Backplane()
+
+
+class BrokerTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        sock, self.broker_port = tornado.testing.bind_unused_port()
+        self.broker = RecordingBroker()
+        self.broker.add_sockets([sock])
+
+        self.other = Hotaru(do_inspect=False, do_metrics=False,
+                            backplane=BrokerBackplane(port=self.broker_port))
+        return Hotaru(do_inspect=False, do_metrics=False,
+                      backplane=BrokerBackplane(port=self.broker_port))
+
+    def setUp(self):
+        super().setUp()
+        self.io_loop.run_sync(self._app.backplane.connect)
+        self.io_loop.run_sync(self.other.backplane.connect)
+        sock, self.other_port = tornado.testing.bind_unused_port()
+        self.other_server = tornado.httpserver.HTTPServer(self.other)
+        self.other_server.add_sockets([sock])
+
+    def tearDown(self):
+        self.other_server.stop()
+        self.broker.stop()
+        self.broker.cut()
+        super().tearDown()
+
+    async def connect(self, query, port):
+        return await tornado.websocket.websocket_connect(f"ws://127.0.0.1:{port}/ws/v0?{query}")
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    async def room(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        return json.loads(response.body)
+
+    @tornado.testing.gen_test
+    async def test_nodes_connect_to_the_broker_again(self):
+        room = await self.room()
+        owner = await self.connect(f"code={room['c']}&su={room['su']}", self.get_http_port())
+
+        self.broker.cut()
+        await tornado.gen.sleep(0.5)
+        assert self._app.backplane.connected and self.other.backplane.connected
+
+        # The room hosted before is reachable from the other node again
+        player = await self.connect(f"code={room['c']}&name=player", self.other_port)
+        assert (await self.read(player))["msg"]["type"] == "su"
+        assert (await self.read(owner))["msg"] == {"type": "userappend", "user": "player"}
+        await player.write_message('chat {"to": 1, "content": "back"}')
+        assert (await self.read(owner))["msg"]["am"] == "back"
+
+    @tornado.testing.gen_test
+    async def test_sockets_come_back_later_while_the_broker_is_gone(self):
+        room = await self.room()
+        self.broker.stop()
+        self.broker.cut()
+
+        original = backplane.LINK_TIMEOUT
+        backplane.LINK_TIMEOUT = original / 10
+        try:
+            player = await self.connect(f"code={room['c']}&name=player", self.other_port)
+            assert await player.read_message() is None
+            assert player.close_code == 4020
+        finally:
+            backplane.LINK_TIMEOUT = original
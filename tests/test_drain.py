@@ -0,0 +1,56 @@
+import base64
+import json
+import os
+import tempfile
+
+import tornado.tcpclient
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru.journal import Journal
+
+"""
+Draining with a journal. Connections that don't finish their close handshake
+in time are dropped, and their rooms still write down that they left.
+"""
+
+
+class DrainTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        return Hotaru(do_inspect=False, do_metrics=False, journal=Journal(self.directory, 0.05))
+
+    # A client that does the handshake, then never reads or answers anything again
+    async def silent(self, query):
+        stream = await tornado.tcpclient.TCPClient().connect("127.0.0.1", self.get_http_port())
+        key = base64.b64encode(os.urandom(16)).decode()
+        await stream.write((f"GET /ws/v0?{query} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                            "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        await stream.read_until(b"\r\n\r\n")
+        return stream
+
+    @tornado.testing.gen_test
+    async def test_players_dropped_at_the_deadline_are_written_down(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        room = json.loads(response.body)
+        url = self.get_url(f"/ws/v0?code={room['c']}&name=polite").replace("http://", "ws://")
+        polite = await tornado.websocket.websocket_connect(url)
+        await polite.read_message()
+        stream = await self.silent(f"code={room['c']}&name=dead")
+
+        await self._app.shutdown(0.4)
+        assert self._app.drain.leftover == 1
+        assert await polite.read_message() is None and polite.close_code == 4020
+        stream.close()
+
+        # After the restart, the owner repeats that "dead" left, but not "polite"
+        again = Hotaru(do_inspect=False, do_metrics=False, journal=Journal(self.directory, 0.05))
+        server = again.pool.get_server_safe(room["c"])
+        left = [m for m in server.generate_repeat(0) if m["type"] == "userleft"]
+        assert left == [{"type": "userleft", "user": "dead"}]
+        again.journal.close()
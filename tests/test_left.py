@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+
+"""
+The owner hears about players who left abnormally, not about those who
+closed on purpose, with or without a close code. Connections that stopped
+answering pings are dropped without a close code too, and count as abnormal.
+"""
+
+
+class LeftTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        # Pinged never, the test drops the connection itself
+        return Hotaru(do_inspect=False, do_metrics=False, ping_interval=3600)
+
+    async def connect(self, query):
+        url = self.get_url("/ws/v0?" + query).replace("http://", "ws://")
+        return await tornado.websocket.websocket_connect(url)
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    @tornado.testing.gen_test
+    async def test_only_abnormal_disconnections_are_told(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        room = json.loads(response.body)
+        owner = await self.connect(f"code={room['c']}&su={room['su']}")
+
+        for name, code in (("clean", None), ("normal", 1000), ("going", 1001)):
+            player = await self.connect(f"code={room['c']}&name={name}")
+            assert (await self.read(owner))["msg"] == {"type": "userappend", "user": name}
+            await self.read(player)
+            player.close(code)
+
+        assert (await self.read(owner))["msg"] == {"type": "userleft", "user": "going"}
+
+        dead = await self.connect(f"code={room['c']}&name=dead")
+        await self.read(owner)
+        await self.read(dead)
+        keepalive = self._app.keepalive
+        handler = next(h for h in keepalive.sockets if h.player and h.player.name == "dead")
+        keepalive.drop({handler})
+        assert (await self.read(owner))["msg"] == {"type": "userleft", "user": "dead"}
+
+        # Nothing about the ones that closed on purpose
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(owner.read_message(), 0.2)
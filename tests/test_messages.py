@@ -0,0 +1,50 @@
+import json
+
+import msgpack
+
+from hotaru import messages
+from hotaru.protocols import PROTOCOLS
+from hotaru.players import Player
+
+"""
+Message bodies are serialized once and reused, shadows and repeats splice them
+together instead of serializing dicts. What comes out has to be byte for byte
+what serializing the dicts would have made.
+"""
+
+NAMES = ["player", "plåyer", 2, 1]
+CONTENTS = ["hi", "ünïcode ☃", "\x7f\n\t\"\\u0041", 7, 1.5, None, [1, "two", {"x": []}],
+            {"nested": {"deep": ["é", 2 ** 40]}}, ""]
+
+
+def bodies():
+    for name in NAMES:
+        sender = Player(name, None)
+        for content in CONTENTS:
+            yield messages.RawMessage(sender, content)
+            yield messages.KeyedMessage(sender, content, "böard")
+
+
+def test_shadows_are_cut_out_of_the_message_body():
+    for message in bodies():
+        for to in NAMES:
+            shadow = messages.ShadowOfMessage(Player(to, None), message)
+            assert shadow.encode() == json.dumps(shadow.build())
+            assert shadow.pack(msgpack.packb) == msgpack.packb(shadow.build())
+            assert shadow.size() == message.size() == len(json.dumps(message.build()))
+
+
+def test_repeated_frames_are_the_same_as_serializing_them_whole():
+    repeat = []
+    for message in bodies():
+        repeat += [message, messages.ShadowOfMessage(Player("to", None), message)]
+    repeat.append(messages.State({"böard": ["☃", 1]}))
+
+    text = PROTOCOLS["v0"]
+    chunks = [text.encode_items(repeat[i:i + 7]) for i in range(0, len(repeat), 7)]
+    expected = {"type": "repeated", "start": 3, "repeat": [m.repr() for m in repeat], "next": 9}
+    assert text.repeated(3, len(repeat), chunks, 9) == json.dumps(expected, ensure_ascii=False)
+
+    binary = PROTOCOLS["v1"]
+    chunks = [binary.encode_items(repeat[i:i + 7]) for i in range(0, len(repeat), 7)]
+    assert binary.repeated(3, len(repeat), chunks, 9) == msgpack.packb(expected)
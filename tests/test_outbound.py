@@ -0,0 +1,46 @@
+import json
+
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru import outbound
+
+"""
+Flow control counts what's written to a connection in bytes, the same
+as the high-water mark, also for text frames that aren't ASCII.
+"""
+
+
+class OutboundTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return Hotaru(do_inspect=False, do_metrics=False)
+
+    def setUp(self):
+        super().setUp()
+        self.sizes = []
+        sent = outbound.Outbound.sent
+
+        def record(connection, size, future, started):
+            self.sizes.append(size)
+            return sent(connection, size, future, started)
+
+        outbound.Outbound.sent = record
+        self.addCleanup(setattr, outbound.Outbound, "sent", sent)
+
+    @tornado.testing.gen_test
+    async def test_pending_is_counted_in_bytes(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        room = json.loads(response.body)
+        url = self.get_url(f"/ws/v0?code={room['c']}&name=player").replace("http://", "ws://")
+        player = await tornado.websocket.websocket_connect(url)
+        await player.read_message()
+
+        await player.write_message('chat {"to": 2, "content": "☃☃☃"}')
+        await player.read_message()
+        await player.write_message("repeat 0")
+        repeated = await player.read_message()
+
+        assert "☃☃☃" in repeated
+        assert self.sizes[-1] == len(repeated.encode()) == len(repeated) + 12
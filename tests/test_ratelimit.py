@@ -0,0 +1,84 @@
+import json
+
+import tornado.httpserver
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru.backplane import LocalBackplane
+from hotaru.ratelimit import RateLimits
+
+"""
+Rate limits under DELAY. Frames that waiting doesn't help with get an error
+back, and frames of sockets on another node are handled in order like local ones.
+"""
+
+
+def limits():
+    return RateLimits(repeats=4, max_frame=200, max_chats=3, policy="delay", burst=1.0)
+
+
+class RateLimitTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        # A second node shares the channels, its clients are linked to rooms hosted here
+        channels = {}
+        self.other = Hotaru(do_inspect=False, do_metrics=False, rate_limits=limits(),
+                            backplane=LocalBackplane(channels))
+        return Hotaru(do_inspect=False, do_metrics=False, rate_limits=limits(),
+                      backplane=LocalBackplane(channels))
+
+    def setUp(self):
+        super().setUp()
+        sock, self.other_port = tornado.testing.bind_unused_port()
+        self.other_server = tornado.httpserver.HTTPServer(self.other)
+        self.other_server.add_sockets([sock])
+
+    def tearDown(self):
+        self.other_server.stop()
+        super().tearDown()
+
+    async def connect(self, query, port=None):
+        port = port or self.get_http_port()
+        return await tornado.websocket.websocket_connect(f"ws://127.0.0.1:{port}/ws/v0?{query}")
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    async def room(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        room = json.loads(response.body)
+        owner = await self.connect(f"code={room['c']}&su={room['su']}")
+        return room, owner
+
+    @tornado.testing.gen_test
+    async def test_frames_that_can_never_be_handled_get_an_error(self):
+        room, owner = await self.room()
+        player = await self.connect(f"code={room['c']}&name=player")
+        await self.read(player)
+        await self.read(owner)
+
+        await player.write_message('chat {"to": 1, "content": "%s"}' % ("x" * 200))
+        assert await self.read(player) == {"type": "error", "error": "frame too large"}
+        await player.write_message('chats [{"to": 1, "content": 1}, {"to": 1, "content": 2},'
+                                   ' {"to": 1, "content": 3}, {"to": 1, "content": 4}]')
+        assert await self.read(player) == {"type": "error", "error": "too many chats"}
+
+        await player.write_message('chat {"to": 1, "content": "fine"}')
+        assert (await self.read(owner))["msg"]["am"] == "fine"
+
+    @tornado.testing.gen_test
+    async def test_delayed_frames_of_other_nodes_stay_in_order(self):
+        room, owner = await self.room()
+        player = await self.connect(f"code={room['c']}&name=player", self.other_port)
+        await self.read(player)
+        await self.read(owner)
+
+        # The last repeat waits for the repeat limit, the chat after it doesn't have to,
+        # but it's still handled afterwards, same as on a local socket
+        for i in range(5):
+            await player.write_message("repeat 0")
+        await player.write_message('chat {"to": 2, "content": "after"}')
+        frames = [await self.read(player) for i in range(6)]
+        assert [frame["type"] for frame in frames] == ["repeated"] * 5 + ["inbound"]
+        assert frames[4]["next"] == frames[5]["q"] == 1
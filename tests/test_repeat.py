@@ -0,0 +1,160 @@
+import random
+
+import pytest
+
+from hotaru import exceptions
+from hotaru.players import Player
+from hotaru.servers import Server
+
+"""
+Repeats have to give back exactly what a client was sent from a given "q" on,
+with the shadows of what it sent itself in between, in the order it all happened.
+Every client here writes down what it received, and shadows are written down when
+its player sends something, that is what repeats are compared against.
+"""
+
+
+class RecordingClient:
+    def __init__(self):
+        self.log = []
+
+    def write_inbound(self, q, message):
+        self.log.append((q, message.repr()))
+
+
+def shadow(to, content):
+    return {"type": "shadow", "shadow": {"to": to, "content": content}}
+
+
+class Room:
+    def __init__(self, players=3):
+        self.server = Server("TEST", -1)
+        self.server.client = RecordingClient()
+        self.players = []
+        for i in range(players):
+            self.register(f"player{i}")
+
+    def register(self, name):
+        player = Player(name, RecordingClient())
+        self.server.register(player)
+        self.players.append(player)
+        return player
+
+    # Shadows get the "q" of the next message the sender will receive. Players get
+    # their own broadcasts back before that, the owner writes the shadow down first
+    # and then gets its broadcast with the same "q"
+    def send(self, player, to, content):
+        received = len(player.client.log)
+        q = player.next
+        self.server.chat(player, to, content)
+        if player is self.server and to == 2:
+            player.client.log.insert(received, (q, shadow(to, content)))
+        else:
+            player.client.log.append((player.next, shadow(to, content)))
+
+    # What a repeat from q has to be
+    def expected(self, player, q):
+        return [body for entry_q, body in player.client.log if entry_q >= q]
+
+
+def interleaved(room):
+    owner = room.server
+    first, second, third = room.players
+    owner.set_group("team", [first.name, second.name])
+
+    room.send(owner, 2, "welcome")
+    room.send(first, 1, "ready")
+    room.send(owner, first.name, "your turn")
+    room.send(first, 2, "hello everyone")
+    room.send(owner, "team", {"round": 1})
+    room.send(second, first.name, "psst")
+    room.send(owner, 2, "round 1")
+    room.send(first, 1, {"move": "e4"})
+    room.send(first, 1, {"move": "d4"})
+    room.send(owner, [first.name, third.name], "split")
+    room.send(third, 2, "hi")
+    room.send(owner, 2, "round 2")
+    room.send(owner, first.name, "again")
+
+
+def test_repeat_interleaves_shadows_inbound_and_broadcasts():
+    room = Room()
+    interleaved(room)
+
+    for player in room.players:
+        for q in range(player.next + 1):
+            assert player.generate_repeat(q) == room.expected(player, q), (player.name, q)
+
+
+def test_repeat_of_the_owner():
+    room = Room()
+    interleaved(room)
+
+    owner = room.server
+    for q in range(owner.next + 1):
+        assert owner.generate_repeat(q) == room.expected(owner, q), q
+
+
+def test_repeat_after_ack_trim():
+    room = Room()
+    interleaved(room)
+    owner = room.server
+    first = room.players[0]
+
+    margin = 2
+    acknowledged = first.next - 4
+    owner.acknowledge(first, acknowledged, margin)
+    floor = acknowledged - margin
+    assert first.floor == floor
+
+    with pytest.raises(exceptions.LogTrimmed):
+        first.generate_repeat(floor - 1)
+    for q in range(floor, first.next + 1):
+        assert first.generate_repeat(q) == room.expected(first, q), q
+
+    # What comes after the trim is still merged in the right place
+    room.send(owner, 2, "after the trim")
+    room.send(first, 1, "still here")
+    room.send(owner, first.name, "good")
+    for q in range(floor, first.next + 1):
+        assert first.generate_repeat(q) == room.expected(first, q), q
+
+
+def test_repeat_after_everyone_acknowledged():
+    room = Room()
+    interleaved(room)
+    owner = room.server
+
+    # The shared log can only be trimmed once every player acknowledged
+    for player in room.players:
+        owner.acknowledge(player, player.next, 0)
+    assert owner.messages_public.start > 0
+
+    room.send(owner, 2, "fresh")
+    room.send(room.players[1], 2, "me too")
+    for player in room.players:
+        for q in range(player.floor, player.next + 1):
+            assert player.generate_repeat(q) == room.expected(player, q), (player.name, q)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_repeat_random_interleavings(seed):
+    rng = random.Random(seed)
+    room = Room(4)
+    owner = room.server
+    names = [p.name for p in room.players]
+
+    for i in range(300):
+        sender = rng.choice(room.players + [owner])
+        to = rng.choice([1, 2, rng.choice(names)])
+        if sender is not owner and to == sender.name:
+            to = 1
+        room.send(sender, to, i)
+
+        if rng.random() < 0.1:
+            player = rng.choice(room.players)
+            owner.acknowledge(player, rng.randint(player.floor, player.next), rng.randint(0, 3))
+
+    for player in room.players + [owner]:
+        for q in range(player.floor, player.next + 1):
+            assert player.generate_repeat(q) == room.expected(player, q), (player.name, q)
@@ -0,0 +1,195 @@
+import json
+import random
+
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from test_repeat import Room, shadow
+
+"""
+Keyed broadcasts of the owner replace the one before them with the same key.
+Repeats only have the latest, so they can have fewer messages than q numbers
+in between, and "next" in the "repeated" frame tells the client where it is.
+Players who register after the replaced ones were trimmed get them as a "state".
+"""
+
+
+def msg(content, key="board"):
+    return {"type": "msg", "from": 1, "am": content, "key": key}
+
+
+class KeyedRoom(Room):
+    def __init__(self, players=3):
+        super().__init__(players)
+        # Contents of keyed broadcasts that were replaced since, they're never repeated
+        self.replaced = set()
+        self.latest = {}
+
+    def keyed(self, key, content):
+        owner = self.server
+        received = len(owner.client.log)
+        q = owner.next
+        owner.chat(owner, 2, content, key)
+        owner.client.log.insert(received, (q, shadow(2, content)))
+
+        if key in self.latest:
+            self.replaced.add(self.latest[key])
+        self.latest[key] = content
+
+    def expected(self, player, q):
+        return [body for body in super().expected(player, q)
+                if not (body.get("am") in self.replaced and body["from"] == 1)
+                and not (body["type"] == "shadow" and body["shadow"]["content"] in self.replaced)]
+
+
+def test_keyed_broadcasts_repeat_only_the_latest():
+    room = KeyedRoom()
+    owner = room.server
+    first = room.players[0]
+
+    for i in range(5):
+        room.keyed("board", i)
+
+    # Every one of them took up a q number
+    assert first.next == 6
+    assert first.generate_repeat(1) == [msg(4)]
+    assert first.generate_repeat(5) == [msg(4)]
+    assert first.generate_repeat(6) == []
+    assert owner.generate_repeat(0) == room.expected(owner, 0)
+    assert owner.generate_repeat(0)[-2:] == [shadow(2, 4), msg(4)]
+
+
+def test_keyed_broadcasts_interleaved_with_everything_else():
+    rng = random.Random(7)
+    room = KeyedRoom(4)
+    owner = room.server
+    names = [p.name for p in room.players]
+
+    for i in range(300):
+        if rng.random() < 0.3:
+            room.keyed(rng.choice(["board", "score", "timer"]), i)
+        else:
+            sender = rng.choice(room.players + [owner])
+            to = rng.choice([1, 2, rng.choice(names)])
+            if sender is not owner and to == sender.name:
+                to = 1
+            room.send(sender, to, i)
+
+    for player in room.players + [owner]:
+        for q in range(player.next + 1):
+            assert player.generate_repeat(q) == room.expected(player, q), (player.name, q)
+
+
+def test_players_registering_after_a_supersede():
+    room = KeyedRoom()
+    for i in range(5):
+        room.keyed("board", i)
+
+    late = room.register("late")
+    # The four that were replaced still count, the next broadcast gets the same q for everyone
+    assert late.next == room.players[0].next == 6
+    assert late.generate_repeat(0)[1:] == [msg(4)]
+
+    room.keyed("board", 5)
+    assert late.client.log[-1] == (6, msg(5))
+    assert late.generate_repeat(0)[1:] == [msg(5)]
+
+
+def test_state_of_trimmed_keys_for_players_registering_afterwards():
+    room = KeyedRoom()
+    owner = room.server
+    room.keyed("board", "first")
+    room.keyed("score", {"a": 1})
+    room.keyed("board", "second")
+    room.send(owner, 2, "not keyed")
+
+    # Everything was acknowledged, the shared log is trimmed past all of it
+    for player in room.players:
+        owner.acknowledge(player, player.next, 0)
+    assert owner.messages_public.start == owner.messages_public.end()
+
+    late = room.register("late")
+    state = {"type": "state", "state": {"score": {"a": 1}, "board": "second"}}
+    assert late.generate_repeat(0)[1:] == [state]
+    assert late.client.log[-1][1] == state
+
+    # Once replaced again, the newest one is in the log and the state is what was sent then
+    room.keyed("board", "third")
+    assert late.generate_repeat(0)[1:] == [state, msg("third")]
+
+
+def test_supersede_after_ack_trim():
+    room = KeyedRoom()
+    owner = room.server
+    room.keyed("board", 0)
+    room.send(owner, 2, "in between")
+    room.keyed("board", 1)
+
+    for player in room.players + [owner]:
+        owner.acknowledge(player, player.next, 0)
+    before = owner.log_stats()
+
+    # The one being replaced is gone from every log already
+    room.keyed("board", 2)
+    room.keyed("board", 3)
+    for player in room.players + [owner]:
+        for q in range(player.floor, player.next + 1):
+            assert player.generate_repeat(q) == room.expected(player, q), (player.name, q)
+
+    # The running byte totals match counting them all again
+    stats = owner.log_stats()
+    assert stats["keys"] == 1 and stats["bytes"] > before["bytes"]
+    owner.recount()
+    assert owner.log_stats() == stats
+
+
+class RepeatedFrameTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        # Long repeats are encoded in chunks, they have to say the same
+        return Hotaru(do_inspect=False, do_metrics=False, repeat_chunk=2)
+
+    async def connect(self, query):
+        url = self.get_url("/ws/v0?" + query).replace("http://", "ws://")
+        return await tornado.websocket.websocket_connect(url)
+
+    async def read(self, connection):
+        return json.loads(await connection.read_message())
+
+    @tornado.testing.gen_test
+    async def test_repeated_frame_says_what_comes_next(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        room = json.loads(response.body)
+        owner = await self.connect(f"code={room['c']}&su={room['su']}")
+        player = await self.connect(f"code={room['c']}&name=player")
+        await self.read(player)
+        await self.read(owner)
+
+        for i in range(5):
+            await owner.write_message('chat {"to": 2, "key": "board", "content": %d}' % i)
+            assert (await self.read(player))["q"] == i + 1
+
+        await player.write_message("repeat 1")
+        assert await self.read(player) == {"type": "repeated", "start": 1, "repeat": [msg(4)], "next": 6}
+
+        await player.write_message("repeat 0")
+        repeated = await self.read(player)
+        assert len(repeated["repeat"]) == 2 and repeated["next"] == 6
+
+        late = await self.connect(f"code={room['c']}&name=late")
+        assert (await self.read(late))["q"] == 0
+        await late.write_message("repeat 1")
+        assert await self.read(late) == {"type": "repeated", "start": 1, "repeat": [msg(4)], "next": 6}
+
+        await owner.write_message('chat {"to": 2, "key": "board", "content": 5}')
+        assert (await self.read(late))["q"] == 6
+
+        # Longer than repeat_chunk, encoded a chunk at a time
+        await owner.write_message("repeat 0")
+        frame = await self.read(owner)
+        while frame["type"] != "repeated":
+            frame = await self.read(owner)
+        assert len(frame["repeat"]) > 2
+        await late.write_message('chat {"to": 1, "content": "hi"}')
+        assert (await self.read(owner))["q"] == frame["next"]
@@ -0,0 +1,73 @@
+import json
+
+import msgpack
+import pytest
+import tornado.testing
+import tornado.websocket
+
+from hotaru import Hotaru
+from hotaru import messages
+from hotaru.players import Player
+from hotaru.servers import BroadcastLog
+
+"""
+The binary protocol, against a real application. MessagePack can carry things
+JSON can't, rooms have to turn those away before anything is written down.
+"""
+
+
+class V1Test(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return Hotaru(do_inspect=False, do_metrics=False)
+
+    async def room(self):
+        response = await self.http_client.fetch(self.get_url("/hotaru/v0/createServer"),
+                                                method="POST", body="")
+        return json.loads(response.body)
+
+    async def connect(self, query):
+        url = self.get_url("/ws/v1?" + query).replace("http://", "ws://")
+        return await tornado.websocket.websocket_connect(url)
+
+    async def read(self, connection):
+        return msgpack.unpackb(await connection.read_message())
+
+    @tornado.testing.gen_test
+    async def test_binary_content_is_turned_down(self):
+        room = await self.room()
+        owner = await self.connect(f"code={room['c']}&su={room['su']}")
+        player = await self.connect(f"code={room['c']}&name=player")
+        su = await self.read(player)
+        assert su[2]["type"] == "su"
+        assert (await self.read(owner))[2]["type"] == "userappend"
+
+        for content in (b"\x00\xff", {"nested": [1, b"bytes"]}, {1: "key"}, msgpack.ExtType(1, b"")):
+            await player.write_message(msgpack.packb([1, {"to": 2, "content": content}]), binary=True)
+            assert await self.read(player) == {"type": "error", "error": "invalid payload"}
+        for frame in (b"\xc1\xc1", msgpack.packb(700), msgpack.packb([1])):
+            await player.write_message(frame, binary=True)
+            assert await self.read(player) == {"type": "error", "error": "invalid payload"}
+
+        # The room is still fine, and the broadcast after it gets the next q
+        await player.write_message(msgpack.packb([1, {"to": 2, "content": "fine"}]), binary=True)
+        assert await self.read(player) == [0, 1, {"type": "msg", "from": "player", "am": "fine"}]
+        assert (await self.read(owner))[2] == {"type": "msg", "from": "player", "am": "fine"}
+
+        await player.write_message(msgpack.packb([3, 0]), binary=True)
+        repeated = await self.read(player)
+        assert repeated["repeat"] == [su[2], {"type": "msg", "from": "player", "am": "fine"},
+                                      {"type": "shadow", "shadow": {"to": 2, "content": "fine"}}]
+        assert repeated["next"] == 2
+
+        late = await self.connect(f"code={room['c']}&name=late")
+        assert (await self.read(late))[:2] == [0, 0]
+        await late.write_message(msgpack.packb([3, 0]), binary=True)
+        assert (await self.read(late))["repeat"][1:] == [{"type": "msg", "from": "player", "am": "fine"}]
+
+
+def test_broadcast_that_cant_be_serialized_leaves_the_log_alone():
+    log = BroadcastLog()
+    log.append(messages.RawMessage(Player("player", None), "fine"))
+    with pytest.raises(TypeError):
+        log.append(messages.RawMessage(Player("player", None), b"\x00"))
+    assert len(log) == 1 and log.end() == 1